@@ -1,64 +1,352 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, g, Response
 from datetime import datetime
+from markupsafe import Markup
+import json
 import os
 import sqlite3
+import bulk_import
+import chat_context
+import chat_history
+import chatbot
+import conditional
 import database
-from chatbot import get_chatbot_response # Import the chatbot function
-
-# Initialize the database
-database.init_db()
-database.migrate_db()
-database.populate_with_more_data()
+import export
+import fragments
+import jobs
+import llm_client
+import metrics
+import pagination
+import quote_conversion
+import scoring
+import search
+import sqltrace
+import summaries
+import write_queue
+from chatbot import get_chatbot_response, stream_chatbot_response # Import the chatbot functions
+
+# Create or migrate the schema; a current database costs a single PRAGMA user_version read
+database.bootstrap()
 
 app = Flask(__name__)
-app.secret_key = os.urandom(24)
-app.config['CSS_VERSION'] = 1 # Increment this number to force CSS refresh
-
+# Every worker process must sign sessions with the same key (gunicorn.conf.py sets one if missing)
+app.secret_key = os.environ.get("SECRET_KEY") or os.urandom(24)
+app.config['CSS_VERSION'] = 6 # Increment this number to force CSS refresh
+# Opt-in: let scrapers on the same host read /metrics without logging in. Leave it off behind a
+# reverse proxy on this host unless the proxy always adds X-Forwarded-For.
+app.config['METRICS_ALLOW_LOCAL'] = os.environ.get("METRICS_ALLOW_LOCAL", "0") == "1"
+metrics.init_app(app)
+if sqltrace.TRACE_AT_STARTUP:
+    sqltrace.tracer.enable()
+
+# Keyset pagination sort options: name -> (SQL column, row key). The id column is always the tie-breaker.
+CUSTOMER_SORTS = {'id': ('c.id', 'id'), 'name': ('c.name COLLATE NOCASE', 'name')}
+ORDER_SORTS = {'id': ('o.id', 'id'), 'date': ('o.order_date', 'order_date')}
+QUOTE_SORTS = {'id': ('q.id', 'id'), 'date': ('q.quote_date', 'quote_date')}
+USER_SORTS = {'id': ('id', 'id'), 'employee_id': ('employee_id', 'employee_id')}
+
+
+def _holds_db_lease(conn):
+    # A connection closed mid-request may already be checked out by another request
+    return conn is not None and conn.checked_out and conn.lease == g.get('_db_lease')
 
 def get_db_connection():
-    conn = sqlite3.connect('/tmp/sales.db')
-    conn.row_factory = sqlite3.Row
+    # One pooled connection per request; conn.close() hands it back to the pool.
+    conn = g.get('_db_conn')
+    if not _holds_db_lease(conn):
+        conn = database.get_pool().acquire()
+        g._db_conn = conn
+        g._db_lease = conn.lease
     return conn
 
+@app.teardown_appcontext
+def release_db_connection(exception):
+    conn = g.get('_db_conn')
+    if _holds_db_lease(conn):
+        conn.close(lease=g._db_lease)
+    g.pop('_db_conn', None)
+    g.pop('_db_lease', None)
+
+def write_row(sql, params, queued=True):
+    """
+    Run a single-row INSERT/UPDATE/DELETE in a BEGIN IMMEDIATE transaction, retried while the
+    database is busy, and return the new row id (or the row count).
+    With WRITE_QUEUE on, the statement goes to the group-commit writer instead (see write_queue.py);
+    pass queued=False when the caller must see constraint errors even in deferred mode.
+    """
+    if queued and write_queue.ENABLED:
+        return write_queue.writer.write(sql, params)
+    conn = get_db_connection()
+    try:
+        cursor = database.write_transaction(conn, lambda conn: conn.execute(sql, params))
+    finally:
+        conn.close()
+    return cursor.lastrowid if sql.startswith('INSERT') else cursor.rowcount
+
+@app.route('/admin/stats')
+def admin_stats():
+    if not can_manage_users():
+        return jsonify({'error': 'Unauthorized'}), 401
+    return jsonify({
+        'db_pool': database.get_pool().stats(),
+        'chatbot_context_cache': chat_context.context_cache.stats(),
+        'llm_client': llm_client.get_client().stats(),
+        'chatbot_router': chatbot.router_stats.snapshot(),
+        'conditional_get': conditional.stats.snapshot(),
+        'fragment_cache': fragments.fragment_cache.stats(),
+        'jobs': jobs.runner.stats(),
+        'write_queue': write_queue.writer.stats(),
+        'write_transactions': database.write_stats.snapshot(),
+    })
+
+@app.route('/admin/sql', methods=['GET', 'POST'])
+def admin_sql():
+    if 'user' not in session:
+        return redirect(url_for('login'))
+    if not can_manage_users():
+        flash('您沒有權限查看 SQL 追蹤。')
+        return redirect(url_for('dashboard'))
+
+    tracer = sqltrace.tracer
+    if request.method == 'POST':
+        action = request.form.get('action')
+        if action == 'enable':
+            try:
+                slow_ms = float(request.form.get('slow_ms') or tracer.slow_ms)
+            except ValueError:
+                flash('慢查詢門檻必須是數字')
+                return redirect(url_for('admin_sql'))
+            tracer.enable(slow_ms)
+            flash(f'SQL 追蹤已開啟，慢查詢門檻 {slow_ms:g} ms')
+        elif action == 'disable':
+            tracer.disable()
+            flash('SQL 追蹤已關閉')
+        elif action == 'reset':
+            tracer.reset()
+            flash('SQL 追蹤統計已清除')
+        return redirect(url_for('admin_sql'))
+
+    top_n = request.args.get('top', sqltrace.TOP_N, type=int)
+    snapshot = tracer.snapshot(max(1, min(top_n, 200)))
+    if request.args.get('format') == 'json':
+        return jsonify(snapshot)
+    return render_template('admin_sql.html', trace=snapshot)
+
+def is_local_request():
+    # Proxied requests also arrive from loopback, so they must not carry X-Forwarded-For
+    return request.remote_addr in ('127.0.0.1', '::1') and 'X-Forwarded-For' not in request.headers
+
+@app.route('/metrics')
+def prometheus_metrics():
+    if not (can_manage_users() or (app.config['METRICS_ALLOW_LOCAL'] and is_local_request())):
+        return jsonify({'error': 'Unauthorized'}), 401
+    pool = database.get_pool().stats()
+    context_cache = chat_context.context_cache.stats()
+    conditional_get = conditional.stats.snapshot()
+    gauges = [
+        ('db_pool_open_connections', "Open pooled SQLite connections", pool['open']),
+        ('db_pool_idle_connections', "Idle pooled SQLite connections", pool['idle']),
+        ('db_pool_waits', "Checkouts that had to wait for a connection", pool['waits']),
+        ('db_pool_timeouts', "Checkouts that timed out", pool['timeouts']),
+        ('chatbot_context_cache_hit_rate', "Chatbot context cache hit rate", context_cache['hit_rate']),
+        ('conditional_get_hit_rate', "Share of ETag-checked page loads answered with 304", conditional_get['hit_rate']),
+    ]
+    for pool, job_stats in jobs.runner.stats().items():
+        gauges += [
+            (f'jobs_{pool}_in_flight', f"Running and queued {pool} jobs", job_stats['in_flight']),
+            (f'jobs_{pool}_queue_depth', f"{pool} jobs waiting for a worker", job_stats['queue_depth']),
+            (f'jobs_{pool}_rejected', f"{pool} jobs rejected because the queue was full", job_stats['rejected']),
+            (f'jobs_{pool}_wait_seconds_avg', f"Average queue wait of finished {pool} jobs", job_stats['wait_seconds_avg']),
+        ]
+    writes = write_queue.writer.stats()
+    gauges += [
+        ('write_queue_depth', "Writes waiting for the group-commit writer", writes['queue_depth']),
+        ('write_queue_batches', "Transactions committed by the group-commit writer", writes['batches']),
+        ('write_queue_avg_batch', "Average writes per group commit", writes['avg_batch']),
+        ('write_queue_failed', "Queued writes that failed", writes['failed']),
+    ]
+    transactions = database.write_stats.snapshot()
+    gauges += [
+        ('db_busy_retries', "Write transactions retried because the database was busy", transactions['busy_retries']),
+        ('db_busy_failures', "Write transactions that stayed busy after every retry", transactions['busy_failures']),
+    ]
+    return Response(metrics.registry.render(gauges), mimetype='text/plain; version=0.0.4')
+
+INTRO_MESSAGE = "您好！我是您的銷售管理系統助理。我可以協助您查詢客戶、訂單、報價單等銷售資料，並引導您使用系統功能。如果您需要我協助執行某些操作（例如建立或更新資料），請務必在執行前給予我明確的確認。請問有什麼可以為您服務的嗎？"
+
+def start_chat_turn(user_message):
+    """Record the user's message and return (conversation_id, recent turns, summary) for the LLM call."""
+    # Older versions kept the whole history in the cookie; drop it
+    session.pop('chatbot_history', None)
+    conn = get_db_connection()
+    try:
+        conversation_id = chat_history.ensure_conversation(conn, session['user']['id'], session.get('chatbot_conversation'))
+        session['chatbot_conversation'] = conversation_id
+        history, summary = chat_history.context_window(conn, conversation_id)
+        chat_history.append_message(conn, conversation_id, 'user', user_message)
+    finally:
+        # Don't hold a pooled connection while waiting for the LLM
+        conn.close()
+    return conversation_id, history, summary
+
+def save_bot_reply(conversation_id, reply):
+    conn = database.get_pool().acquire()
+    try:
+        chat_history.append_message(conn, conversation_id, 'assistant', reply)
+    finally:
+        conn.close()
+
+JOB_BUSY_MESSAGE = '系統忙碌中，請稍後再試。'
+
+def _chat_job(emit, user_message, history, summary, conversation_id, stream):
+    """Runs on the LLM job pool; the reply is saved even if the client has gone away."""
+    parts = []
+    try:
+        if stream:
+            for delta in stream_chatbot_response(user_message, history=history, summary=summary):
+                parts.append(delta)
+                emit(delta)
+        else:
+            parts.append(get_chatbot_response(user_message, history=history, summary=summary))
+            emit(parts[0])
+    finally:
+        reply = ''.join(parts) or '機器人沒有回應。'
+        save_bot_reply(conversation_id, reply)
+    return reply
+
+def submit_chat_job(user_message, stream=True):
+    """Record the user's turn and queue the LLM call. Raises jobs.JobRejected when the pool is full."""
+    jobs.runner.check_capacity('llm')
+    conversation_id, history, summary = start_chat_turn(user_message)
+    try:
+        return jobs.runner.submit('llm', _chat_job, user_message, history, summary, conversation_id, stream,
+                                  owner_id=session['user']['id'])
+    except jobs.JobRejected:
+        save_bot_reply(conversation_id, JOB_BUSY_MESSAGE)
+        raise
+
+def _job_rejected(error):
+    response = jsonify({'error': JOB_BUSY_MESSAGE})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+def _chat_message():
+    return (request.get_json(silent=True) or {}).get('message')
+
 @app.route('/chatbot_api', methods=['POST'])
 def chatbot_api():
     if 'user' not in session:
         return jsonify({'error': 'Unauthorized'}), 401
 
-    user_message = request.json.get('message')
+    user_message = _chat_message()
+    if not user_message:
+        return jsonify({'error': 'No message provided'}), 400
+
+    try:
+        job_id = submit_chat_job(user_message, stream=False)
+    except jobs.JobRejected as e:
+        return _job_rejected(e)
+    jobs.runner.wait(job_id, jobs.TIMEOUT_SECONDS)
+    job = jobs.runner.get(job_id, session['user']['id'])
+    if job['status'] != jobs.DONE:
+        return jsonify({'error': job['error'] or 'Timed out', 'job_id': job_id}), 504
+
+    return jsonify({'response': job['result']})
+
+@app.route('/chatbot_jobs', methods=['POST'])
+def chatbot_jobs():
+    """Queue a chatbot turn and return at once; the UI polls or streams /jobs/<id>."""
+    if 'user' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    user_message = _chat_message()
     if not user_message:
         return jsonify({'error': 'No message provided'}), 400
 
-    # Get conversation history from session, or initialize if not present
-    conversation_history = session.get('chatbot_history', [])
+    try:
+        job_id = submit_chat_job(user_message)
+    except jobs.JobRejected as e:
+        return _job_rejected(e)
+    return jsonify({
+        'job_id': job_id,
+        'status_url': url_for('job_status', job_id=job_id),
+        'stream_url': url_for('job_stream', job_id=job_id),
+    }), 202
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    if 'user' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    job = jobs.runner.get(job_id, session['user']['id'], since=request.args.get('since', 0, type=int))
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def _relay_chat_job(job_id, owner_id):
+    # Follows the job, not the request: a client disconnect no longer cuts the reply short
+    for event, data in jobs.runner.follow(job_id, owner_id):
+        if event == 'delta':
+            yield _sse('delta', {'content': data})
+        elif event == 'done':
+            yield _sse('done', {'response': data['result']})
+        else:
+            yield _sse('done', {'response': '機器人沒有回應。', 'error': data})
 
-    # Add user message to history
-    conversation_history.append({'role': 'user', 'content': user_message})
+def _event_stream(body, job_id):
+    return Response(body, mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+        'X-Job-Id': job_id,
+    })
 
-    # Get chatbot response
-    bot_response = get_chatbot_response(user_message)
+@app.route('/jobs/<job_id>/stream')
+def job_stream(job_id):
+    if 'user' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    if jobs.runner.get(job_id, session['user']['id']) is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return _event_stream(_relay_chat_job(job_id, session['user']['id']), job_id)
 
-    # Add bot response to history
-    conversation_history.append({'role': 'bot', 'content': bot_response})
+@app.route('/chatbot_stream', methods=['POST'])
+def chatbot_stream():
+    if 'user' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
 
-    # Store updated history back in session
-    session['chatbot_history'] = conversation_history
+    user_message = _chat_message()
+    if not user_message:
+        return jsonify({'error': 'No message provided'}), 400
 
-    return jsonify({'response': bot_response})
+    try:
+        job_id = submit_chat_job(user_message)
+    except jobs.JobRejected as e:
+        return _job_rejected(e)
+    return _event_stream(_relay_chat_job(job_id, session['user']['id']), job_id)
 
 @app.route('/get_chatbot_history', methods=['GET'])
 def get_chatbot_history():
     if 'user' not in session:
         return jsonify({'error': 'Unauthorized'}), 401
-    conversation_history = session.get('chatbot_history', [])
 
-    if not conversation_history:
-        # Add introductory message if history is empty
-        intro_message = "您好！我是您的銷售管理系統助理。我可以協助您查詢客戶、訂單、報價單等銷售資料，並引導您使用系統功能。如果您需要我協助執行某些操作（例如建立或更新資料），請務必在執行前給予我明確的確認。請問有什麼可以為您服務的嗎？"
-        conversation_history.append({'role': 'bot', 'content': intro_message})
-        session['chatbot_history'] = conversation_history # Save the updated history to session
+    before = request.args.get('before', type=int)
+    limit = max(1, min(request.args.get('limit', chat_history.HISTORY_PAGE_SIZE, type=int), 200))
+    conversation_id = session.get('chatbot_conversation')
+    messages, next_before = [], None
+    if conversation_id:
+        conn = get_db_connection()
+        conversation_id = chat_history.ensure_conversation(conn, session['user']['id'], conversation_id)
+        session['chatbot_conversation'] = conversation_id
+        messages, next_before = chat_history.page_messages(conn, conversation_id, before, limit)
+        conn.close()
+
+    history = messages
+    if not history and before is None:
+        # Introductory message for an empty conversation (not stored)
+        history = [{'role': 'bot', 'content': INTRO_MESSAGE}]
 
-    return jsonify({'history': conversation_history})
+    return jsonify({'history': history, 'next_before': next_before})
 
 
 @app.route('/')
@@ -93,6 +381,24 @@ def dashboard():
                          user=session['user'],
                          current_date=current_date)
 
+def customer_listing_query(conn, search_query, search_limit=None):
+    """Build (base_query, where, params, sorts, hits) for the customer list and export."""
+    base_query = "SELECT c.* FROM customers c"
+    where = []
+    params = []
+    sorts = CUSTOMER_SORTS
+
+    hits = search.ranked_hits(conn, 'customers', search_query, limit=search_limit) if search_query else None
+    if hits:
+        cte, params = hits
+        base_query = cte + " SELECT c.*, hits.score FROM hits JOIN customers c ON c.id = hits.id"
+        sorts = search.with_relevance(CUSTOMER_SORTS)
+    elif search_query:
+        # Terms shorter than a trigram fall back to LIKE
+        where.append("(c.name LIKE ? OR c.contact_person LIKE ? OR c.phone LIKE ? OR c.email LIKE ?)")
+        params.extend([f'%{search_query}%', f'%{search_query}%', f'%{search_query}%', f'%{search_query}%'])
+    return base_query, where, params, sorts, hits
+
 @app.route('/customers')
 def customers():
     if 'user' not in session:
@@ -101,21 +407,14 @@ def customers():
     search_query = request.args.get('search')
     
     conn = get_db_connection()
+    base_query, where, params, sorts, hits = customer_listing_query(conn, search_query)
     
-    base_query = "SELECT * FROM customers"
-    params = []
-    
-    if search_query:
-        if "WHERE" in base_query:
-            base_query += " AND (name LIKE ? OR contact_person LIKE ? OR phone LIKE ? OR email LIKE ?)"
-        else:
-            base_query += " WHERE (name LIKE ? OR contact_person LIKE ? OR phone LIKE ? OR email LIKE ?)"
-        params.extend([f'%{search_query}%', f'%{search_query}%', f'%{search_query}%', f'%{search_query}%'])
-    
-    customers = conn.execute(base_query, params).fetchall()
+    args = pagination.parse_args(request.args, sorts, default_sort='relevance' if hits else 'id')
+    page = pagination.fetch_page(conn, base_query, where, params, sorts, 'c.id', args,
+                                 version=database.table_versions(conn, ('customers',)))
     conn.close()
     
-    return render_template('customers.html', customers=customers, search_query=search_query)
+    return render_template('customers.html', customers=page.rows, page=page, search_query=search_query)
 
 @app.route('/customers/add', methods=['POST'])
 def add_customer():
@@ -128,11 +427,8 @@ def add_customer():
     email = request.form.get('email')
     creator_id = session['user']['id'] # Set creator_id to current user's ID
     
-    conn = get_db_connection()
-    conn.execute('INSERT INTO customers (name, contact_person, phone, email, creator_id) VALUES (?, ?, ?, ?, ?)',
-                 (name, contact_person, phone, email, creator_id))
-    conn.commit()
-    conn.close()
+    write_row('INSERT INTO customers (name, contact_person, phone, email, creator_id) VALUES (?, ?, ?, ?, ?)',
+              (name, contact_person, phone, email, creator_id))
     
     flash('客戶已成功新增')
     return redirect(url_for('customers'))
@@ -164,10 +460,9 @@ def edit_customer(customer_id):
         phone = request.form.get('phone')
         email = request.form.get('email')
         
-        conn.execute('UPDATE customers SET name = ?, contact_person = ?, phone = ?, email = ? WHERE id = ?',
-                     (name, contact_person, phone, email, customer_id))
-        conn.commit()
         conn.close()
+        write_row('UPDATE customers SET name = ?, contact_person = ?, phone = ?, email = ? WHERE id = ?',
+                  (name, contact_person, phone, email, customer_id))
         
         flash('客戶已成功更新')
         return redirect(url_for('customers'))
@@ -196,14 +491,68 @@ def delete_customer(customer_id):
         conn.close()
         return redirect(url_for('customers'))
 
-    conn.execute('DELETE FROM customers WHERE id = ?', (customer_id,))
-    conn.commit()
     conn.close()
+    write_row('DELETE FROM customers WHERE id = ?', (customer_id,))
     
     flash('客戶已成功刪除')
     return redirect(url_for('customers'))
 
+def document_listing_query(conn, table, search_query, search_limit=None):
+    """
+    Build (base_query, where, params, sorts, hits) for the order or quote list and export.
+    Regular users only see the documents they created.
+    """
+    alias, sorts = ('o', ORDER_SORTS) if table == 'orders' else ('q', QUOTE_SORTS)
+    base_query = f"SELECT {alias}.*, c.name as customer_name FROM {table} {alias} JOIN customers c ON {alias}.customer_id = c.id"
+    where = []
+    params = []
+    scope = None
+
+    if not is_system_admin() and not is_administrator(): # Administrators can view everything
+        scope = session['user']['id']
+        where.append(f"{alias}.creator_id = ?")
+        params.append(scope)
+    
+    hits = None
+    if search_query:
+        hits = search.ranked_hits(conn, table, search_query, 'creator_id' if scope is not None else None, scope, limit=search_limit)
+    if hits:
+        cte, cte_params = hits
+        base_query = cte + f" SELECT {alias}.*, c.name as customer_name, hits.score FROM hits JOIN {table} {alias} ON {alias}.id = hits.id JOIN customers c ON {alias}.customer_id = c.id"
+        params = cte_params + params
+        sorts = search.with_relevance(sorts)
+    elif search_query:
+        # Terms shorter than a trigram fall back to LIKE; ids are matched exactly
+        if search_query.strip().isdigit():
+            where.append(f"({alias}.id = ? OR c.name LIKE ? OR {alias}.status LIKE ?)")
+            params.extend([int(search_query), f'%{search_query}%', f'%{search_query}%'])
+        else:
+            where.append(f"(c.name LIKE ? OR {alias}.status LIKE ?)")
+            params.extend([f'%{search_query}%', f'%{search_query}%'])
+    return base_query, where, params, sorts, hits
+
+def cached_listing(conn, table, search_query):
+    """
+    Render the search bar, table and pager of /orders or /quotes. The fragment is reused until
+    the table or customers change, keyed by role, visibility scope and query args.
+    """
+    scope = None if is_system_admin() or is_administrator() else session['user']['id']
+    key = (request.endpoint, conditional.release_tag(), session['user']['role'], scope,
+           tuple(sorted(request.args.items(multi=True))))
+
+    def build():
+        base_query, where, params, sorts, hits = document_listing_query(conn, table, search_query)
+        args = pagination.parse_args(request.args, sorts, default_sort='relevance' if hits else 'id')
+        id_column = 'o.id' if table == 'orders' else 'q.id'
+        # The total must come from the same data version the fragment is stored under
+        page = pagination.fetch_page(conn, base_query, where, params, sorts, id_column, args,
+                                     version=database.table_versions(conn, (table, 'customers')))
+        return render_template(f'_{table}_listing.html', **{table: page.rows}, page=page, search_query=search_query)
+
+    return Markup(fragments.get_or_build(conn, key, (table, 'customers'), build))
+
 @app.route('/orders')
+@conditional.conditional_get('orders', 'customers')
 def orders():
     if 'user' not in session:
         return redirect(url_for('login'))
@@ -211,25 +560,10 @@ def orders():
     search_query = request.args.get('search')
     
     conn = get_db_connection()
-    
-    base_query = "SELECT o.*, c.name as customer_name FROM orders o JOIN customers c ON o.customer_id = c.id"
-    params = []
-
-    if not is_system_admin() and not is_administrator(): # Administrators can view all orders
-        base_query += " WHERE o.creator_id = ?"
-        params.append(session['user']['id'])
-    
-    if search_query:
-        if "WHERE" in base_query:
-            base_query += " AND (o.id LIKE ? OR c.name LIKE ? OR o.status LIKE ?)"
-        else:
-            base_query += " WHERE (o.id LIKE ? OR c.name LIKE ? OR o.status LIKE ?)"
-        params.extend([f'%{search_query}%', f'%{search_query}%', f'%{search_query}%'])
-    
-    orders = conn.execute(base_query, params).fetchall()
+    listing = cached_listing(conn, 'orders', search_query)
     conn.close()
     
-    return render_template('orders.html', orders=orders, search_query=search_query)
+    return render_template('orders.html', listing=listing, search_query=search_query)
 
 @app.route('/orders/add', methods=['POST'])
 def add_order():
@@ -242,15 +576,82 @@ def add_order():
     status = request.form.get('status')
     creator_id = session['user']['id'] # Set creator_id to current user's ID
     
-    conn = get_db_connection()
-    conn.execute('INSERT INTO orders (customer_id, order_date, amount, status, creator_id) VALUES (?, ?, ?, ?, ?)',
-                 (customer_id, order_date, amount, status, creator_id))
-    conn.commit()
-    conn.close()
+    write_row('INSERT INTO orders (customer_id, order_date, amount, status, creator_id) VALUES (?, ?, ?, ?, ?)',
+              (customer_id, order_date, amount, status, creator_id))
     
     flash('訂單已成功新增')
     return redirect(url_for('orders'))
 
+@app.route('/import/<kind>', methods=['POST'])
+def bulk_import_upload(kind):
+    if 'user' not in session:
+        if request.accept_mimetypes.best_match(['application/json', 'text/html']) == 'application/json':
+            return jsonify({'error': 'Unauthorized'}), 401
+        return redirect(url_for('login'))
+    if kind not in bulk_import.KINDS:
+        return jsonify({'error': 'Unknown import type'}), 404
+
+    upload = request.files.get('file')
+    if upload is None or not upload.filename:
+        return jsonify({'error': 'No file provided'}), 400
+    fmt = request.form.get('format') or bulk_import.detect_format(upload.filename)
+    if fmt not in bulk_import.FORMATS:
+        return jsonify({'error': 'Unsupported format'}), 400
+
+    wants_json = request.accept_mimetypes.best_match(['application/json', 'text/html']) == 'application/json'
+
+    # Use a dedicated connection so the import's transactions don't mix with the request's
+    conn = database.connect()
+    try:
+        result = bulk_import.import_stream(conn, kind, upload.stream, fmt, session['user']['id'],
+                                           encoding=request.form.get('encoding') or bulk_import.DEFAULT_ENCODING)
+    except bulk_import.EncodingError as e:
+        # Nothing has been written: the whole file is decoded before the first batch
+        if wants_json:
+            return jsonify({'error': str(e)}), 400
+        flash(f"匯入失敗：{e}")
+        return redirect(url_for(kind))
+    finally:
+        conn.close()
+
+    if wants_json:
+        result['rejects'] = result['rejects'][:100]
+        return jsonify(result)
+    flash(f"匯入完成：成功 {result['inserted']} 筆，拒絕 {result['rejected']} 筆（{result['rows_per_second']} 筆/秒）")
+    for reject in result['rejects'][:5]:
+        flash(f"第 {reject['line']} 行：{reject['error']}")
+    return redirect(url_for(kind))
+
+@app.route('/export/<kind>')
+def export_data(kind):
+    if 'user' not in session:
+        return redirect(url_for('login'))
+    if kind not in export.COLUMNS:
+        return jsonify({'error': 'Unknown export type'}), 404
+    fmt = request.args.get('format', 'csv')
+    if fmt not in export.FORMATS:
+        return jsonify({'error': 'Unsupported format'}), 400
+    compress = request.args.get('gzip') in ('1', 'true')
+
+    # Same visibility and search rules as the list pages, without the search result cap
+    search_query = request.args.get('search')
+    conn = get_db_connection()
+    if kind == 'customers':
+        base_query, where, params, _, _ = customer_listing_query(conn, search_query, search_limit=-1)
+        id_column = 'c.id'
+    else:
+        base_query, where, params, _, _ = document_listing_query(conn, kind, search_query, search_limit=-1)
+        id_column = 'o.id' if kind == 'orders' else 'q.id'
+    conn.close()
+    query = base_query + (" WHERE " + " AND ".join(where) if where else "") + f" ORDER BY {id_column}"
+
+    filename = f"{kind}-{datetime.now():%Y%m%d-%H%M%S}.{fmt}" + ('.gz' if compress else '')
+    return Response(
+        export.stream_export(query, params, export.COLUMNS[kind], fmt, compress),
+        mimetype='application/gzip' if compress else export.MIMETYPES[fmt],
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'},
+    )
+
 @app.route('/orders/edit/<int:order_id>', methods=['GET', 'POST'])
 def edit_order(order_id):
     if 'user' not in session:
@@ -278,10 +679,9 @@ def edit_order(order_id):
         amount = request.form.get('amount')
         status = request.form.get('status')
         
-        conn.execute('UPDATE orders SET customer_id = ?, order_date = ?, amount = ?, status = ? WHERE id = ?',
-                     (customer_id, order_date, amount, status, order_id))
-        conn.commit()
         conn.close()
+        write_row('UPDATE orders SET customer_id = ?, order_date = ?, amount = ?, status = ? WHERE id = ?',
+                  (customer_id, order_date, amount, status, order_id))
         
         flash('訂單已成功更新')
         return redirect(url_for('orders'))
@@ -310,14 +710,14 @@ def delete_order(order_id):
         conn.close()
         return redirect(url_for('orders'))
 
-    conn.execute('DELETE FROM orders WHERE id = ?', (order_id,))
-    conn.commit()
     conn.close()
+    write_row('DELETE FROM orders WHERE id = ?', (order_id,))
     
     flash('訂單已成功刪除')
     return redirect(url_for('orders'))
 
 @app.route('/quotes')
+@conditional.conditional_get('quotes', 'customers')
 def quotes():
     if 'user' not in session:
         return redirect(url_for('login'))
@@ -325,25 +725,10 @@ def quotes():
     search_query = request.args.get('search')
     
     conn = get_db_connection()
-    
-    base_query = "SELECT q.*, c.name as customer_name FROM quotes q JOIN customers c ON q.customer_id = c.id"
-    params = []
-
-    if not is_system_admin() and not is_administrator(): # Administrators can view all quotes
-        base_query += " WHERE q.creator_id = ?"
-        params.append(session['user']['id'])
-    
-    if search_query:
-        if "WHERE" in base_query:
-            base_query += " AND (q.id LIKE ? OR c.name LIKE ? OR q.status LIKE ?)"
-        else:
-            base_query += " WHERE (q.id LIKE ? OR c.name LIKE ? OR q.status LIKE ?)"
-        params.extend([f'%{search_query}%', f'%{search_query}%', f'%{search_query}%'])
-    
-    quotes = conn.execute(base_query, params).fetchall()
+    listing = cached_listing(conn, 'quotes', search_query)
     conn.close()
     
-    return render_template('quotes.html', quotes=quotes, search_query=search_query)
+    return render_template('quotes.html', listing=listing, search_query=search_query)
 
 @app.route('/quotes/add', methods=['POST'])
 def add_quote():
@@ -356,11 +741,8 @@ def add_quote():
     status = request.form.get('status')
     creator_id = session['user']['id'] # Set creator_id to current user's ID
     
-    conn = get_db_connection()
-    conn.execute('INSERT INTO quotes (customer_id, quote_date, amount, status, creator_id) VALUES (?, ?, ?, ?, ?)',
-                 (customer_id, quote_date, amount, status, creator_id))
-    conn.commit()
-    conn.close()
+    write_row('INSERT INTO quotes (customer_id, quote_date, amount, status, creator_id) VALUES (?, ?, ?, ?, ?)',
+              (customer_id, quote_date, amount, status, creator_id))
     
     flash('報價單已成功新增')
     return redirect(url_for('quotes'))
@@ -392,10 +774,9 @@ def edit_quote(quote_id):
         amount = request.form.get('amount')
         status = request.form.get('status')
         
-        conn.execute('UPDATE quotes SET customer_id = ?, quote_date = ?, amount = ?, status = ? WHERE id = ?',
-                     (customer_id, quote_date, amount, status, quote_id))
-        conn.commit()
         conn.close()
+        write_row('UPDATE quotes SET customer_id = ?, quote_date = ?, amount = ?, status = ? WHERE id = ?',
+                  (customer_id, quote_date, amount, status, quote_id))
         
         flash('報價單已成功更新')
         return redirect(url_for('quotes'))
@@ -424,9 +805,8 @@ def delete_quote(quote_id):
         conn.close()
         return redirect(url_for('quotes'))
 
-    conn.execute('DELETE FROM quotes WHERE id = ?', (quote_id,))
-    conn.commit()
     conn.close()
+    write_row('DELETE FROM quotes WHERE id = ?', (quote_id,))
     
     flash('報價單已成功刪除')
     return redirect(url_for('quotes'))
@@ -438,88 +818,127 @@ def automation():
     
     conn = get_db_connection()
     
-    base_query = "SELECT q.*, c.name as customer_name FROM quotes q JOIN customers c ON q.customer_id = c.id WHERE q.status = '已接受'"
-    params = []
-
-    if not is_system_admin() and not is_administrator(): # Administrators can view all accepted quotes for automation
-        base_query += " AND q.creator_id = ?"
-        params.append(session['user']['id'])
-    
-    accepted_quotes = conn.execute(base_query, params).fetchall()
+    filters = _conversion_filters(request.args)
+    # Administrators can view all accepted quotes for automation
+    query, params = quote_conversion.accepted_quotes_query(filters, _automation_creator_filter())
+    accepted_quotes = conn.execute(query + " ORDER BY q.id", params).fetchall()
     conn.close()
     
-    return render_template('automation.html', accepted_quotes=accepted_quotes)
+    return render_template('automation.html', accepted_quotes=accepted_quotes, filters=filters)
+
+def _conversion_filters(source):
+    filters = {}
+    for key in ('search', 'date_from', 'date_to'):
+        value = source.get(key) or ''
+        # JSON bodies can carry numbers or lists here; form and query values are always strings
+        if not isinstance(value, str):
+            raise quote_conversion.ConversionError(f'篩選條件 {key} 必須是文字')
+        filters[key] = value.strip()
+    return filters
+
+def _automation_creator_filter():
+    if is_system_admin() or is_administrator():
+        return None
+    return session['user']['id']
+
+def _run_conversion(conn, quote_ids):
+    results = quote_conversion.convert(conn, quote_ids, session['user']['id'], is_system_admin())
+    conn.close()
+    return results
 
 @app.route('/quotes/convert_to_order/<int:quote_id>', methods=['POST'])
 def convert_to_order(quote_id):
     if 'user' not in session:
         return redirect(url_for('login'))
-        
-    conn = get_db_connection()
-    
-    # Get the quote details
-    quote = conn.execute('SELECT * FROM quotes WHERE id = ?', (quote_id,)).fetchone()
-    
-    if quote is None or quote['status'] != '已接受':
-        flash('無效的操作，或報價單不是「已接受」狀態。')
-        conn.close()
-        return redirect(url_for('automation'))
-    
-    # Permission check: Only system_admin or creator can convert
-    if not is_system_admin() and quote['creator_id'] != session['user']['id']:
+
+    result = _run_conversion(get_db_connection(), [quote_id])[0]['result']
+    if result == quote_conversion.RESULT_FORBIDDEN:
         flash('您沒有權限轉換此報價單。')
-        conn.close()
         return redirect(url_for('automation'))
-        
-    # Create a new order
-    order_date = quote['quote_date'] # Use quote date for order date
-    creator_id = session['user']['id'] # Set creator_id to current user's ID
-    conn.execute('INSERT INTO orders (customer_id, order_date, amount, status, creator_id) VALUES (?, ?, ?, ?, ?)',
-                 (quote['customer_id'], order_date, quote['amount'], '未付款', creator_id))
-                 
-    # Update the quote status
-    conn.execute("UPDATE quotes SET status = '已轉換' WHERE id = ?", (quote_id,))
-    
-    conn.commit()
-    conn.close()
-    
+    if result != quote_conversion.RESULT_CONVERTED:
+        flash('無效的操作，或報價單不是「已接受」狀態。')
+        return redirect(url_for('automation'))
+
     flash(f"報價單 #{quote_id} 已成功轉換為新訂單。")
     return redirect(url_for('orders'))
 
+@app.route('/quotes/convert_batch', methods=['POST'])
+def convert_quotes_batch():
+    """
+    Batch conversion. Accepts either explicit ids (form field quote_ids / JSON "quote_ids")
+    or all accepted quotes matching a filter (form field all_matching / JSON "filter").
+    Retrying the same request never creates duplicate orders.
+    """
+    wants_json = request.is_json or request.accept_mimetypes.best_match(['application/json', 'text/html']) == 'application/json'
+    if 'user' not in session:
+        if wants_json:
+            return jsonify({'error': 'Unauthorized'}), 401
+        return redirect(url_for('login'))
+
+    truncated = False
+    if request.is_json:
+        payload = request.get_json(silent=True) or {}
+        quote_ids = payload.get('quote_ids')
+        filters = payload.get('filter')
+    else:
+        quote_ids = request.form.getlist('quote_ids') if not request.form.get('all_matching') else None
+        filters = _conversion_filters(request.form) if request.form.get('all_matching') else None
+
+    conn = get_db_connection()
+    try:
+        if quote_ids is None and isinstance(filters, dict):
+            quote_ids, truncated = quote_conversion.matching_ids(conn, _conversion_filters(filters),
+                                                                 _automation_creator_filter())
+        elif not isinstance(quote_ids, list) or not quote_ids:
+            raise quote_conversion.ConversionError('請勾選要轉換的報價單，或使用篩選條件轉換全部')
+        results = _run_conversion(conn, quote_ids)
+    except quote_conversion.ConversionError as e:
+        if wants_json:
+            return jsonify({'error': str(e)}), 400
+        flash(str(e))
+        return redirect(url_for('automation'))
+
+    counts = quote_conversion.summarize(results)
+    if wants_json:
+        return jsonify({'results': results, 'counts': counts, 'truncated': truncated})
+    converted = counts.get(quote_conversion.RESULT_CONVERTED, 0)
+    flash(f"批次轉換完成：新建立 {converted} 筆訂單，略過 {len(results) - converted} 張報價單。")
+    skipped = {
+        quote_conversion.RESULT_ALREADY_CONVERTED: '已轉換過',
+        quote_conversion.RESULT_NOT_FOUND: '找不到',
+        quote_conversion.RESULT_NOT_ACCEPTED: '不是「已接受」狀態',
+        quote_conversion.RESULT_FORBIDDEN: '沒有權限',
+    }
+    for result, label in skipped.items():
+        ids = [str(item['quote_id']) for item in results if item['result'] == result]
+        if ids:
+            flash(f"{label}：#{', #'.join(ids[:20])}{' …' if len(ids) > 20 else ''}")
+    if truncated:
+        flash(f"符合條件的報價單超過 {quote_conversion.MAX_BATCH} 張，請再執行一次以轉換其餘的報價單。")
+    return redirect(url_for('automation'))
+
+def _plain_overview(overview):
+    # sqlite3.Row can't be pickled for the shared on-disk cache
+    return dict(overview,
+                top_customers=[dict(row) for row in overview['top_customers']],
+                order_status_distribution=[dict(row) for row in overview['order_status_distribution']])
+
 @app.route('/analysis')
+@conditional.conditional_get('orders', 'quotes', 'customers')
 def analysis():
     if 'user' not in session:
         return redirect(url_for('login'))
     
     conn = get_db_connection()
     
-    # Sales Summary
-    sales_summary_query = conn.execute('SELECT COUNT(*), SUM(amount) FROM orders').fetchone()
-    total_orders = sales_summary_query[0] if sales_summary_query[0] else 0
-    total_revenue = sales_summary_query[1] if sales_summary_query[1] else 0
-    average_order_value = total_revenue / total_orders if total_orders > 0 else 0
-    sales_summary = {
-        'total_orders': total_orders,
-        'total_revenue': total_revenue,
-        'average_order_value': average_order_value
-    }
-    
-    # Quote Conversion Rate
-    quote_summary_query = conn.execute("SELECT COUNT(*), (SELECT COUNT(*) FROM quotes WHERE status = '已接受' OR status = '已轉換') FROM quotes").fetchone()
-    total_quotes = quote_summary_query[0] if quote_summary_query[0] else 0
-    converted_quotes = quote_summary_query[1] if quote_summary_query[1] else 0
-    conversion_rate = converted_quotes / total_quotes if total_quotes > 0 else 0
-    quote_summary = {
-        'total_quotes': total_quotes,
-        'converted_quotes': converted_quotes,
-        'conversion_rate': conversion_rate
-    }
-    
-    # Top Customers
-    top_customers = conn.execute('SELECT c.name, SUM(o.amount) AS total_spent FROM orders o JOIN customers c ON o.customer_id = c.id GROUP BY c.name ORDER BY total_spent DESC LIMIT 5').fetchall()
-    
-    # Order Status Distribution
-    order_status_distribution = conn.execute('SELECT status, COUNT(*) as count FROM orders GROUP BY status').fetchall()
+    # Sales summary, quote conversion, top customers and status distribution
+    # are read from the trigger-maintained summary tables
+    overview = fragments.get_or_build(conn, ('analysis',), ('orders', 'quotes', 'customers'),
+                                      lambda: _plain_overview(summaries.sales_overview(conn)))
+    sales_summary = overview['sales_summary']
+    quote_summary = overview['quote_summary']
+    top_customers = overview['top_customers']
+    order_status_distribution = overview['order_status_distribution']
     
     conn.close()
     
@@ -544,71 +963,37 @@ def analysis():
         suggestions=suggestions
     )
 
+SCORING_TABLES = ('customers', 'orders', 'quotes')
+# How long /ai_features waits for the scoring job before rendering a pending page
+AI_FEATURES_WAIT_SECONDS = float(os.environ.get("AI_FEATURES_WAIT_SECONDS", "2"))
+
 @app.route('/ai_features')
 def ai_features():
     if 'user' not in session:
         return redirect(url_for('login'))
 
     conn = get_db_connection()
-    customers = conn.execute('SELECT * FROM customers').fetchall()
-    orders = conn.execute('SELECT * FROM orders').fetchall()
-    quotes = conn.execute('SELECT * FROM quotes').fetchall()
+    version = database.table_versions(conn, SCORING_TABLES)
     conn.close()
 
-    # --- Customer Scoring ---
-    customer_scores = {}
-    for customer in customers:
-        customer_scores[customer['id']] = {'name': customer['name'], 'score': 0}
-
-    for order in orders:
-        if order['customer_id'] in customer_scores:
-            if order['status'] == '取消':
-                customer_scores[order['customer_id']]['score'] -= 10
-            else:
-                customer_scores[order['customer_id']]['score'] += 10
-
-    for quote in quotes:
-        if quote['customer_id'] in customer_scores:
-            if quote['status'] == '已接受' or quote['status'] == '已轉換':
-                customer_scores[quote['customer_id']]['score'] += 5
-
-    # --- Customer Segmentation ---
-    customer_spending = {c['id']: {'name': c['name'], 'total_spent': 0} for c in customers}
-    for order in orders:
-        if order['customer_id'] in customer_spending and order['status'] != '取消':
-            customer_spending[order['customer_id']]['total_spent'] += order['amount']
-    
-    spendings = sorted([v['total_spent'] for v in customer_spending.values() if v['total_spent'] > 0])
-    
-    p25, p75 = 0, 0
-    if spendings:
-        p25_index = int(len(spendings) * 0.25)
-        p75_index = int(len(spendings) * 0.75)
-        p25 = spendings[p25_index]
-        p75 = spendings[p75_index]
-
-    # Add spending to scores for sorting
-    for cid, data in customer_scores.items():
-        data['total_spent'] = customer_spending[cid]['total_spent']
-        if data['total_spent'] > (sum(s for s in spendings) / len(spendings) if spendings else 0):
-             data['score'] += 20
-
-
-    segments = {'high_value': [], 'mid_value': [], 'low_value': []}
-    for cid, data in customer_spending.items():
-        if data['total_spent'] >= p75 and p75 > 0:
-            segments['high_value'].append(data)
-        elif data['total_spent'] >= p25:
-            segments['mid_value'].append(data)
-        else:
-            segments['low_value'].append(data)
-
-    scored_customers_list = sorted(customer_scores.values(), key=lambda x: x['score'], reverse=True)
-
+    # Customer scoring and P25/P75 segmentation (see scoring.py) runs on the scoring job pool.
+    # One job per data version, shared by everyone; a slow run is shown as pending and polled.
+    try:
+        job_id = jobs.runner.submit('scoring', scoring.score_database, database.DB_PATH,
+                                    dedup_key=f"scoring:{version}")
+    except jobs.JobRejected:
+        return render_template('ai_features.html', job=None, busy=True), 503
+    jobs.runner.wait(job_id, AI_FEATURES_WAIT_SECONDS)
+    job = jobs.runner.get(job_id)
+    if job['status'] != jobs.DONE:
+        return render_template('ai_features.html', job=job)
+
+    scored_customers_list, segments = job['result']
     return render_template(
         'ai_features.html',
         scored_customers=scored_customers_list,
-        segments=segments
+        segments=segments,
+        job=job
     )
 
 
@@ -633,18 +1018,21 @@ def users():
         return redirect(url_for('edit_user', user_id=session['user']['id']))
 
     # Admins and System Admins can see the full list.
-    search_query = request.args.get('search')
+    args = pagination.parse_args(request.args, USER_SORTS)
+    search_query = args['search']
     conn = get_db_connection()
     
+    where = []
+    params = []
     if search_query:
-        query = "SELECT * FROM users WHERE employee_id LIKE ? OR name LIKE ? OR role LIKE ?"
-        users_list = conn.execute(query, (f'%{search_query}%', f'%{search_query}%', f'%{search_query}%')).fetchall()
-    else:
-        users_list = conn.execute('SELECT * FROM users').fetchall()
-        
+        where.append("(employee_id LIKE ? OR name LIKE ? OR role LIKE ?)")
+        params.extend([f'%{search_query}%', f'%{search_query}%', f'%{search_query}%'])
+
+    page = pagination.fetch_page(conn, 'SELECT * FROM users', where, params, USER_SORTS, 'id', args,
+                                 version=database.table_versions(conn, ('users',)))
     conn.close()
     
-    return render_template('users.html', users=users_list, search_query=search_query)
+    return render_template('users.html', users=page.rows, page=page, search_query=search_query)
 
 @app.route('/users/add', methods=['POST'])
 def add_user():
@@ -671,16 +1059,12 @@ def add_user():
     elif not role: # If system_admin didn't specify, default to 'user'
         role = 'user'
 
-    conn = get_db_connection()
     try:
-        conn.execute('INSERT INTO users (employee_id, password, name, role, creator_id) VALUES (?, ?, ?, ?, ?)',
-                     (employee_id, password, name, role, creator_id))
-        conn.commit()
+        write_row('INSERT INTO users (employee_id, password, name, role, creator_id) VALUES (?, ?, ?, ?, ?)',
+                  (employee_id, password, name, role, creator_id), queued=False)
         flash('帳號已成功新增')
     except sqlite3.IntegrityError:
         flash('員工ID已存在，請使用其他ID。')
-    finally:
-        conn.close()
     
     return redirect(url_for('users'))
 
@@ -743,8 +1127,7 @@ def edit_user(user_id):
             query = f"UPDATE users SET {', '.join(query_parts)} WHERE id = ?"
 
             try:
-                conn.execute(query, tuple(params))
-                conn.commit()
+                database.write_transaction(conn, lambda conn: conn.execute(query, tuple(params)))
                 flash('帳號已成功更新')
 
                 if user_id == session['user']['id']:
@@ -796,14 +1179,12 @@ def delete_user(user_id):
         conn.close()
         return redirect(url_for('users'))
 
+    conn.close()
     try:
-        conn.execute('DELETE FROM users WHERE id = ?', (user_id,))
-        conn.commit()
+        write_row('DELETE FROM users WHERE id = ?', (user_id,), queued=False)
         flash('帳號已成功刪除')
     except sqlite3.Error as e:
         flash(f'刪除帳號失敗: {e}')
-    finally:
-        conn.close()
     
     return redirect(url_for('users'))
 
@@ -812,7 +1193,4 @@ def logout():
     session.clear()
     return redirect(url_for('login'))
 if __name__ == "__main__":
-    database.init_db()
-    database.migrate_db()
-    database.populate_with_more_data()
     app.run(debug=True)
@@ -0,0 +1,684 @@
+"""
+路由層級的壓力測試。
+
+依規模產生（或重複使用）合成資料庫，以真正的 HTTP 伺服器執行 app，
+多個用戶端同時登入並依權重隨機打各個頁面；聊天機器人改接 llm_stub 的本機端點。
+每個路由記錄請求數、錯誤數、吞吐量與 p50/p95/p99 延遲，結果寫成 JSON，
+並與儲存的基準比較，任何路由明顯變慢就以非零結束碼失敗。
+
+    python benchmark.py                                # 預設 small、medium
+    python benchmark.py --sizes large --clients 16 --duration 30
+    python benchmark.py --save-baseline                # 把這次的結果存成基準
+    python benchmark.py --sizes none                   # 只量測冷啟動
+    python benchmark.py --sizes none --startup-runs 0  # 只比較逐筆 commit 與批次提交的寫入吞吐量
+    python benchmark.py --sizes none --startup-runs 0 --write-clients 0 --stress-workers 8
+                                                       # 8 個 worker 行程同時寫入，檢查沒有遺失的寫入
+    python benchmark.py --sizes none --startup-runs 0 --write-clients 0 --scoring-orders 1000000
+                                                       # 只量測 100 萬筆訂單的客戶評分時間
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import requests
+from werkzeug.serving import WSGIRequestHandler, make_server
+import database
+import generate_data
+import scoring
+
+SIZES = {
+    'small': dict(users=20, customers=1_000, orders=10_000, quotes=2_000),
+    'medium': dict(users=50, customers=10_000, orders=200_000, quotes=40_000),
+    'large': dict(users=200, customers=100_000, orders=2_000_000, quotes=400_000),
+}
+
+# (名稱, 方法, 路徑, 權重)；每個用戶端依權重隨機挑下一個請求
+SCENARIO = (
+    ('login', 'POST', '/login', 1),
+    ('customers_search', 'GET', '/customers', 3),
+    ('orders', 'GET', '/orders', 4),
+    ('quotes', 'GET', '/quotes', 3),
+    ('analysis', 'GET', '/analysis', 2),
+    ('ai_features', 'GET', '/ai_features', 1),
+    ('automation', 'GET', '/automation', 1),
+    ('chatbot_api', 'POST', '/chatbot_api', 1),
+)
+
+SEARCH_TERMS = ('宏達', '聯發科技', '台灣', '國際', '控股', '電子', '富邦實業', '中信')
+CHAT_MESSAGES = (
+    "分析最近三個月的訂單趨勢",
+    "為什麼報價單轉換率偏低？",
+    "前 5 大客戶",
+    "有多少筆未付款的訂單？",
+)
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+# 與基準比較時允許的變動比例；延遲另外允許固定的毫秒數，避免極快的路由因雜訊誤報
+TOLERANCE = 0.3
+LATENCY_SLACK_MS = 5.0
+# 百分位數之上至少要有這麼多筆樣本才拿來比較（例如 p99 需要 500 筆），樣本太少時雜訊比訊號大
+MIN_TAIL_SAMPLES = 5
+STARTUP_SLACK_MS = 20.0
+
+# 在全新的 Python process 中量測匯入 app 的時間，以及第一個請求（GET /login）的回應時間
+_STARTUP_SCRIPT = '''
+import json, time
+started = time.perf_counter()
+from app import app
+imported = time.perf_counter()
+status = app.test_client().get('/login').status_code
+finished = time.perf_counter()
+print(json.dumps({'import_ms': (imported - started) * 1000, 'first_response_ms': (finished - imported) * 1000,
+                  'status': status}))
+'''
+STARTUP_METRICS = ('import_ms', 'first_response_ms', 'process_ms')
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * q))]
+
+
+def seed_database(path, size, seed=42, fresh=False, log=print):
+    """產生指定規模的資料庫；已存在且 schema 為最新版時直接沿用。"""
+    if fresh:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+    database.DB_PATH = path
+    if os.path.exists(path):
+        conn = sqlite3.connect(path)
+        try:
+            if database.get_schema_version(conn) == database.SCHEMA_VERSION:
+                return 0.0
+        finally:
+            conn.close()
+        os.remove(path)
+    started = time.perf_counter()
+    log(f"產生 {size} 資料：{SIZES[size]}")
+    database.bootstrap()
+    conn = database.connect()
+    try:
+        generate_data.generate(conn, seed=seed, reset=True, log=lambda message: None, **SIZES[size])
+    finally:
+        conn.close()
+    return time.perf_counter() - started
+
+
+def _accounts(path, count):
+    """系統管理員加上幾位一般業務，讓權限過濾的查詢也被測到。"""
+    conn = sqlite3.connect(path)
+    try:
+        users = conn.execute(
+            "SELECT employee_id, password FROM users WHERE role = 'user' ORDER BY id LIMIT ?", (count,)
+        ).fetchall()
+    finally:
+        conn.close()
+    return [('1', '1')] + users
+
+
+class _Client(threading.Thread):
+    def __init__(self, base_url, account, warmup_until, deadline, seed):
+        super().__init__(daemon=True)
+        self.base_url = base_url
+        self.account = account
+        self.warmup_until = warmup_until
+        self.deadline = deadline
+        self.random = random.Random(seed)
+        self.samples = []  # (路由名稱, 秒數, HTTP 狀態碼；連線失敗為 None)
+
+    def _request(self, session, name, method, path):
+        kwargs = {'allow_redirects': False, 'timeout': 60}
+        if name == 'login':
+            kwargs['data'] = {'employee_id': self.account[0], 'password': self.account[1]}
+        elif name == 'customers_search':
+            kwargs['params'] = {'search': self.random.choice(SEARCH_TERMS)}
+        elif name == 'chatbot_api':
+            kwargs['json'] = {'message': self.random.choice(CHAT_MESSAGES)}
+        started = time.perf_counter()
+        try:
+            response = session.request(method, self.base_url + path, **kwargs)
+            response.content
+            status = response.status_code
+        except requests.RequestException:
+            status = None
+        return time.perf_counter() - started, status
+
+    def run(self):
+        weights = [step[3] for step in SCENARIO]
+        with requests.Session() as session:
+            self._request(session, *SCENARIO[0][:3])
+            while time.perf_counter() < self.deadline:
+                name, method, path, _ = self.random.choices(SCENARIO, weights)[0]
+                seconds, status = self._request(session, name, method, path)
+                if time.perf_counter() > self.warmup_until:
+                    self.samples.append((name, seconds, status))
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def _summarize(samples, seconds):
+    latencies = sorted(latency for _, latency, _ in samples)
+    statuses = {}
+    for _, _, status in samples:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    # 登入成功會轉址，其餘頁面都應該直接回 200
+    errors = sum(1 for name, _, status in samples if status != (302 if name == 'login' else 200))
+    return {
+        'requests': len(samples),
+        'errors': errors,
+        'status_codes': statuses,
+        'throughput': round(len(samples) / seconds, 2) if seconds else 0.0,
+        'mean_ms': round(sum(latencies) / len(latencies) * 1000, 2) if latencies else 0.0,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+    }
+
+
+def run_load(app, db_path, clients=8, duration=10.0, warmup=2.0, llm_delay=0.05, seed=42):
+    """對 db_path 執行一輪負載，回傳各路由與整體的統計。"""
+    import chat_context
+    import chatbot
+    import pagination
+    from llm_stub import StubLLMServer
+
+    database.DB_PATH = db_path
+    # 不同資料庫的版本號可能相同，換資料庫前先清掉所有快取
+    chat_context.context_cache.clear()
+    pagination.clear_count_cache()
+
+    accounts = _accounts(db_path, max(clients - 1, 1))
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=_QuietHandler)
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    original_url = chatbot.DEEPSEEK_API_URL
+    try:
+        with StubLLMServer(reply="這是壓力測試用的回覆。", delay=llm_delay) as stub:
+            chatbot.DEEPSEEK_API_URL = stub.url
+            base_url = f"http://127.0.0.1:{server.server_port}"
+            started = time.perf_counter()
+            workers = [
+                _Client(base_url, accounts[i % len(accounts)], started + warmup, started + warmup + duration, seed + i)
+                for i in range(clients)
+            ]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+    finally:
+        chatbot.DEEPSEEK_API_URL = original_url
+        server.shutdown()
+        server_thread.join()
+
+    samples = [sample for worker in workers for sample in worker.samples]
+    routes = {}
+    for name, _, _, _ in SCENARIO:
+        routes[name] = _summarize([s for s in samples if s[0] == name], duration)
+    return {'routes': routes, 'total': _summarize(samples, duration)}
+
+
+def _start_process(db_path):
+    env = dict(os.environ, DB_PATH=db_path)
+    started = time.perf_counter()
+    completed = subprocess.run([sys.executable, '-c', _STARTUP_SCRIPT], cwd=os.path.dirname(os.path.abspath(__file__)),
+                               env=env, capture_output=True, text=True, check=True)
+    sample = json.loads(completed.stdout.strip().splitlines()[-1])
+    sample['process_ms'] = (time.perf_counter() - started) * 1000
+    return sample
+
+
+def measure_startup(runs=5):
+    """
+    冷啟動時間（毫秒，取中位數）：
+        current_schema  資料庫已是最新版，只需檢查 schema 版本
+        new_database    每次都是空的資料庫，需要建立 schema
+    process_ms 另外包含 Python 直譯器本身的啟動時間。
+    """
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='sales-startup-') as directory:
+        current = os.path.join(directory, 'current.db')
+        _start_process(current)  # 先建立好 schema，不列入量測
+        for label in ('current_schema', 'new_database'):
+            samples = []
+            for run in range(runs):
+                path = current if label == 'current_schema' else os.path.join(directory, f'new-{run}.db')
+                samples.append(_start_process(path))
+            results[label] = {key: round(statistics.median(s[key] for s in samples), 1) for key in STARTUP_METRICS}
+    return results
+
+
+_WRITE_SQL = "INSERT INTO orders (customer_id, order_date, amount, status, creator_id) VALUES (1, '2024-01-01', ?, '未付款', 1)"
+
+
+def measure_writes(writers=16, duration=3.0, durability='full'):
+    """
+    同時 writers 個執行緒不斷新增訂單，比較兩種寫法的吞吐量與延遲：
+        direct  每個執行緒用自己的連線，一筆一個交易（目前預設的寫法）
+        queued  交給 write_queue 的批次提交寫入執行緒
+    兩者使用相同的 synchronous 設定（durability 見 write_queue.py），各自從空的資料庫開始。
+    """
+    import write_queue
+
+    def run(label, path):
+        deadline = time.perf_counter() + duration
+        samples = []
+        lock = threading.Lock()
+        writer = write_queue.WriteQueue(path, durability=durability) if label == 'queued' else None
+
+        def worker():
+            conn = None if writer else database.connect(path)
+            if conn is not None:
+                conn.execute(f"PRAGMA synchronous={write_queue.DURABILITIES[durability]}")
+            local = []
+            i = 0
+            try:
+                while time.perf_counter() < deadline:
+                    started = time.perf_counter()
+                    try:
+                        if writer:
+                            writer.write(_WRITE_SQL, (float(i),))
+                        else:
+                            conn.execute(_WRITE_SQL, (float(i),))
+                            conn.commit()
+                        ok = True
+                    except sqlite3.Error:
+                        ok = False
+                    local.append((time.perf_counter() - started, ok))
+                    i += 1
+            finally:
+                if conn is not None:
+                    conn.close()
+            with lock:
+                samples.extend(local)
+
+        threads = [threading.Thread(target=worker) for _ in range(writers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if writer:
+            writer.flush()
+            batches = writer.stats()
+            writer.close()
+        conn = sqlite3.connect(path)
+        try:
+            rows = conn.execute("SELECT COUNT(*) FROM orders WHERE order_date = '2024-01-01'").fetchone()[0]
+        finally:
+            conn.close()
+        latencies = sorted(seconds for seconds, _ in samples)
+        result = {
+            'writes': len(samples),
+            'errors': sum(1 for _, ok in samples if not ok),
+            'rows': rows,
+            'throughput': round(rows / duration, 1),
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+            'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        }
+        if writer:
+            result['avg_batch'] = round(batches['avg_batch'], 1)
+        return result
+
+    results = {'writers': writers, 'duration': duration, 'durability': durability}
+    original = database.DB_PATH
+    with tempfile.TemporaryDirectory(prefix='sales-writes-') as directory:
+        try:
+            for label in ('direct', 'queued'):
+                path = os.path.join(directory, f'{label}.db')
+                database.DB_PATH = path
+                database.bootstrap()
+                conn = sqlite3.connect(path)
+                conn.execute("INSERT OR IGNORE INTO customers (id, name, contact_person, phone, email, creator_id) "
+                             "VALUES (1, '壓測客戶', '-', '-', '-', 1)")
+                conn.commit()
+                conn.close()
+                results[label] = run(label, path)
+        finally:
+            database.DB_PATH = original
+    direct = results['direct']['throughput']
+    results['speedup'] = round(results['queued']['throughput'] / direct, 2) if direct else None
+    return results
+
+
+def _time_scoring(path, orders, customers, runs, seed):
+    conn = sqlite3.connect(path)
+    try:
+        reuse = database.get_schema_version(conn) == database.SCHEMA_VERSION
+    finally:
+        conn.close()
+    original = database.DB_PATH
+    database.DB_PATH = path
+    try:
+        if not reuse:
+            database.bootstrap(seed_demo_data=False)
+            conn = database.connect()
+            try:
+                generate_data.generate(conn, users=5, customers=customers, orders=orders, quotes=orders // 5,
+                                       seed=seed, reset=True, log=lambda message: None)
+            finally:
+                conn.close()
+        conn = database.connect()
+        try:
+            samples = []
+            for _ in range(max(1, runs)):
+                started = time.perf_counter()
+                scoring.score_customers(conn)
+                samples.append(time.perf_counter() - started)
+            return samples
+        finally:
+            conn.close()
+    finally:
+        database.DB_PATH = original
+
+
+def measure_scoring(orders=1_000_000, customers=10_000, runs=3, data_dir=None, seed=42):
+    """
+    /ai_features 評分（scoring.score_customers）的時間，取 runs 次的中位數。
+    給 data_dir 時資料庫留在那裡，下次直接沿用；per_million_seconds 換算成每 100 萬筆訂單，
+    與 scoring 的目標（TARGET）及防止退步的上限（BUDGET）比較。
+    """
+    name = f'scoring-{orders}-{customers}-{seed}.db'
+    if data_dir:
+        samples = _time_scoring(os.path.join(data_dir, name), orders, customers, runs, seed)
+    else:
+        with tempfile.TemporaryDirectory(prefix='sales-scoring-') as directory:
+            samples = _time_scoring(os.path.join(directory, name), orders, customers, runs, seed)
+    seconds = statistics.median(samples)
+    per_million = seconds * 1_000_000 / max(1, orders)
+    return {
+        'orders': orders,
+        'customers': customers,
+        'runs': len(samples),
+        'median_seconds': round(seconds, 3),
+        'per_million_seconds': round(per_million, 3),
+        'target_seconds': scoring.TARGET_SECONDS_PER_MILLION_ORDERS,
+        'budget_seconds': scoring.BUDGET_SECONDS_PER_MILLION_ORDERS,
+        'meets_target': per_million <= scoring.TARGET_SECONDS_PER_MILLION_ORDERS,
+    }
+
+
+def _stress_worker(path, worker, writes):
+    """
+    在獨立的行程中執行（等同一個 gunicorn worker）：以 test client 登入後新增、修改、刪除自己的訂單。
+    第 i 筆新增金額 i 的訂單；i % 5 == 4 時刪除，否則 i % 3 == 1 時改成 i + 0.5。
+    回傳非預期的回應數與 busy 重試統計。
+    """
+    database.DB_PATH = path
+    from app import app
+    status = f'stress-{worker}'
+    errors = []
+    conn = sqlite3.connect(path)
+    try:
+        with app.test_client() as client:
+            def failed(response):
+                # 未登入或出錯時也會轉址（回到登入頁），只有轉回列表頁才算成功
+                return response.status_code != 302 or '/orders' not in response.headers.get('Location', '')
+
+            client.post('/login', data={'employee_id': '1', 'password': '1'})
+            for i in range(writes):
+                form = {'customer_id': '1', 'order_date': '2024-02-02', 'amount': str(i), 'status': status}
+                response = client.post('/orders/add', data=form)
+                if failed(response):
+                    errors.append(('add', i, response.status_code))
+                    continue
+                if i % 3 == 1 or i % 5 == 4:
+                    order_id = conn.execute("SELECT id FROM orders WHERE status = ? AND amount = ?",
+                                            (status, float(i))).fetchone()[0]
+                    if i % 5 == 4:
+                        action, response = 'delete', client.post(f'/orders/delete/{order_id}')
+                    else:
+                        action, response = 'edit', client.post(f'/orders/edit/{order_id}', data=dict(form, amount=str(i + 0.5)))
+                    if failed(response):
+                        errors.append((action, i, response.status_code))
+    finally:
+        conn.close()
+    return {'errors': errors, **database.write_stats.snapshot()}
+
+
+def _expected_amounts(writes):
+    return sorted(i + 0.5 if i % 3 == 1 else float(i) for i in range(writes) if i % 5 != 4)
+
+
+def stress_workers(workers=4, writes=200, db_path=None):
+    """
+    workers 個行程同時對同一個 SQLite 檔新增、修改、刪除訂單，結束後逐一比對每個行程應有的資料列。
+    lost 為缺少、多出或內容不符的資料列數，正常時必須為 0。
+    """
+    import concurrent.futures
+    import multiprocessing
+
+    with tempfile.TemporaryDirectory(prefix='sales-stress-') as directory:
+        path = db_path or os.path.join(directory, 'stress.db')
+        original = database.DB_PATH
+        database.DB_PATH = path
+        try:
+            database.bootstrap()
+        finally:
+            database.DB_PATH = original
+        conn = sqlite3.connect(path)
+        conn.execute("INSERT OR IGNORE INTO customers (id, name, contact_person, phone, email, creator_id) "
+                     "VALUES (1, '壓測客戶', '-', '-', '-', 1)")
+        conn.execute("DELETE FROM orders WHERE status LIKE 'stress-%'")
+        conn.commit()
+        conn.close()
+
+        started = time.perf_counter()
+        with concurrent.futures.ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            reports = list(pool.map(_stress_worker, [path] * workers, range(workers), [writes] * workers))
+        seconds = time.perf_counter() - started
+
+        conn = sqlite3.connect(path)
+        try:
+            lost = 0
+            expected = _expected_amounts(writes)
+            for worker in range(workers):
+                actual = sorted(row[0] for row in conn.execute(
+                    "SELECT amount FROM orders WHERE status = ?", (f'stress-{worker}',)))
+                lost += len(set(expected) ^ set(actual)) + abs(len(expected) - len(actual))
+        finally:
+            conn.close()
+
+    requests_made = workers * sum(1 + (i % 3 == 1 or i % 5 == 4) for i in range(writes))
+    return {
+        'workers': workers,
+        'requests': requests_made,
+        'seconds': round(seconds, 2),
+        'throughput': round(requests_made / seconds, 1),
+        'errors': sum(len(report['errors']) for report in reports),
+        'error_samples': [error for report in reports for error in report['errors']][:10],
+        'lost': lost,
+        'busy_retries': sum(report['busy_retries'] for report in reports),
+        'busy_failures': sum(report['busy_failures'] for report in reports),
+    }
+
+
+def compare(results, baseline, tolerance=TOLERANCE, slack_ms=LATENCY_SLACK_MS):
+    """回傳與基準相比退步的項目說明；只比較兩邊都有的規模與路由。"""
+    regressions = []
+    for size, result in results['sizes'].items():
+        base_size = baseline.get('sizes', {}).get(size)
+        if not base_size:
+            continue
+        for name, stats in list(result['routes'].items()) + [('total', result['total'])]:
+            base = base_size['total'] if name == 'total' else base_size['routes'].get(name)
+            if not base or not base['requests']:
+                continue
+            label = f"{size}/{name}"
+            for key, q in (('p50_ms', 0.50), ('p95_ms', 0.95), ('p99_ms', 0.99)):
+                if min(stats['requests'], base['requests']) * (1 - q) < MIN_TAIL_SAMPLES:
+                    continue
+                limit = base[key] * (1 + tolerance) + slack_ms
+                if stats[key] > limit:
+                    regressions.append(f"{label} {key} {stats[key]} > {limit:.2f}（基準 {base[key]}）")
+            if name == 'total' and stats['throughput'] < base['throughput'] * (1 - tolerance):
+                regressions.append(f"{label} throughput {stats['throughput']} < 基準 {base['throughput']} 的 {1 - tolerance:.0%}")
+            if stats['errors'] and not base['errors']:
+                regressions.append(f"{label} 出現 {stats['errors']} 個錯誤（基準為 0）")
+    scored = results.get('scoring')
+    if scored:
+        if scored['per_million_seconds'] > scored['budget_seconds']:
+            regressions.append(f"scoring per_million_seconds {scored['per_million_seconds']} > 上限 {scored['budget_seconds']}")
+        base = baseline.get('scoring')
+        if base and base['orders'] == scored['orders']:
+            limit = base['median_seconds'] * (1 + tolerance)
+            if scored['median_seconds'] > limit:
+                regressions.append(f"scoring median_seconds {scored['median_seconds']} > {limit:.3f}（基準 {base['median_seconds']}）")
+    for label, stats in results.get('startup', {}).items():
+        base = baseline.get('startup', {}).get(label)
+        if not base:
+            continue
+        for key in STARTUP_METRICS:
+            limit = base[key] * (1 + tolerance) + STARTUP_SLACK_MS
+            if stats[key] > limit:
+                regressions.append(f"startup/{label} {key} {stats[key]} > {limit:.1f}（基準 {base[key]}）")
+    return regressions
+
+
+def _print_table(size, result):
+    print(f"\n[{size}]  {'route':<18}{'req':>7}{'err':>5}{'req/s':>9}{'p50':>9}{'p95':>9}{'p99':>9}  (ms)")
+    for name, stats in list(result['routes'].items()) + [('total', result['total'])]:
+        print(f"        {name:<18}{stats['requests']:>7}{stats['errors']:>5}{stats['throughput']:>9}"
+              f"{stats['p50_ms']:>9}{stats['p95_ms']:>9}{stats['p99_ms']:>9}")
+
+
+def _print_startup(startup):
+    print(f"\n[startup]  {'':<16}{'import':>9}{'first req':>11}{'process':>9}  (ms)")
+    for label, stats in startup.items():
+        print(f"           {label:<16}{stats['import_ms']:>9}{stats['first_response_ms']:>11}{stats['process_ms']:>9}")
+
+
+def _print_writes(writes):
+    print(f"\n[writes]   {writes['writers']} 個執行緒，durability={writes['durability']}")
+    print(f"           {'':<10}{'rows/s':>9}{'err':>5}{'p50':>9}{'p95':>9}{'p99':>9}  (ms)")
+    for label in ('direct', 'queued'):
+        stats = writes[label]
+        print(f"           {label:<10}{stats['throughput']:>9}{stats['errors']:>5}"
+              f"{stats['p50_ms']:>9}{stats['p95_ms']:>9}{stats['p99_ms']:>9}")
+    print(f"           批次提交為逐筆 commit 的 {writes['speedup']} 倍（平均每批 {writes['queued']['avg_batch']} 筆）")
+
+
+def _print_scoring(scored):
+    status = '達成' if scored['meets_target'] else '未達成'
+    print(f"\n[scoring]  {scored['orders']:,} 筆訂單、{scored['customers']:,} 位客戶：{scored['median_seconds']} 秒"
+          f"（每 100 萬筆 {scored['per_million_seconds']} 秒，目標 {scored['target_seconds']} 秒{status}，"
+          f"上限 {scored['budget_seconds']} 秒）")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="路由層級的壓力測試")
+    parser.add_argument('--sizes', default='small,medium', help=f"逗號分隔，可用：{', '.join(SIZES)}；none 表示不跑負載")
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=10.0, help="每種規模量測的秒數（不含暖機）")
+    parser.add_argument('--warmup', type=float, default=2.0)
+    parser.add_argument('--llm-delay', type=float, default=0.05, help="模擬 LLM 上游的回應時間（秒）")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--startup-runs', type=int, default=5, help="冷啟動量測次數，0 表示不量測")
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'sales-bench'),
+                        help="產生的資料庫放在這裡，下次執行直接沿用")
+    parser.add_argument('--fresh', action='store_true', help="重新產生資料庫")
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true', help="把結果寫成新的基準，不做比較")
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    parser.add_argument('--write-clients', type=int, default=16, help="寫入吞吐量測試的執行緒數，0 表示不量測")
+    parser.add_argument('--write-duration', type=float, default=3.0)
+    parser.add_argument('--write-durability', default='full', help="full、normal 或 deferred（見 write_queue.py）")
+    parser.add_argument('--stress-workers', type=int, default=0, help="多行程寫入壓力測試的 worker 數，0 表示不執行")
+    parser.add_argument('--stress-writes', type=int, default=200, help="每個 worker 新增的訂單數")
+    parser.add_argument('--scoring-orders', type=int, default=1_000_000, help="客戶評分量測的訂單數，0 表示不量測")
+    parser.add_argument('--scoring-runs', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    sizes = [size.strip() for size in args.sizes.split(',') if size.strip() and size.strip() != 'none']
+    unknown = [size for size in sizes if size not in SIZES]
+    if unknown:
+        parser.error(f"未知的規模: {', '.join(unknown)}")
+    os.makedirs(args.data_dir, exist_ok=True)
+
+    # app 匯入時會初始化 database.DB_PATH，先指向第一個壓測資料庫，避免動到平常用的資料庫
+    paths = {size: os.path.join(args.data_dir, f"{size}-{args.seed}.db") for size in sizes}
+    seed_seconds = {size: seed_database(paths[size], size, args.seed, args.fresh) for size in sizes}
+
+    results = {
+        'meta': {
+            'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'clients': args.clients,
+            'duration': args.duration,
+            'llm_delay': args.llm_delay,
+            'seed': args.seed,
+        },
+        'sizes': {},
+    }
+    if args.startup_runs > 0:
+        results['startup'] = measure_startup(args.startup_runs)
+        _print_startup(results['startup'])
+    if args.write_clients > 0:
+        results['writes'] = measure_writes(args.write_clients, args.write_duration, args.write_durability)
+        _print_writes(results['writes'])
+    if args.scoring_orders > 0:
+        results['scoring'] = measure_scoring(args.scoring_orders, runs=args.scoring_runs,
+                                             data_dir=args.data_dir, seed=args.seed)
+        _print_scoring(results['scoring'])
+    if args.stress_workers > 0:
+        results['stress'] = stress_workers(args.stress_workers, args.stress_writes)
+        stress = results['stress']
+        print(f"\n[stress]   {stress['workers']} 個 worker 行程，{stress['requests']} 個寫入請求，"
+              f"{stress['throughput']} req/s，錯誤 {stress['errors']}，遺失 {stress['lost']}，"
+              f"busy 重試 {stress['busy_retries']}")
+    if sizes:
+        database.DB_PATH = paths[sizes[0]]
+        from app import app
+    for size in sizes:
+        result = run_load(app, paths[size], args.clients, args.duration, args.warmup, args.llm_delay, args.seed)
+        result['rows'] = SIZES[size]
+        result['seed_seconds'] = round(seed_seconds[size], 2)
+        results['sizes'][size] = result
+        _print_table(size, result)
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"\n結果已寫入 {args.output}")
+
+    stress = results.get('stress')
+    if stress and (stress['lost'] or stress['errors']):
+        print("\n!!! 多行程寫入有錯誤或遺失 !!!")
+        return 1
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"基準已更新：{args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f"找不到基準 {args.baseline}，略過比較（可用 --save-baseline 建立）")
+        return 0
+    with open(args.baseline, encoding='utf-8') as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print("\n!!! 效能退步 !!!")
+        for line in regressions:
+            print("  " + line)
+        return 1
+    print("與基準相比沒有退步")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
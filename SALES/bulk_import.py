@@ -0,0 +1,340 @@
+"""
+客戶、訂單、報價單的批次匯入（CSV / NDJSON）。
+
+逐行串流讀取檔案、驗證每一筆資料，訂單與報價單的客戶可以用 customer_id 或 customer_name 指定。
+通過驗證的資料以 executemany 分批寫入，每批一個交易；不合格的資料記錄下來，不會中斷整個匯入。
+
+    python bulk_import.py orders orders.csv
+    python bulk_import.py customers customers.ndjson --rejects rejected.ndjson
+    python bulk_import.py orders orders-big5.csv --encoding cp950
+
+檔案預設為 UTF-8（可有 BOM），其他編碼（例如 Excel 存出的 Big5 / cp950）以 encoding 指定。
+無法以該編碼解碼的檔案在寫入任何資料之前整個被拒絕。
+
+CSV 第一列為欄位名稱；NDJSON 每行一個 JSON 物件。欄位：
+    customers: name, contact_person, phone, email
+    orders:    customer_id 或 customer_name, order_date (YYYY-MM-DD), amount, status
+    quotes:    customer_id 或 customer_name, quote_date (YYYY-MM-DD), amount, status
+"""
+import argparse
+import codecs
+import csv
+import datetime
+import io
+import json
+import math
+import os
+import re
+import sys
+import tempfile
+import time
+import database
+
+BATCH_SIZE = int(os.environ.get("IMPORT_BATCH_SIZE", "5000"))
+# 結果中最多保留的拒絕明細筆數（完整清單可另外寫到檔案）
+MAX_REPORTED_REJECTS = 1000
+MAX_TEXT_LENGTH = 200
+DEFAULT_ENCODING = 'utf-8'
+# 檢查編碼時每次讀取的位元組數；無法倒帶的串流（標準輸入）超過這個大小的部分先暫存到磁碟
+_CHUNK_SIZE = 64 * 1024
+_SPOOL_BYTES = 16 * 1024 * 1024
+
+KINDS = ('customers', 'orders', 'quotes')
+FORMATS = ('csv', 'ndjson')
+
+_EMAIL = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s]+$')
+
+_INSERTS = {
+    'customers': "INSERT INTO customers (name, contact_person, phone, email, creator_id) VALUES (?, ?, ?, ?, ?)",
+    'orders': "INSERT INTO orders (customer_id, order_date, amount, status, creator_id) VALUES (?, ?, ?, ?, ?)",
+    'quotes': "INSERT INTO quotes (customer_id, quote_date, amount, status, creator_id) VALUES (?, ?, ?, ?, ?)",
+}
+
+
+class RowError(ValueError):
+    """單筆資料驗證失敗。"""
+
+
+class EncodingError(ValueError):
+    """檔案無法以指定的編碼解碼（或編碼名稱不存在）；整個檔案被拒絕。"""
+
+
+def detect_format(filename, default='csv'):
+    extension = os.path.splitext(filename or '')[1].lower()
+    if extension in ('.ndjson', '.jsonl', '.json'):
+        return 'ndjson'
+    if extension == '.csv':
+        return 'csv'
+    return default
+
+
+def read_records(stream, fmt):
+    """從文字串流逐筆產生 (行號, 資料 dict)；無法解析的行產生 (行號, RowError)。"""
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for record in reader:
+            if None in record:
+                yield reader.line_num, RowError("欄位數量多於標題列")
+            else:
+                yield reader.line_num, record
+    elif fmt == 'ndjson':
+        for line_no, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                yield line_no, RowError(f"JSON 格式錯誤: {e}")
+                continue
+            if not isinstance(record, dict):
+                yield line_no, RowError("每行必須是一個 JSON 物件")
+                continue
+            yield line_no, record
+    else:
+        raise ValueError(f"不支援的格式: {fmt}")
+
+
+def _text(record, field, required=False):
+    value = record.get(field)
+    value = '' if value is None else str(value).strip()
+    if required and not value:
+        raise RowError(f"缺少 {field}")
+    if len(value) > MAX_TEXT_LENGTH:
+        raise RowError(f"{field} 超過 {MAX_TEXT_LENGTH} 個字元")
+    return value
+
+
+def _date(record, field):
+    value = _text(record, field, required=True)
+    try:
+        return datetime.date.fromisoformat(value).isoformat()
+    except ValueError:
+        raise RowError(f"{field} 不是有效的日期 (YYYY-MM-DD): {value}")
+
+
+def _amount(record):
+    value = record.get('amount')
+    try:
+        amount = float(value)
+    except (TypeError, ValueError):
+        raise RowError(f"amount 不是數字: {value}")
+    if not math.isfinite(amount) or amount < 0:
+        raise RowError(f"amount 必須是非負數: {value}")
+    return amount
+
+
+def _customer_ref(record):
+    """回傳 ('id', int) 或 ('name', str)。"""
+    raw_id = record.get('customer_id')
+    if raw_id not in (None, ''):
+        try:
+            return 'id', int(str(raw_id).strip())
+        except ValueError:
+            raise RowError(f"customer_id 不是整數: {raw_id}")
+    name = _text(record, 'customer_name')
+    if not name:
+        raise RowError("缺少 customer_id 或 customer_name")
+    return 'name', name
+
+
+def validate(kind, record):
+    """驗證並正規化一筆資料；訂單與報價單的客戶欄位先保留為參照，批次寫入前再解析。"""
+    if kind == 'customers':
+        email = _text(record, 'email')
+        if email and not _EMAIL.match(email):
+            raise RowError(f"email 格式錯誤: {email}")
+        return (_text(record, 'name', required=True), _text(record, 'contact_person'), _text(record, 'phone'), email)
+    date_field = 'order_date' if kind == 'orders' else 'quote_date'
+    return (_customer_ref(record), _date(record, date_field), _amount(record), _text(record, 'status', required=True))
+
+
+class CustomerResolver:
+    """把 customer_id / customer_name 解析成存在的客戶 id，每批只查一次資料庫並快取結果。"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.ids = set()
+        self.names = {}
+
+    def prefetch(self, refs):
+        ids = [value for kind, value in refs if kind == 'id' and value not in self.ids]
+        names = list({value.lower() for kind, value in refs if kind == 'name' and value.lower() not in self.names})
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            self.ids.update(row[0] for row in self.conn.execute(
+                f"SELECT id FROM customers WHERE id IN ({', '.join('?' for _ in chunk)})", chunk
+            ))
+        for start in range(0, len(names), 500):
+            chunk = names[start:start + 500]
+            # 同名客戶取 id 最小的一筆；名稱比對不分大小寫（使用 idx_customers_name）
+            for row in self.conn.execute(
+                f"SELECT MIN(id), name FROM customers WHERE name COLLATE NOCASE IN ({', '.join('?' for _ in chunk)}) "
+                f"GROUP BY name COLLATE NOCASE", chunk
+            ):
+                self.names[row[1].lower()] = row[0]
+
+    def resolve(self, ref):
+        kind, value = ref
+        if kind == 'id':
+            if value not in self.ids:
+                raise RowError(f"找不到客戶 ID: {value}")
+            return value
+        customer_id = self.names.get(value.lower())
+        if customer_id is None:
+            raise RowError(f"找不到客戶: {value}")
+        return customer_id
+
+
+def import_records(conn, kind, records, creator_id, batch_size=None, on_reject=None):
+    """
+    匯入 read_records() 產生的資料，回傳匯入結果 dict。
+    on_reject(line, error, record) 會在每筆資料被拒絕時呼叫（例如寫到拒絕清單檔案）。
+    """
+    if kind not in KINDS:
+        raise ValueError(f"不支援的資料類型: {kind}")
+    batch_size = batch_size or BATCH_SIZE
+    insert = _INSERTS[kind]
+    resolver = CustomerResolver(conn) if kind != 'customers' else None
+    result = {'kind': kind, 'rows': 0, 'inserted': 0, 'rejected': 0, 'rejects': []}
+    start = time.perf_counter()
+
+    def reject(line, error, record):
+        result['rejected'] += 1
+        if len(result['rejects']) < MAX_REPORTED_REJECTS:
+            result['rejects'].append({'line': line, 'error': str(error)})
+        if on_reject:
+            on_reject(line, str(error), record)
+
+    def flush(batch):
+        rows = []
+        if resolver:
+            resolver.prefetch([values[0] for _, values, _ in batch])
+            for line, values, record in batch:
+                try:
+                    rows.append((resolver.resolve(values[0]),) + values[1:] + (creator_id,))
+                except RowError as e:
+                    reject(line, e, record)
+        else:
+            rows = [values + (creator_id,) for _, values, _ in batch]
+        if rows:
+            with conn:
+                conn.executemany(insert, rows)
+            result['inserted'] += len(rows)
+
+    batch = []
+    for line, record in records:
+        result['rows'] += 1
+        if isinstance(record, RowError):
+            reject(line, record, None)
+            continue
+        try:
+            batch.append((line, validate(kind, record), record))
+        except RowError as e:
+            reject(line, e, record)
+            continue
+        if len(batch) >= batch_size:
+            flush(batch)
+            batch = []
+    if batch:
+        flush(batch)
+
+    result['seconds'] = round(time.perf_counter() - start, 3)
+    result['rows_per_second'] = round(result['rows'] / result['seconds']) if result['seconds'] else result['rows']
+    return result
+
+
+def _codec(encoding):
+    try:
+        name = codecs.lookup(encoding or DEFAULT_ENCODING).name
+    except LookupError:
+        raise EncodingError(f"不支援的編碼: {encoding}") from None
+    # UTF-8 一律容許 BOM（Excel 存出的 CSV 常有）
+    return 'utf-8-sig' if name == 'utf-8' else name
+
+
+def check_encoding(stream, encoding):
+    """把整個串流以 encoding 解碼一遍，失敗時拋出 EncodingError（含行號）。不會倒帶串流。"""
+    decoder = codecs.getincrementaldecoder(encoding)()
+    line = 1
+    while True:
+        chunk = stream.read(_CHUNK_SIZE)
+        try:
+            text = decoder.decode(chunk, final=not chunk)
+        except UnicodeDecodeError as e:
+            line += e.object[:e.start].count(b'\n')
+            raise EncodingError(f"第 {line} 行無法以 {encoding} 解碼，請確認檔案編碼") from None
+        line += text.count('\n')
+        if not chunk:
+            return
+
+
+def import_stream(conn, kind, stream, fmt, creator_id, encoding=DEFAULT_ENCODING, **kwargs):
+    """
+    從二進位串流（例如上傳的檔案）匯入。先確認整個檔案都能以 encoding 解碼，
+    不能時拋出 EncodingError，不寫入任何資料。
+    """
+    encoding = _codec(encoding)
+    if not stream.seekable():
+        spooled = tempfile.SpooledTemporaryFile(max_size=_SPOOL_BYTES)
+        while chunk := stream.read(_CHUNK_SIZE):
+            spooled.write(chunk)
+        spooled.seek(0)
+        stream = spooled
+    start = stream.tell()
+    check_encoding(stream, encoding)
+    stream.seek(start)
+
+    text = io.TextIOWrapper(stream, encoding=encoding, newline='')
+    try:
+        return import_records(conn, kind, read_records(text, fmt), creator_id, **kwargs)
+    finally:
+        text.detach()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="批次匯入客戶、訂單或報價單")
+    parser.add_argument('kind', choices=KINDS)
+    parser.add_argument('path', help="CSV 或 NDJSON 檔案，'-' 代表標準輸入")
+    parser.add_argument('--format', choices=FORMATS, help="預設依副檔名判斷")
+    parser.add_argument('--creator-id', type=int, default=1, help="匯入資料的建立者 (users.id)")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--encoding', default=DEFAULT_ENCODING, help="檔案編碼，例如 utf-8、cp950（Big5）")
+    parser.add_argument('--rejects', help="把被拒絕的資料寫到這個 NDJSON 檔案")
+    args = parser.parse_args(argv)
+
+    fmt = args.format or detect_format(args.path)
+    database.bootstrap()
+    conn = database.connect()
+    rejects_file = open(args.rejects, 'w', encoding='utf-8') if args.rejects else None
+
+    def on_reject(line, error, record):
+        if rejects_file:
+            rejects_file.write(json.dumps({'line': line, 'error': error, 'record': record}, ensure_ascii=False) + "\n")
+
+    try:
+        if args.path == '-':
+            result = import_stream(conn, args.kind, sys.stdin.buffer, fmt, args.creator_id,
+                                   batch_size=args.batch_size, encoding=args.encoding,
+                                   on_reject=on_reject)
+        else:
+            with open(args.path, 'rb') as f:
+                result = import_stream(conn, args.kind, f, fmt, args.creator_id,
+                                       batch_size=args.batch_size, encoding=args.encoding,
+                                       on_reject=on_reject)
+    except EncodingError as e:
+        print(e, file=sys.stderr)
+        return 1
+    finally:
+        conn.close()
+        if rejects_file:
+            rejects_file.close()
+
+    for reject in result['rejects'][:20]:
+        print(f"第 {reject['line']} 行：{reject['error']}")
+    print(f"匯入完成：共 {result['rows']} 筆，成功 {result['inserted']} 筆，拒絕 {result['rejected']} 筆，"
+          f"耗時 {result['seconds']} 秒（{result['rows_per_second']} 筆/秒）")
+    return 0 if result['rejected'] == 0 else 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
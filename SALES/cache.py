@@ -0,0 +1,253 @@
+"""
+以資料版本為鍵的行程內快取。
+
+每筆快取都記錄建立時的資料版本（例如 database.table_versions() 的結果）；
+讀取時版本不同就視為失效並重建。同一個鍵同時有多個請求未命中時，只有一個會去建立，
+其他的等待結果，所以一波同時送來的請求只會花一次建立成本。
+
+VersionedCache 以筆數為上限；FragmentCache 以位元組為上限（渲染好的 HTML 片段、查詢結果），
+並可選擇搭配 DiskStore，讓同一台機器上的多個 worker 行程共用已建立的項目。
+"""
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class VersionedCache:
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._building = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get_or_build(self, key, version, build):
+        """回傳 key 在 version 時的值；沒有或版本不同時呼叫 build() 建立。"""
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None and entry[0] == version:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                pending = self._building.get(key)
+                if pending is None:
+                    if entry is not None:
+                        self.invalidations += 1
+                    self.misses += 1
+                    pending = self._building[key] = threading.Event()
+                    break
+            # 其他執行緒正在建立同一個鍵，等它完成後再讀一次
+            pending.wait()
+
+        try:
+            value = self._load(key, version)
+            if value is _MISSING:
+                value = build()
+                self._save(key, version, value)
+            with self._lock:
+                self._store(key, version, value)
+            return value
+        finally:
+            with self._lock:
+                del self._building[key]
+            pending.set()
+
+    def _load(self, key, version):
+        """行程內未命中時的第二層查詢；預設沒有第二層。"""
+        return _MISSING
+
+    def _save(self, key, version, value):
+        """新建立的值寫入第二層；預設沒有第二層。"""
+
+    def _store(self, key, version, value):
+        # 呼叫時已持有 lock
+        self._entries[key] = (version, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+            }
+
+
+def _size(value):
+    if isinstance(value, str):
+        return len(value.encode('utf-8'))
+    if isinstance(value, bytes):
+        return len(value)
+    return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+
+class FragmentCache(VersionedCache):
+    """
+    以位元組為上限的 LRU 版本快取。值必須可以 pickle（字串、dict、list 等），
+    超過 max_bytes 時從最久未使用的項目開始淘汰；單一項目超過上限的四分之一時不放入記憶體。
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, disk=None):
+        super().__init__(max_entries=None)
+        self.max_bytes = max_bytes
+        self.disk = disk
+        self.bytes = 0
+        self.evictions = 0
+        self.disk_hits = 0
+
+    def _load(self, key, version):
+        if self.disk is None:
+            return _MISSING
+        value = self.disk.get(key, version)
+        if value is not _MISSING:
+            with self._lock:
+                self.disk_hits += 1
+        return value
+
+    def _save(self, key, version, value):
+        if self.disk is not None:
+            self.disk.put(key, version, value)
+
+    def _store(self, key, version, value):
+        size = _size(value)
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.bytes -= old[2]
+        if size > self.max_bytes // 4:
+            return
+        self._entries[key] = (version, value, size)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, (_, _, evicted) = self._entries.popitem(last=False)
+            self.bytes -= evicted
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        stats = super().stats()
+        with self._lock:
+            stats.update({
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'evictions': self.evictions,
+                'disk_hits': self.disk_hits,
+            })
+        if self.disk is not None:
+            stats['disk'] = self.disk.stats()
+        return stats
+
+
+class DiskStore:
+    """
+    多個 worker 行程共用的 SQLite 快取檔（WAL）。項目以 (key, version) 查詢，
+    超過 max_bytes 時刪除最早寫入的項目。任何 SQLite 錯誤都只計數，並視為未命中，不影響請求。
+    """
+
+    # 每寫入幾次檢查一次檔案大小
+    TRIM_EVERY = 64
+
+    def __init__(self, path, max_bytes=256 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.errors = 0
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=1, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS fragments (
+                    key TEXT PRIMARY KEY,
+                    version TEXT NOT NULL,
+                    value BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    stored_at REAL NOT NULL
+                )
+            ''')
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_fragments_stored ON fragments (stored_at)")
+            self._local.conn = conn
+        return conn
+
+    def _failed(self):
+        with self._lock:
+            self.errors += 1
+
+    def get(self, key, version):
+        try:
+            row = self._conn().execute(
+                "SELECT value FROM fragments WHERE key = ? AND version = ?", (repr(key), repr(version))
+            ).fetchone()
+            return _MISSING if row is None else pickle.loads(row[0])
+        except Exception:
+            # 截斷或過期的 pickle 還可能拋出 EOFError、AttributeError、ImportError 等
+            self._failed()
+            return _MISSING
+
+    def put(self, key, version, value):
+        blob = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if len(blob) > self.max_bytes // 4:
+            return
+        try:
+            conn = self._conn()
+            conn.execute("INSERT OR REPLACE INTO fragments (key, version, value, size, stored_at) VALUES (?, ?, ?, ?, ?)",
+                         (repr(key), repr(version), blob, len(blob), time.time()))
+            with self._lock:
+                self._writes += 1
+                trim = self._writes % self.TRIM_EVERY == 0
+            if trim:
+                self.trim(conn)
+        except sqlite3.Error:
+            self._failed()
+
+    def trim(self, conn=None):
+        conn = conn or self._conn()
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM fragments").fetchone()[0]
+        if total <= self.max_bytes:
+            return 0
+        # 刪到剩下上限的四分之三，避免每次檢查都要刪
+        excess = total - self.max_bytes * 3 // 4
+        return conn.execute('''
+            DELETE FROM fragments WHERE key IN (
+                SELECT key FROM (
+                    SELECT key, size, SUM(size) OVER (ORDER BY stored_at, key) AS running FROM fragments
+                ) WHERE running - size < ?
+            )
+        ''', (excess,)).rowcount
+
+    def stats(self):
+        try:
+            entries, size = self._conn().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM fragments").fetchone()
+        except sqlite3.Error:
+            self._failed()
+            entries, size = None, None
+        with self._lock:
+            errors = self.errors
+        return {'path': self.path, 'entries': entries, 'bytes': size, 'max_bytes': self.max_bytes, 'errors': errors}
@@ -0,0 +1,329 @@
+"""
+聊天機器人的資料庫脈絡擷取。
+
+不再把整個資料庫倒進提示詞，而是先從使用者問題中找出實體（客戶名稱、ID、狀態、日期區間），
+只查詢相關的資料列與少量彙總數字，並控制在 token 預算之內。
+組好的脈絡依 customers / orders / quotes 的變更計數器快取，資料沒有異動時不會重建。
+"""
+import datetime
+import json
+import os
+import re
+import cache
+import database
+import summaries
+
+# 脈絡的 token 預算（粗估），以及每一類資料最多列出的筆數
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CHATBOT_CONTEXT_TOKENS", "2000"))
+MAX_ROWS_PER_SECTION = int(os.environ.get("CHATBOT_CONTEXT_ROWS", "20"))
+# 客戶名稱比對時，最多從問題中嘗試幾個起始位置
+MAX_NAME_PROBES = 64
+# 脈絡只依賴這三張表，其中任一張被寫入時快取才失效
+CONTEXT_TABLES = ('customers', 'orders', 'quotes')
+
+context_cache = cache.VersionedCache(int(os.environ.get("CHATBOT_CONTEXT_CACHE_SIZE", "256")))
+
+# 常見的英文／口語說法對應到資料庫中的狀態值
+STATUS_SYNONYMS = {
+    'pending': ('Pending', '未付款'),
+    '待付款': ('未付款',),
+    '處理中': ('Pending', '未付款'),
+    'unpaid': ('未付款',),
+    'paid': ('已付款',),
+    'completed': ('Completed', '已付款'),
+    'cancelled': ('取消',),
+    'canceled': ('取消',),
+    '已取消': ('取消',),
+    'accepted': ('已接受',),
+    'converted': ('已轉換',),
+    'rejected': ('已拒絕',),
+    'draft': ('草稿',),
+    'sent': ('Sent', '已發送'),
+}
+
+_ORDER_ID = re.compile(r'(?:訂單|order)\s*(?:id|編號|號碼)?\s*[#:：]?\s*(\d+)', re.IGNORECASE)
+_QUOTE_ID = re.compile(r'(?:報價單|報價|quote)\s*(?:id|編號|號碼)?\s*[#:：]?\s*(\d+)', re.IGNORECASE)
+_CUSTOMER_ID = re.compile(r'(?:客戶|customer)\s*(?:id|編號|號碼)?\s*[#:：]?\s*(\d+)', re.IGNORECASE)
+_ISO_DATE = re.compile(r'(\d{4})[-/.](\d{1,2})[-/.](\d{1,2})')
+_YEAR_MONTH = re.compile(r'(\d{4})\s*(?:年|[-/])\s*(\d{1,2})\s*月?(?![-/\d])')
+_LAST_DAYS = re.compile(r'(?:最近|過去|last|past)\s*(\d+)\s*(?:天|日|days?)', re.IGNORECASE)
+_CJK = re.compile(r'[㐀-鿿豈-﫿]')
+_NAME_START = re.compile(r'[㐀-鿿豈-﫿]|(?<![A-Za-z0-9])[A-Za-z0-9]')
+
+_ORDER_WORDS = ('訂單', 'order')
+_QUOTE_WORDS = ('報價', 'quote')
+
+
+def estimate_tokens(text):
+    """粗估 token 數：中日韓字元約一字一 token，其他字元約四字一 token。"""
+    cjk = len(_CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def _month_range(year, month):
+    start = datetime.date(year, month, 1)
+    end = datetime.date(year + (month == 12), month % 12 + 1, 1) - datetime.timedelta(days=1)
+    return start, end
+
+
+def extract_date_range(question, today=None):
+    """回傳 (起日, 迄日) 的 ISO 字串，找不到日期時回傳 None。"""
+    today = today or datetime.date.today()
+    lowered = question.lower()
+
+    dates = []
+    for y, m, d in _ISO_DATE.findall(question):
+        try:
+            dates.append(datetime.date(int(y), int(m), int(d)))
+        except ValueError:
+            pass
+    if dates:
+        return min(dates).isoformat(), max(dates).isoformat()
+
+    match = _YEAR_MONTH.search(question)
+    if match and 1 <= int(match.group(2)) <= 12:
+        start, end = _month_range(int(match.group(1)), int(match.group(2)))
+        return start.isoformat(), end.isoformat()
+
+    match = _LAST_DAYS.search(question)
+    if match:
+        return (today - datetime.timedelta(days=int(match.group(1)))).isoformat(), today.isoformat()
+
+    if '今天' in question or 'today' in lowered:
+        return today.isoformat(), today.isoformat()
+    if any(word in question for word in ('上個月', '上月')) or 'last month' in lowered:
+        last = today.replace(day=1) - datetime.timedelta(days=1)
+        start, end = _month_range(last.year, last.month)
+        return start.isoformat(), end.isoformat()
+    if any(word in question for word in ('本月', '這個月', '这个月')) or 'this month' in lowered:
+        start, end = _month_range(today.year, today.month)
+        return start.isoformat(), end.isoformat()
+    if '去年' in question or 'last year' in lowered:
+        return datetime.date(today.year - 1, 1, 1).isoformat(), datetime.date(today.year - 1, 12, 31).isoformat()
+    if '今年' in question or 'this year' in lowered:
+        return datetime.date(today.year, 1, 1).isoformat(), datetime.date(today.year, 12, 31).isoformat()
+    return None
+
+
+def _known_statuses(conn):
+    statuses = set()
+    for table in ('order_status_summary', 'quote_status_summary'):
+        statuses.update(row[0] for row in conn.execute(f"SELECT status FROM {table}"))
+    return statuses
+
+
+def extract_statuses(conn, question):
+    lowered = question.lower()
+    found = {status for status in _known_statuses(conn) if status and status.lower() in lowered}
+    for word, statuses in STATUS_SYNONYMS.items():
+        if word in lowered:
+            found.update(statuses)
+    return sorted(found)
+
+
+def find_customers(conn, question):
+    """
+    以 customers(name COLLATE NOCASE) 索引找出問題中提到的客戶。
+
+    從問題中每個可能的起始位置（中文字元或英數單字開頭），用前兩個字元做索引範圍查詢，
+    再挑出與問題在該位置有最長共同前綴的客戶名稱。
+    """
+    matches = {}
+    probes = 0
+    for start_match in _NAME_START.finditer(question):
+        if probes >= MAX_NAME_PROBES:
+            break
+        start = start_match.start()
+        tail = question[start:]
+        prefix = tail[:2]
+        if len(prefix) < 2:
+            continue
+        probes += 1
+        rows = conn.execute(
+            "SELECT id, name FROM customers WHERE name COLLATE NOCASE >= ? AND name COLLATE NOCASE < ? LIMIT 200",
+            (prefix, prefix + '\U0010ffff')
+        ).fetchall()
+        best = 0
+        hits = []
+        folded_tail = tail.lower()
+        for row in rows:
+            name = row['name'].lower()
+            common = 0
+            for a, b in zip(name, folded_tail):
+                if a != b:
+                    break
+                common += 1
+            # 名稱完整出現在問題中，或至少有 4 個字元相符（例如「宏達電子」對上「宏達電子股份有限公司」）
+            if common < len(name) and common < 4:
+                continue
+            if common > best:
+                best, hits = common, [row]
+            elif common == best:
+                hits.append(row)
+        for row in hits:
+            matches[row['id']] = row['name']
+    return [{'id': cid, 'name': name} for cid, name in matches.items()]
+
+
+def extract_entities(conn, question, today=None):
+    lowered = question.lower()
+    order_ids = sorted({int(x) for x in _ORDER_ID.findall(question)})
+    quote_ids = sorted({int(x) for x in _QUOTE_ID.findall(question)})
+    customer_ids = sorted({int(x) for x in _CUSTOMER_ID.findall(question)})
+    return {
+        'customers': find_customers(conn, question),
+        'customer_ids': customer_ids,
+        'order_ids': order_ids,
+        'quote_ids': quote_ids,
+        'statuses': extract_statuses(conn, question),
+        'date_range': extract_date_range(question, today),
+        'wants_orders': any(word in lowered for word in _ORDER_WORDS),
+        'wants_quotes': any(word in lowered for word in _QUOTE_WORDS),
+    }
+
+
+def _rows(conn, query, params=()):
+    return [dict(row) for row in conn.execute(query, params).fetchall()]
+
+
+def document_filters(alias, date_column, entities):
+    """依實體的狀態與日期區間產生 WHERE 條件與參數。"""
+    where = []
+    params = []
+    if entities['statuses']:
+        where.append(f"{alias}.status IN ({', '.join('?' for _ in entities['statuses'])})")
+        params.extend(entities['statuses'])
+    if entities['date_range']:
+        where.append(f"{alias}.{date_column} BETWEEN ? AND ?")
+        params.extend(entities['date_range'])
+    return where, params
+
+
+def _documents(conn, table, entities, customer_ids):
+    """依實體篩選訂單或報價單，回傳 (資料列, 彙總)。"""
+    alias, date_column = ('o', 'order_date') if table == 'orders' else ('q', 'quote_date')
+    where, params = document_filters(alias, date_column, entities)
+    if customer_ids:
+        where.append(f"{alias}.customer_id IN ({', '.join('?' for _ in customer_ids)})")
+        params.extend(customer_ids)
+    clause = (" WHERE " + " AND ".join(where)) if where else ""
+    rows = _rows(conn, f'''
+        SELECT {alias}.id, {alias}.customer_id, c.name AS customer_name, {alias}.{date_column}, {alias}.amount, {alias}.status
+        FROM {table} {alias} LEFT JOIN customers c ON c.id = {alias}.customer_id
+        {clause}
+        ORDER BY {alias}.{date_column} DESC, {alias}.id DESC
+        LIMIT ?
+    ''', params + [MAX_ROWS_PER_SECTION])
+    aggregate = conn.execute(
+        f"SELECT COUNT(*), TOTAL({alias}.amount) FROM {table} {alias}{clause}", params
+    ).fetchone()
+    return rows, {'筆數': aggregate[0], '總金額': round(aggregate[1], 2)}
+
+
+def collect_sections(conn, question, today=None):
+    """依問題產生 (標題, 資料列, 彙總) 的清單，越前面越重要。"""
+    entities = extract_entities(conn, question, today)
+    sections = []
+
+    if entities['order_ids']:
+        sections.append(('指定的訂單', _rows(conn, f'''
+            SELECT o.id, o.customer_id, c.name AS customer_name, o.order_date, o.amount, o.status
+            FROM orders o LEFT JOIN customers c ON c.id = o.customer_id
+            WHERE o.id IN ({', '.join('?' for _ in entities['order_ids'])})
+        ''', entities['order_ids']), None))
+    if entities['quote_ids']:
+        sections.append(('指定的報價單', _rows(conn, f'''
+            SELECT q.id, q.customer_id, c.name AS customer_name, q.quote_date, q.amount, q.status
+            FROM quotes q LEFT JOIN customers c ON c.id = q.customer_id
+            WHERE q.id IN ({', '.join('?' for _ in entities['quote_ids'])})
+        ''', entities['quote_ids']), None))
+
+    customer_ids = sorted({c['id'] for c in entities['customers']} | set(entities['customer_ids']))
+    if customer_ids:
+        sections.append(('相關客戶', _rows(conn, f'''
+            SELECT c.id, c.name, c.contact_person, c.phone, c.email,
+                   COALESCE(s.order_count, 0) AS order_count, COALESCE(s.total_amount, 0) AS order_total,
+                   COALESCE(s.quote_count, 0) AS quote_count, COALESCE(s.converted_quotes, 0) AS converted_quotes
+            FROM customers c LEFT JOIN customer_sales_summary s ON s.customer_id = c.id
+            WHERE c.id IN ({', '.join('?' for _ in customer_ids)})
+        ''', customer_ids), None))
+
+    filtered = bool(customer_ids or entities['statuses'] or entities['date_range'])
+    if filtered:
+        # 沒特別指定訂單或報價單時兩者都提供
+        both = entities['wants_orders'] == entities['wants_quotes']
+        if entities['wants_orders'] or both:
+            rows, aggregate = _documents(conn, 'orders', entities, customer_ids)
+            sections.append(('符合條件的訂單', rows, aggregate))
+        if entities['wants_quotes'] or both:
+            rows, aggregate = _documents(conn, 'quotes', entities, customer_ids)
+            sections.append(('符合條件的報價單', rows, aggregate))
+
+    if not sections:
+        # 問題中沒有可辨識的實體：提供整體概況與最近的資料
+        overview = summaries.sales_overview(conn)
+        sections.append(('銷售概況', [], {
+            '總訂單數': overview['sales_summary']['total_orders'],
+            '總銷售額': round(overview['sales_summary']['total_revenue'], 2),
+            '總報價單數': overview['quote_summary']['total_quotes'],
+            '報價轉換數': overview['quote_summary']['converted_quotes'],
+            '訂單狀態分佈': {row['status']: row['count'] for row in overview['order_status_distribution']},
+            '頂尖客戶': [{'name': row['name'], 'total_spent': round(row['total_spent'], 2)} for row in overview['top_customers']],
+        }))
+        sections.append(('最近的訂單', _rows(conn, '''
+            SELECT o.id, o.customer_id, c.name AS customer_name, o.order_date, o.amount, o.status
+            FROM orders o LEFT JOIN customers c ON c.id = o.customer_id
+            ORDER BY o.id DESC LIMIT ?
+        ''', (MAX_ROWS_PER_SECTION // 2,)), None))
+        sections.append(('最近的報價單', _rows(conn, '''
+            SELECT q.id, q.customer_id, c.name AS customer_name, q.quote_date, q.amount, q.status
+            FROM quotes q LEFT JOIN customers c ON c.id = q.customer_id
+            ORDER BY q.id DESC LIMIT ?
+        ''', (MAX_ROWS_PER_SECTION // 2,)), None))
+
+    return sections
+
+
+def render_sections(sections, token_budget=None):
+    """把各區塊轉成文字，超過 token 預算的資料列會被省略並註明筆數。"""
+    budget = CONTEXT_TOKEN_BUDGET if token_budget is None else token_budget
+    used = 0
+    parts = []
+    for title, rows, aggregate in sections:
+        lines = [f"{title}:"]
+        if aggregate:
+            lines.append("彙總: " + json.dumps(aggregate, ensure_ascii=False, separators=(',', ':')))
+        if not rows and not aggregate:
+            lines.append("（查無資料）")
+        header = "\n".join(lines)
+        cost = estimate_tokens(header) + 1
+        if used + cost > budget:
+            break
+        used += cost
+        for index, row in enumerate(rows):
+            line = json.dumps(row, ensure_ascii=False, separators=(',', ':'))
+            cost = estimate_tokens(line) + 1
+            if used + cost > budget:
+                lines.append(f"（另有 {len(rows) - index} 筆因長度限制未列出）")
+                break
+            used += cost
+            lines.append(line)
+        parts.append("\n".join(lines))
+    return "\n\n".join(parts)
+
+
+def build_context(question, token_budget=None, today=None):
+    """回傳送給 LLM 的資料庫脈絡文字（依資料版本快取）。"""
+    question = ' '.join((question or '').split())
+    budget = CONTEXT_TOKEN_BUDGET if token_budget is None else token_budget
+    today = today or datetime.date.today()
+    conn = database.get_pool().acquire()
+    try:
+        version = database.table_versions(conn, CONTEXT_TABLES)
+        return context_cache.get_or_build(
+            (question.lower(), budget, today),
+            version,
+            lambda: render_sections(collect_sections(conn, question, today), budget)
+        )
+    finally:
+        conn.close()
@@ -0,0 +1,138 @@
+"""
+伺服器端的聊天紀錄（chat_conversations / chat_messages）。
+
+session 只保存對話 id；送給 LLM 的多輪脈絡由兩部分組成：
+    * 最近幾輪對話，從最新的往回取，直到用完 token 預算
+    * （可選）較早對話的滾動摘要：每則訊息擷取開頭一段，超過摘要預算時丟掉最舊的
+"""
+import os
+import uuid
+import database
+from chat_context import estimate_tokens
+
+HISTORY_TOKEN_BUDGET = int(os.environ.get("CHATBOT_HISTORY_TOKENS", "1500"))
+SUMMARY_TOKEN_BUDGET = int(os.environ.get("CHATBOT_SUMMARY_TOKENS", "300"))
+ROLLING_SUMMARY = os.environ.get("CHATBOT_ROLLING_SUMMARY", "1") == "1"
+HISTORY_PAGE_SIZE = 50
+# 每則訊息放進摘要的最多字元數；視窗最多回看的訊息數
+SUMMARY_LINE_CHARS = 80
+MAX_WINDOW_MESSAGES = 200
+
+ROLE_LABELS = {'user': '使用者', 'assistant': '助理'}
+
+
+def create_conversation(conn, user_id):
+    conversation_id = uuid.uuid4().hex
+    database.write_transaction(conn, lambda conn: conn.execute(
+        "INSERT INTO chat_conversations (id, user_id) VALUES (?, ?)", (conversation_id, user_id)))
+    return conversation_id
+
+
+def ensure_conversation(conn, user_id, conversation_id=None):
+    """回傳屬於該使用者的對話 id；沒有或不屬於該使用者時建立新的對話。"""
+    if conversation_id:
+        row = conn.execute(
+            "SELECT 1 FROM chat_conversations WHERE id = ? AND user_id = ?", (conversation_id, user_id)
+        ).fetchone()
+        if row:
+            return conversation_id
+    return create_conversation(conn, user_id)
+
+
+def append_message(conn, conversation_id, role, content):
+    def insert(conn):
+        cursor = conn.execute(
+            "INSERT INTO chat_messages (conversation_id, role, content) VALUES (?, ?, ?)",
+            (conversation_id, role, content)
+        )
+        conn.execute("UPDATE chat_conversations SET updated_at = CURRENT_TIMESTAMP WHERE id = ?", (conversation_id,))
+        return cursor.lastrowid
+    return database.write_transaction(conn, insert)
+
+
+def page_messages(conn, conversation_id, before=None, limit=HISTORY_PAGE_SIZE):
+    """
+    由新到舊分頁讀取對話，回傳 (依時間排序的訊息, 下一頁的 before 游標或 None)。
+    before 為訊息 id，只取比它更早的訊息。
+    """
+    params = [conversation_id]
+    where = "conversation_id = ?"
+    if before is not None:
+        where += " AND id < ?"
+        params.append(before)
+    rows = conn.execute(
+        f"SELECT id, role, content, created_at FROM chat_messages WHERE {where} ORDER BY id DESC LIMIT ?",
+        params + [limit + 1]
+    ).fetchall()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    rows.reverse()
+    messages = [dict(row) for row in rows]
+    return messages, (messages[0]['id'] if more and messages else None)
+
+
+def _summary_line(role, content):
+    text = ' '.join(content.split())
+    if len(text) > SUMMARY_LINE_CHARS:
+        text = text[:SUMMARY_LINE_CHARS] + '…'
+    return f"{ROLE_LABELS.get(role, role)}：{text}"
+
+
+def _trim_summary(lines, budget):
+    while lines and estimate_tokens("\n".join(lines)) > budget:
+        lines.pop(0)
+    return lines
+
+
+def _roll_summary(conn, conversation_id, window_start):
+    """把視窗之前、尚未摘要的訊息併入對話摘要，回傳最新的摘要文字。"""
+    summary, summarized_through = conn.execute(
+        "SELECT summary, summarized_through FROM chat_conversations WHERE id = ?", (conversation_id,)
+    ).fetchone()
+    if window_start <= summarized_through + 1:
+        return summary
+    rows = conn.execute(
+        "SELECT id, role, content FROM chat_messages WHERE conversation_id = ? AND id > ? AND id < ? ORDER BY id",
+        (conversation_id, summarized_through, window_start)
+    ).fetchall()
+    if not rows:
+        return summary
+    lines = summary.split("\n") if summary else []
+    lines.extend(_summary_line(row['role'], row['content']) for row in rows)
+    summary = "\n".join(_trim_summary(lines, SUMMARY_TOKEN_BUDGET))
+    database.write_transaction(conn, lambda conn: conn.execute(
+        "UPDATE chat_conversations SET summary = ?, summarized_through = ? WHERE id = ?",
+        (summary, rows[-1]['id'], conversation_id)
+    ))
+    return summary
+
+
+def context_window(conn, conversation_id, token_budget=None):
+    """
+    回傳 (最近的訊息, 摘要)。訊息格式為 LLM API 的 {'role', 'content'}，依時間排序；
+    沒有啟用滾動摘要或沒有較早的訊息時，摘要為空字串。
+    """
+    budget = HISTORY_TOKEN_BUDGET if token_budget is None else token_budget
+    rows = conn.execute(
+        "SELECT id, role, content FROM chat_messages WHERE conversation_id = ? ORDER BY id DESC LIMIT ?",
+        (conversation_id, MAX_WINDOW_MESSAGES)
+    ).fetchall()
+    window = []
+    used = 0
+    for row in rows:
+        cost = estimate_tokens(row['content']) + 4
+        if used + cost > budget:
+            break
+        used += cost
+        window.append(row)
+    window.reverse()
+    # 視窗從使用者的提問開始，避免只留下半輪對話
+    while window and window[0]['role'] != 'user':
+        window.pop(0)
+
+    summary = ''
+    if ROLLING_SUMMARY and rows:
+        # 視窗是空的（最新一則就超過預算）時，所有訊息都算在視窗之前
+        window_start = window[0]['id'] if window else rows[0]['id'] + 1
+        summary = _roll_summary(conn, conversation_id, window_start)
+    return [{'role': row['role'], 'content': row['content']} for row in window], summary
@@ -1,11 +1,19 @@
 import os
-import requests
+import re
 import json
 import sqlite3
+import threading
+import time
+import chat_context
+import database
+import llm_client
 
-# 從環境變數中讀取 DeepSeek API Key
-DEEPSEEK_API_KEY = ("sk-14300a2e726d4835a1c6fc1e6f6c6d98")
-DEEPSEEK_API_URL = "https://api.deepseek.com/chat/completions"
+# 從環境變數中讀取 DeepSeek API Key 與端點（測試時可指向本機的 llm_stub）
+DEEPSEEK_API_KEY = os.environ.get("DEEPSEEK_API_KEY", "sk-14300a2e726d4835a1c6fc1e6f6c6d98")
+DEEPSEEK_API_URL = os.environ.get("DEEPSEEK_API_URL", "https://api.deepseek.com/chat/completions")
+
+# 斷路器開啟（上游持續失敗）時直接回覆，不再等待逾時
+CIRCUIT_OPEN_MESSAGE = "助理服務暫時無法使用，請稍後再試。"
 
 SYSTEM_PROMPT = '''
 你是一個專業、智慧的銷售管理系統助理。你的主要目標是協助使用者（業務人員、經理）有效率地查詢銷售資料。
@@ -30,64 +38,276 @@ def query_database(query: str, params=()):
     執行一個唯讀的查詢到 sales.db 資料庫並回傳結果。
     """
     try:
-        conn = sqlite3.connect('sales.db')
-        conn.row_factory = sqlite3.Row  # 這樣可以透過欄位名稱存取資料
-        cursor = conn.cursor()
-        cursor.execute(query, params)
-        rows = cursor.fetchall()
-        conn.close()
+        conn = database.get_pool().acquire()  # 連線已設定 sqlite3.Row，可透過欄位名稱存取資料
+        try:
+            rows = conn.execute(query, params).fetchall()
+        finally:
+            conn.close()
         # 將 row 物件轉換為字典列表，方便處理
         return [dict(row) for row in rows]
     except sqlite3.Error as e:
         print(f"資料庫錯誤: {e}")
         return []
 
-def get_database_context_for_llm():
+def get_database_context_for_llm(user_message: str = '', token_budget=None):
     """
-    從所有相關表格中提取資料，為 LLM 建立一個文字脈絡。
-    為了簡單起見，我們提取所有資料。在真實世界的應用中，你可能會想根據使用者問題來做更精準的提取。
+    依使用者問題擷取相關資料，為 LLM 建立一個文字脈絡。
+    只查詢問題提到的客戶、ID、狀態與日期區間，並控制在 token 預算之內（見 chat_context.py）。
     """
-    context_parts = []
-
-    # 提取客戶資料
-    customers = query_database("SELECT id, name, contact_person, phone, email FROM customers")
-    if customers:
-        context_parts.append("客戶資料:\n" + json.dumps(customers, ensure_ascii=False, indent=2))
-
-    # 提取訂單資料，並加入客戶名稱
-    orders = query_database('''
-        SELECT o.id, c.name as customer_name, o.order_date, o.amount, o.status
-        FROM orders o
-        JOIN customers c ON o.customer_id = c.id
-    ''')
-    if orders:
-        context_parts.append("訂單資料:\n" + json.dumps(orders, ensure_ascii=False, indent=2))
-
-    # 提取報價單資料，並加入客戶名稱
-    quotes = query_database('''
-        SELECT q.id, c.name as customer_name, q.quote_date, q.amount, q.status
-        FROM quotes q
-        JOIN customers c ON q.customer_id = c.id
-    ''')
-    if quotes:
-        context_parts.append("報價單資料:\n" + json.dumps(quotes, ensure_ascii=False, indent=2))
-
-    if not context_parts:
+    try:
+        context = chat_context.build_context(user_message, token_budget)
+    except sqlite3.Error as e:
+        print(f"資料庫錯誤: {e}")
         return "資料庫中目前沒有資料。"
+    return context or "資料庫中目前沒有資料。"
+
+
+# --- 本地意圖路由：常見問題直接用 SQL 回答，不呼叫 LLM ---
+
+# 需要推理或建議的問題一律交給 LLM
+# 英文關鍵字前後不能緊接英文字母，避免 account 被當成 count、small 被當成 all；
+# 中文字不算英文字母，所以「列出all訂單」仍然符合。推理類的字根允許接字尾（analysis、suggestions）
+_LLM_ONLY = re.compile(r'為什麼|為何|原因|建議|分析|預測|比較|趨勢|如何|怎麼|(?<![a-z])(?:why|suggest|recommend|analy[sz]|predict|compare|trend|how to)', re.IGNORECASE)
+_TOP_CUSTOMERS = re.compile(r'(頂尖|前\s*\d*\s*[名大]|最大|最好|最重要|排行|(?<![a-z])(?:top|best|biggest|largest))\s*\d*\s*(的)?\s*(客戶|customers?(?![a-z]))', re.IGNORECASE)
+_COUNT = re.compile(r'多少|幾筆|幾張|幾個|數量|(?<![a-z])(?:how many|count|number of)(?![a-z])', re.IGNORECASE)
+_SALES_TOTAL = re.compile(r'銷售額|營收|業績|總金額|(?<![a-z])(?:revenue|total sales|sales total)(?![a-z])', re.IGNORECASE)
+_LIST = re.compile(r'查詢|列出|顯示|所有|全部|有哪些|哪些|(?<![a-z])(?:list|show|all|find)(?![a-z])', re.IGNORECASE)
+
+ROUTER_LIST_LIMIT = 20
+TOP_CUSTOMER_LIMIT = 5
+
+_DOCUMENTS = {
+    'orders': {'label': '訂單', 'alias': 'o', 'date': 'order_date'},
+    'quotes': {'label': '報價單', 'alias': 'q', 'date': 'quote_date'},
+}
+
+
+class RouterStats:
+    """路由命中率與各路徑（本地意圖 / LLM）的延遲統計。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.intents = {}
+        self.paths = {
+            'router': {'count': 0, 'seconds_total': 0.0, 'seconds_max': 0.0},
+            'llm': {'count': 0, 'seconds_total': 0.0, 'seconds_max': 0.0},
+        }
+
+    def record(self, path, seconds, intent=None):
+        with self._lock:
+            stats = self.paths[path]
+            stats['count'] += 1
+            stats['seconds_total'] += seconds
+            stats['seconds_max'] = max(stats['seconds_max'], seconds)
+            if intent:
+                self.intents[intent] = self.intents.get(intent, 0) + 1
+
+    def snapshot(self):
+        with self._lock:
+            paths = {name: dict(stats) for name, stats in self.paths.items()}
+            intents = dict(self.intents)
+        total = paths['router']['count'] + paths['llm']['count']
+        for stats in paths.values():
+            stats['seconds_avg'] = stats['seconds_total'] / stats['count'] if stats['count'] else 0.0
+        return {
+            'messages': total,
+            'hit_rate': paths['router']['count'] / total if total else 0.0,
+            'intents': intents,
+            'paths': paths,
+        }
+
+
+router_stats = RouterStats()
+
+
+def _money(amount):
+    return f"{amount or 0:,.2f}"
+
+
+def _describe_filters(entities):
+    parts = []
+    if entities['statuses']:
+        parts.append("狀態為「" + "、".join(entities['statuses']) + "」")
+    if entities['date_range']:
+        start, end = entities['date_range']
+        parts.append(f"日期在 {start} 至 {end}" if start != end else f"日期為 {start}")
+    return "，".join(parts)
+
+
+def _subject(entities, default):
+    """回覆開頭的主詞，例如「TechCorp（客戶 ID: 1），狀態為「未付款」」。"""
+    parts = []
+    if entities['customers']:
+        parts.append(_customer_label(entities))
+    filters = _describe_filters(entities)
+    if filters:
+        parts.append(filters)
+    return "，".join(parts) if parts else default
+
+
+def _document_line(label, row, date_column):
+    customer = f"{row['customer_name']}（客戶 ID: {row['customer_id']}）" if row['customer_name'] else f"客戶 ID: {row['customer_id']}"
+    return f"- {label} (ID: {row['id']})｜{customer}｜{row[date_column]}｜{_money(row['amount'])}｜{row['status']}"
+
+
+def _document_detail(conn, table, ids):
+    doc = _DOCUMENTS[table]
+    alias, date_column = doc['alias'], doc['date']
+    rows = conn.execute(f'''
+        SELECT {alias}.id, {alias}.customer_id, c.name AS customer_name, {alias}.{date_column}, {alias}.amount, {alias}.status
+        FROM {table} {alias} LEFT JOIN customers c ON c.id = {alias}.customer_id
+        WHERE {alias}.id IN ({', '.join('?' for _ in ids)}) ORDER BY {alias}.id
+    ''', ids).fetchall()
+    found = {row['id'] for row in rows}
+    lines = [_document_line(doc['label'], row, date_column) for row in rows]
+    lines += [f"- 找不到{doc['label']} (ID: {i})" for i in ids if i not in found]
+    return f"{doc['label']}資料如下：\n" + "\n".join(lines)
+
+
+def _document_query(table, entities, customer_ids):
+    doc = _DOCUMENTS[table]
+    alias = doc['alias']
+    where, params = chat_context.document_filters(alias, doc['date'], entities)
+    if customer_ids:
+        where.append(f"{alias}.customer_id IN ({', '.join('?' for _ in customer_ids)})")
+        params.extend(customer_ids)
+    return (" WHERE " + " AND ".join(where)) if where else "", params
+
+
+def _customer_label(entities):
+    return "、".join(f"{c['name']}（客戶 ID: {c['id']}）" for c in entities['customers'])
+
+
+def _list_documents(conn, table, entities):
+    doc = _DOCUMENTS[table]
+    alias, date_column = doc['alias'], doc['date']
+    customer_ids = [c['id'] for c in entities['customers']]
+    clause, params = _document_query(table, entities, customer_ids)
+    count, total = conn.execute(f"SELECT COUNT(*), TOTAL({alias}.amount) FROM {table} {alias}{clause}", params).fetchone()
+    subject = _subject(entities, '')
+    if count == 0:
+        return f"找不到{subject}的{doc['label']}。"
+    rows = conn.execute(f'''
+        SELECT {alias}.id, {alias}.customer_id, c.name AS customer_name, {alias}.{date_column}, {alias}.amount, {alias}.status
+        FROM {table} {alias} LEFT JOIN customers c ON c.id = {alias}.customer_id
+        {clause}
+        ORDER BY {alias}.{date_column} DESC, {alias}.id DESC LIMIT ?
+    ''', params + [ROUTER_LIST_LIMIT]).fetchall()
+    lines = [f"{subject}的{doc['label']}共有 {count} 筆，總金額 {_money(total)}："]
+    lines += [_document_line(doc['label'], row, date_column) for row in rows]
+    if count > len(rows):
+        lines.append(f"（僅列出最近 {len(rows)} 筆）")
+    return "\n".join(lines)
+
+
+def _count_documents(conn, table, entities):
+    doc = _DOCUMENTS[table]
+    alias = doc['alias']
+    customer_ids = [c['id'] for c in entities['customers']]
+    clause, params = _document_query(table, entities, customer_ids)
+    rows = conn.execute(
+        f"SELECT {alias}.status, COUNT(*) AS count, TOTAL({alias}.amount) AS total FROM {table} {alias}{clause} "
+        f"GROUP BY {alias}.status ORDER BY count DESC",
+        params
+    ).fetchall()
+    count = sum(row['count'] for row in rows)
+    total = sum(row['total'] for row in rows)
+    reply = f"{_subject(entities, '目前')}的{doc['label']}共有 {count} 筆，總金額 {_money(total)}。"
+    if len(rows) > 1:
+        reply += "\n" + "\n".join(f"- {row['status']}：{row['count']} 筆，{_money(row['total'])}" for row in rows)
+    return reply
+
+
+def _top_customers(conn, entities):
+    date_range = entities['date_range']
+    if date_range:
+        rows = conn.execute('''
+            SELECT o.customer_id AS id, c.name, COUNT(*) AS order_count, TOTAL(o.amount) AS total
+            FROM orders o JOIN customers c ON c.id = o.customer_id
+            WHERE o.order_date BETWEEN ? AND ? AND o.status != ?
+            GROUP BY o.customer_id ORDER BY total DESC LIMIT ?
+        ''', (*date_range, '取消', TOP_CUSTOMER_LIMIT)).fetchall()
+    else:
+        # 彙總表含取消的訂單，扣掉後才與有日期的查詢採用相同的排除規則
+        rows = conn.execute('''
+            SELECT s.customer_id AS id, c.name,
+                   s.order_count - COALESCE(x.order_count, 0) AS order_count,
+                   s.total_amount - COALESCE(x.total, 0) AS total
+            FROM customer_sales_summary s JOIN customers c ON c.id = s.customer_id
+            LEFT JOIN (
+                SELECT customer_id, COUNT(*) AS order_count, TOTAL(amount) AS total
+                FROM orders WHERE status = ? GROUP BY customer_id
+            ) x ON x.customer_id = s.customer_id
+            WHERE s.order_count - COALESCE(x.order_count, 0) > 0 ORDER BY total DESC LIMIT ?
+        ''', ('取消', TOP_CUSTOMER_LIMIT)).fetchall()
+    period = _describe_filters({'statuses': [], 'date_range': date_range})
+    if not rows:
+        return f"{period or '目前'}沒有任何訂單資料。"
+    lines = [f"訂單金額最高的客戶（{period}）：" if period else "訂單金額最高的客戶："]
+    lines += [
+        f"{rank}. {row['name']}（客戶 ID: {row['id']}）：{row['order_count']} 筆訂單，{_money(row['total'])}"
+        for rank, row in enumerate(rows, 1)
+    ]
+    return "\n".join(lines)
+
 
-    return "\n\n".join(context_parts)
+def _sales_total(conn, entities):
+    customer_ids = [c['id'] for c in entities['customers']]
+    clause, params = _document_query('orders', entities, customer_ids)
+    count, total = conn.execute(f"SELECT COUNT(*), TOTAL(o.amount) FROM orders o{clause}", params).fetchone()
+    return f"{_subject(entities, '全部')}的訂單共 {count} 筆，銷售總額 {_money(total)}。"
 
 
-def get_chatbot_response(user_message: str) -> str:
+def match_intent(conn, user_message):
     """
-    向 DeepSeek API 發送使用者訊息並獲取機器人回應。
-    這個版本會先從資料庫查詢脈絡，再送給 LLM。
+    辨識常見問題並直接以 SQL 回答，回傳 (意圖名稱, 回覆文字)；無法辨識時回傳 None，由 LLM 處理。
     """
-    if not DEEPSEEK_API_KEY:
-        return "錯誤：未設定 DEEPSEEK_API_KEY 環境變數。"
+    if _LLM_ONLY.search(user_message):
+        return None
+    entities = chat_context.extract_entities(conn, user_message)
+    tables = [t for t, wanted in (('orders', entities['wants_orders']), ('quotes', entities['wants_quotes'])) if wanted]
+
+    if entities['order_ids'] or entities['quote_ids']:
+        parts = []
+        if entities['order_ids']:
+            parts.append(_document_detail(conn, 'orders', entities['order_ids']))
+        if entities['quote_ids']:
+            parts.append(_document_detail(conn, 'quotes', entities['quote_ids']))
+        return 'document_detail', "\n\n".join(parts)
+    if _TOP_CUSTOMERS.search(user_message):
+        return 'top_customers', _top_customers(conn, entities)
+    if _COUNT.search(user_message) and len(tables) == 1:
+        return 'count_documents', _count_documents(conn, tables[0], entities)
+    if _SALES_TOTAL.search(user_message):
+        return 'sales_total', _sales_total(conn, entities)
+    if entities['customers'] and len(tables) == 1 and (_LIST.search(user_message) or entities['statuses'] or entities['date_range']):
+        return 'list_documents', _list_documents(conn, tables[0], entities)
+    return None
+
+
+def route_message(user_message: str):
+    """以資料庫連線執行 match_intent；資料庫錯誤時交給 LLM。"""
+    try:
+        conn = database.get_pool().acquire()
+        try:
+            return match_intent(conn, user_message)
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        print(f"資料庫錯誤: {e}")
+        return None
+
 
+def _build_request(user_message: str, stream: bool = False, history=None, summary: str = ''):
+    """
+    組出送給 DeepSeek API 的 headers 與 payload。
+    history 為最近幾輪的 {'role', 'content'} 訊息，summary 為更早對話的摘要（見 chat_history.py）。
+    """
     # 1. 從資料庫取得脈絡
-    db_context = get_database_context_for_llm()
+    db_context = get_database_context_for_llm(user_message)
 
     # 2. 建立傳送給 LLM 的訊息
     # 我們將資料庫脈絡和使用者問題結合在一個 user role message 中
@@ -98,19 +318,45 @@ def get_chatbot_response(user_message: str) -> str:
         "Authorization": f"Bearer {DEEPSEEK_API_KEY}"
     }
 
-    messages = [
-        {"role": "system", "content": SYSTEM_PROMPT},
-        {"role": "user", "content": combined_user_message}
-    ]
+    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+    if summary:
+        messages.append({"role": "system", "content": f"先前對話摘要：\n{summary}"})
+    messages.extend(history or [])
+    messages.append({"role": "user", "content": combined_user_message})
 
     payload = {
         "model": "deepseek-chat",
         "messages": messages,
-        "stream": False
+        "stream": stream
     }
+    return headers, payload
+
+
+def get_chatbot_response(user_message: str, history=None, summary: str = '') -> str:
+    """
+    向 DeepSeek API 發送使用者訊息並獲取機器人回應。
+    常見問題先由本地意圖路由直接回答；其他問題才從資料庫查詢脈絡，再送給 LLM。
+    """
+    start = time.perf_counter()
+    routed = route_message(user_message)
+    if routed:
+        router_stats.record('router', time.perf_counter() - start, routed[0])
+        return routed[1]
+    try:
+        return _llm_response(user_message, history, summary)
+    finally:
+        router_stats.record('llm', time.perf_counter() - start)
+
+
+def _llm_response(user_message, history, summary):
+    if not DEEPSEEK_API_KEY:
+        return "錯誤：未設定 DEEPSEEK_API_KEY 環境變數。"
+
+    import requests  # 只有真的呼叫 LLM 時才載入
+    headers, payload = _build_request(user_message, history=history, summary=summary)
 
     try:
-        response = requests.post(DEEPSEEK_API_URL, headers=headers, data=json.dumps(payload))
+        response = llm_client.get_client().post(DEEPSEEK_API_URL, headers=headers, data=json.dumps(payload))
         response.raise_for_status()
 
         response_data = response.json()
@@ -119,6 +365,8 @@ def get_chatbot_response(user_message: str) -> str:
         else:
             return "機器人回應格式不正確。"
 
+    except llm_client.CircuitOpenError:
+        return CIRCUIT_OPEN_MESSAGE
     except requests.exceptions.RequestException as e:
         return f"與 DeepSeek API 通訊時發生錯誤: {e}"
     except json.JSONDecodeError:
@@ -126,6 +374,56 @@ def get_chatbot_response(user_message: str) -> str:
     except Exception as e:
         return f"發生未知錯誤: {e}"
 
+
+def stream_chatbot_response(user_message: str, history=None, summary: str = ''):
+    """
+    以串流模式（stream: true）呼叫 DeepSeek API，逐段產生回覆文字。
+    上游回傳的是 OpenAI 相容的 SSE：每行 `data: {...}`，最後是 `data: [DONE]`。
+    發生錯誤時產生一段錯誤訊息後結束。本地意圖路由能回答的問題直接產生完整回覆。
+    """
+    start = time.perf_counter()
+    routed = route_message(user_message)
+    if routed:
+        router_stats.record('router', time.perf_counter() - start, routed[0])
+        yield routed[1]
+        return
+    try:
+        yield from _llm_stream(user_message, history, summary)
+    finally:
+        router_stats.record('llm', time.perf_counter() - start)
+
+
+def _llm_stream(user_message, history, summary):
+    if not DEEPSEEK_API_KEY:
+        yield "錯誤：未設定 DEEPSEEK_API_KEY 環境變數。"
+        return
+
+    import requests
+    headers, payload = _build_request(user_message, stream=True, history=history, summary=summary)
+
+    try:
+        with llm_client.get_client().post(DEEPSEEK_API_URL, headers=headers, data=json.dumps(payload), stream=True) as response:
+            response.raise_for_status()
+            # chunk_size=None：有資料就交出來，不等湊滿固定大小
+            for line in response.iter_lines(chunk_size=None):
+                if not line.startswith(b'data:'):
+                    continue
+                data = line[5:].strip()
+                if data == b'[DONE]':
+                    break
+                choices = json.loads(data).get('choices') or [{}]
+                delta = (choices[0].get('delta') or {}).get('content')
+                if delta:
+                    yield delta
+    except llm_client.CircuitOpenError:
+        yield CIRCUIT_OPEN_MESSAGE
+    except requests.exceptions.RequestException as e:
+        yield f"與 DeepSeek API 通訊時發生錯誤: {e}"
+    except json.JSONDecodeError:
+        yield "解析 DeepSeek API 回應時發生錯誤。"
+    except Exception as e:
+        yield f"發生未知錯誤: {e}"
+
 if __name__ == "__main__":
     # 測試新的 get_chatbot_response
     # 確保你的 sales.db 檔案存在且有資料
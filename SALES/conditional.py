@@ -0,0 +1,111 @@
+"""
+列表與分析頁面的條件式 GET（ETag / 304 Not Modified）。
+
+ETag 由以下內容雜湊而成：
+    * 頁面用到的資料表的變更計數器（database.table_versions，由 trigger 在每次寫入時遞增）
+    * 目前使用者的 id 與角色（決定可見的資料範圍與側邊欄）
+    * 查詢參數（搜尋、排序、游標）
+    * 樣板與 CSS 版本（部署新版後舊的 ETag 自動失效）
+
+瀏覽器帶著相同的 If-None-Match 重新整理時，只讀取 table_versions 一張小表就回傳 304，
+不執行列表的 JOIN 查詢，也不渲染樣板。有待顯示的 flash 訊息時一律完整渲染。
+
+命中率可由 /admin/stats 的 conditional_get 與 /metrics 的 304 狀態碼計數觀察。
+"""
+import functools
+import hashlib
+import os
+import threading
+from flask import current_app, request, session
+import database
+
+
+class ConditionalStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.endpoints = {}  # endpoint -> [檢查次數, 304 次數]
+
+    def record(self, endpoint, not_modified):
+        with self._lock:
+            entry = self.endpoints.setdefault(endpoint, [0, 0])
+            entry[0] += 1
+            entry[1] += not_modified
+
+    def snapshot(self):
+        with self._lock:
+            endpoints = {name: list(entry) for name, entry in self.endpoints.items()}
+        checks = sum(entry[0] for entry in endpoints.values())
+        not_modified = sum(entry[1] for entry in endpoints.values())
+        return {
+            'checks': checks,
+            'not_modified': not_modified,
+            'hit_rate': not_modified / checks if checks else 0.0,
+            'endpoints': {
+                name: {'checks': total, 'not_modified': hits, 'hit_rate': hits / total}
+                for name, (total, hits) in sorted(endpoints.items())
+            },
+        }
+
+
+stats = ConditionalStats()
+
+_release_tag = None
+
+
+def release_tag():
+    """樣板檔案的修改時間與 CSS 版本；同一版程式的每個 worker 算出的值都相同。"""
+    global _release_tag
+    if _release_tag is None:
+        folder = os.path.join(current_app.root_path, current_app.template_folder)
+        stamps = sorted((name, os.stat(os.path.join(folder, name)).st_mtime_ns) for name in os.listdir(folder))
+        release = f"{current_app.config.get('CSS_VERSION')}:{stamps}".encode('utf-8')
+        _release_tag = hashlib.blake2b(release, digest_size=8).hexdigest()
+    return _release_tag
+
+
+def make_etag(versions, user, args):
+    digest = hashlib.blake2b(digest_size=12)
+    for part in (release_tag(), versions, user.get('id'), user.get('role'), sorted(args.items(multi=True))):
+        digest.update(repr(part).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def conditional_get(*tables):
+    """
+    以 tables 的變更計數器產生 ETag 的裝飾器；放在已檢查登入的路由上，
+    未登入或有 flash 訊息時直接交給路由處理。
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            user = session.get('user')
+            if user is None or session.get('_flashes'):
+                return view(*args, **kwargs)
+
+            conn = database.get_pool().acquire()
+            try:
+                versions = database.table_versions(conn, tables)
+            finally:
+                conn.close()
+            etag = make_etag(versions, user, request.args)
+            not_modified = request.if_none_match.contains_weak(etag)
+            stats.record(request.endpoint, not_modified)
+
+            if not_modified:
+                response = current_app.response_class(status=304)
+            else:
+                response = current_app.make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag, weak=True)
+            # 每次都要向伺服器確認；內容因使用者而異，不可存在共用快取
+            response.headers['Cache-Control'] = 'private, no-cache'
+            response.vary.add('Cookie')
+            return response
+        return wrapper
+    return decorator
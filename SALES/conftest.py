@@ -0,0 +1,7 @@
+import os
+import tempfile
+
+# 測試一律使用暫存資料庫，避免動到 /tmp/sales.db
+os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="sales-test-"), "sales.db")
+# 測試依賴範例客戶（TechCorp 等）與示範資料
+os.environ["SEED_DEMO_DATA"] = "1"
@@ -2,11 +2,277 @@ import sqlite3
 import datetime
 import random
 import os
+import threading
+import time
 
 # 統一管理 DB 路徑
 DB_PATH = os.environ.get("DB_PATH", "/tmp/sales.db")
 
-def init_db():
+# 連線池與 PRAGMA 設定
+POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "8"))
+POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "10"))
+BUSY_TIMEOUT_MS = int(os.environ.get("DB_BUSY_TIMEOUT_MS", "5000"))
+CACHE_SIZE_KIB = int(os.environ.get("DB_CACHE_SIZE_KIB", "20000"))
+MMAP_SIZE = int(os.environ.get("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+# 寫入交易遇到 busy 錯誤時的重試次數與第一次退避的毫秒數（之後每次加倍）
+BUSY_RETRIES = int(os.environ.get("DB_BUSY_RETRIES", "5"))
+BUSY_BACKOFF_MS = float(os.environ.get("DB_BUSY_BACKOFF_MS", "20"))
+# 建立新資料庫時是否填入示範資料（範例客戶、訂單、報價單）
+SEED_DEMO_DATA = os.environ.get("SEED_DEMO_DATA", "0") == "1"
+
+
+class PoolTimeoutError(sqlite3.OperationalError):
+    """等待可用連線逾時。繼承 OperationalError，讓既有的 sqlite3.Error 處理照常運作。"""
+
+
+# 連線池連線每執行一條陳述式就呼叫 hook(conn, sql, params, seconds)，
+# 例如 metrics.py 的每請求 SQL 統計與 sqltrace.py 的慢查詢記錄
+statement_hooks = []
+
+
+def _observe(conn, execute, sql, params):
+    start = time.perf_counter()
+    try:
+        return execute(sql, params)
+    finally:
+        elapsed = time.perf_counter() - start
+        for hook in statement_hooks:
+            hook(conn, sql, params, elapsed)
+
+
+class PooledConnection(sqlite3.Connection):
+    """由連線池管理的連線：close() 會把連線歸還給連線池，而不是真的關閉。"""
+
+    pool = None
+    checked_out = False
+    # 每次借出都會換一個編號，用來分辨「這次借用」是否已經歸還
+    lease = 0
+
+    def execute(self, sql, parameters=()):
+        if not statement_hooks:
+            return super().execute(sql, parameters)
+        return _observe(self, super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        if not statement_hooks:
+            return super().executemany(sql, seq_of_parameters)
+        return _observe(self, super().executemany, sql, seq_of_parameters)
+
+    def close(self, lease=None):
+        # lease：呼叫者借到的編號；傳入時只有仍是同一次借用才會歸還
+        if self.pool is not None:
+            self.pool.release(self, lease)
+        else:
+            super().close()
+
+    def close_for_real(self):
+        self.pool = None
+        super().close()
+
+
+def connect(path=None, factory=sqlite3.Connection):
+    """開啟一條套用 WAL 與效能 PRAGMA 的連線。"""
+    conn = sqlite3.connect(path or DB_PATH, timeout=BUSY_TIMEOUT_MS / 1000,
+                           check_same_thread=False, factory=factory)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KIB}")
+    conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+    return conn
+
+
+def is_busy_error(error):
+    """SQLITE_BUSY / SQLITE_LOCKED：另一條連線（可能在別的 worker 行程）正持有寫入鎖。"""
+    if not isinstance(error, sqlite3.OperationalError) or isinstance(error, PoolTimeoutError):
+        return False
+    message = str(error).lower()
+    return 'locked' in message or 'busy' in message
+
+
+class WriteStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.transactions = 0
+            self.retries = 0
+            self.gave_up = 0
+
+    def record(self, retries, gave_up=False):
+        with self._lock:
+            self.transactions += 1
+            self.retries += retries
+            self.gave_up += gave_up
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'transactions': self.transactions,
+                'busy_retries': self.retries,
+                'busy_failures': self.gave_up,
+                'max_retries': BUSY_RETRIES,
+            }
+
+
+write_stats = WriteStats()
+
+
+def write_transaction(conn, work, retries=None):
+    """
+    以 BEGIN IMMEDIATE 執行 work(conn) 並 commit，回傳 work 的回傳值。
+
+    一開始就取得寫入鎖，多個 worker 行程同時修改時不會在交易中途因為升級鎖而失敗。
+    遇到 busy 錯誤（busy_timeout 等完仍拿不到鎖，或 SQLite 為了避免死結直接回傳 BUSY）時，
+    回滾後以指數退避加隨機抖動重試整個交易，最多 DB_BUSY_RETRIES 次，之後拋出原本的例外。
+    work 可能被執行多次，裡面只能做資料庫操作；conn 不可處於未完成的交易中。
+    """
+    retries = BUSY_RETRIES if retries is None else retries
+    attempt = 0
+    while True:
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = work(conn)
+                conn.execute("COMMIT")
+            except BaseException:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                raise
+        except sqlite3.OperationalError as e:
+            if not is_busy_error(e) or attempt >= retries:
+                write_stats.record(attempt, gave_up=is_busy_error(e))
+                raise
+            time.sleep(BUSY_BACKOFF_MS / 1000 * (2 ** attempt) * random.uniform(0.5, 1.5))
+            attempt += 1
+            continue
+        write_stats.record(attempt)
+        return result
+
+
+class ConnectionPool:
+    """
+    執行緒安全的 SQLite 連線池。
+
+    閒置連線以 LIFO 方式重複使用（最近用過的連線快取最熱），
+    連線數達上限時借用者會等待，直到有人歸還或逾時。
+    """
+
+    def __init__(self, path, max_size=POOL_SIZE, timeout=POOL_TIMEOUT):
+        self.path = path
+        self.max_size = max_size
+        self.timeout = timeout
+        self._idle = []
+        self._opened = 0
+        self._leases = 0
+        self._cond = threading.Condition()
+        self._stats = {
+            'checkouts': 0,
+            'hits': 0,
+            'misses': 0,
+            'waits': 0,
+            'timeouts': 0,
+            'checkout_seconds_total': 0.0,
+            'checkout_seconds_max': 0.0,
+        }
+
+    def acquire(self):
+        start = time.perf_counter()
+        deadline = start + self.timeout
+        conn = None
+        with self._cond:
+            waited = False
+            while not self._idle and self._opened >= self.max_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise PoolTimeoutError("timed out waiting for a database connection")
+                if not waited:
+                    self._stats['waits'] += 1
+                    waited = True
+                self._cond.wait(remaining)
+            if self._idle:
+                conn = self._idle.pop()
+                self._stats['hits'] += 1
+            else:
+                self._opened += 1
+                self._stats['misses'] += 1
+            self._leases += 1
+            lease = self._leases
+
+        if conn is None:
+            try:
+                conn = connect(self.path, factory=PooledConnection)
+            except Exception:
+                with self._cond:
+                    self._opened -= 1
+                    self._cond.notify()
+                raise
+            conn.pool = self
+
+        conn.checked_out = True
+        conn.lease = lease
+        elapsed = time.perf_counter() - start
+        with self._cond:
+            self._stats['checkouts'] += 1
+            self._stats['checkout_seconds_total'] += elapsed
+            self._stats['checkout_seconds_max'] = max(self._stats['checkout_seconds_max'], elapsed)
+        return conn
+
+    def release(self, conn, lease=None):
+        if not conn.checked_out:
+            return
+        if lease is not None and lease != conn.lease:
+            # 過期的借用：連線已經歸還並借給別人，不能替對方歸還
+            return
+        conn.checked_out = False
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            # 連線已損壞，直接丟棄並讓出名額
+            conn.close_for_real()
+            with self._cond:
+                self._opened -= 1
+                self._cond.notify()
+            return
+        with self._cond:
+            self._idle.append(conn)
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._opened -= len(idle)
+        for conn in idle:
+            conn.close_for_real()
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats['open'] = self._opened
+            stats['idle'] = len(self._idle)
+            stats['max_size'] = self.max_size
+        return stats
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """回傳目前 DB_PATH 對應的共用連線池；DB_PATH 改變時會重建。"""
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.path != DB_PATH:
+            if _pool is not None:
+                _pool.close()
+            _pool = ConnectionPool(DB_PATH)
+        return _pool
+
+def init_db(seed_samples=False):
     conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
 
@@ -44,7 +310,7 @@ def init_db():
 
     # Add sample customers
     cursor.execute("SELECT COUNT(*) FROM customers")
-    if cursor.fetchone()[0] < 2:
+    if seed_samples and cursor.fetchone()[0] < 2:
         sample_customers = [
             ('TechCorp', 'Alice', '123-456-7890', 'alice@techcorp.com', 1),
             ('Innovate Inc.', 'Bob', '098-765-4321', 'bob@innovateinc.com', 1)
@@ -69,7 +335,7 @@ def init_db():
 
     # Add sample orders
     cursor.execute("SELECT COUNT(*) FROM orders")
-    if cursor.fetchone()[0] < 2:
+    if seed_samples and cursor.fetchone()[0] < 2:
         sample_orders = [
             (1, datetime.date(2025, 7, 1).isoformat(), 1500.00, 'Completed', 1),
             (2, datetime.date(2025, 7, 5).isoformat(), 3000.50, 'Pending', 1)
@@ -94,7 +360,7 @@ def init_db():
 
     # Add sample quotes
     cursor.execute("SELECT COUNT(*) FROM quotes")
-    if cursor.fetchone()[0] < 2:
+    if seed_samples and cursor.fetchone()[0] < 2:
         sample_quotes = [
             (1, datetime.date(2025, 6, 20).isoformat(), 1400.00, 'Accepted', 1),
             (2, datetime.date(2025, 7, 2).isoformat(), 2900.75, 'Sent', 1)
@@ -139,30 +405,374 @@ def populate_with_more_data():
         new_customers
     )
 
-    # 其他 quote & order 生成省略，原邏輯不變
-    # …
+    # 大量的訂單與報價單請用 generate_data.py 產生
 
     conn.commit()
     conn.close()
 
-def migrate_db():
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-
+def _migrate_legacy_columns(conn):
     # 檢查 users 欄位
-    cursor.execute("PRAGMA table_info(users)")
-    cols = [col[1] for col in cursor.fetchall()]
+    cols = [col[1] for col in conn.execute("PRAGMA table_info(users)").fetchall()]
     if 'creator_id' not in cols:
-        cursor.execute("ALTER TABLE users ADD COLUMN creator_id INTEGER DEFAULT 1")
+        conn.execute("ALTER TABLE users ADD COLUMN creator_id INTEGER DEFAULT 1")
     if 'role' not in cols:
-        cursor.execute("ALTER TABLE users ADD COLUMN role TEXT DEFAULT 'user'")
+        conn.execute("ALTER TABLE users ADD COLUMN role TEXT DEFAULT 'user'")
 
     # customers / orders / quotes 同理
     for table in ('customers','orders','quotes'):
-        cursor.execute(f"PRAGMA table_info({table})")
-        cols = [col[1] for col in cursor.fetchall()]
+        cols = [col[1] for col in conn.execute(f"PRAGMA table_info({table})").fetchall()]
         if 'creator_id' not in cols:
-            cursor.execute(f"ALTER TABLE {table} ADD COLUMN creator_id INTEGER DEFAULT 1")
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN creator_id INTEGER DEFAULT 1")
 
-    conn.commit()
-    conn.close()
+def _create_hot_column_indexes(conn):
+    # 列表依 creator_id 篩選、JOIN customer_id、依狀態與日期查詢都會用到
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_creator_date ON orders (creator_id, order_date)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_customer ON orders (customer_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_status ON orders (status)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_date ON orders (order_date)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_quotes_status_creator ON quotes (status, creator_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_quotes_customer ON quotes (customer_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_quotes_creator_date ON quotes (creator_id, quote_date)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_customers_creator ON customers (creator_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_customers_name ON customers (name COLLATE NOCASE)")
+
+def fts5_trigram_available(conn):
+    try:
+        conn.execute("CREATE VIRTUAL TABLE temp._fts5_probe USING fts5(x, tokenize = 'trigram')")
+        conn.execute("DROP TABLE temp._fts5_probe")
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+def _create_search_index(conn):
+    # trigram 斷詞讓「宏達電子」這類中文名稱也能用子字串搜尋；rowid 即原資料表的 id
+    if not fts5_trigram_available(conn):
+        # 舊版 SQLite 沒有 FTS5 trigram，搜尋會退回 LIKE
+        return
+    conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS customers_fts USING fts5(name, contact_person, phone, email, tokenize = 'trigram')")
+    conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS orders_fts USING fts5(customer_name, status, tokenize = 'trigram')")
+    conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS quotes_fts USING fts5(customer_name, status, tokenize = 'trigram')")
+
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS customers_fts_insert AFTER INSERT ON customers BEGIN
+            INSERT INTO customers_fts (rowid, name, contact_person, phone, email)
+            VALUES (new.id, new.name, new.contact_person, new.phone, new.email);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS customers_fts_update AFTER UPDATE OF name, contact_person, phone, email ON customers BEGIN
+            DELETE FROM customers_fts WHERE rowid = old.id;
+            INSERT INTO customers_fts (rowid, name, contact_person, phone, email)
+            VALUES (new.id, new.name, new.contact_person, new.phone, new.email);
+            UPDATE orders_fts SET customer_name = new.name
+            WHERE new.name IS NOT old.name AND rowid IN (SELECT id FROM orders WHERE customer_id = new.id);
+            UPDATE quotes_fts SET customer_name = new.name
+            WHERE new.name IS NOT old.name AND rowid IN (SELECT id FROM quotes WHERE customer_id = new.id);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS customers_fts_delete AFTER DELETE ON customers BEGIN
+            DELETE FROM customers_fts WHERE rowid = old.id;
+        END
+    ''')
+
+    for table in ('orders', 'quotes'):
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_fts_insert AFTER INSERT ON {table} BEGIN
+                INSERT INTO {table}_fts (rowid, customer_name, status)
+                VALUES (new.id, (SELECT name FROM customers WHERE id = new.customer_id), new.status);
+            END
+        ''')
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_fts_update AFTER UPDATE OF customer_id, status ON {table} BEGIN
+                DELETE FROM {table}_fts WHERE rowid = old.id;
+                INSERT INTO {table}_fts (rowid, customer_name, status)
+                VALUES (new.id, (SELECT name FROM customers WHERE id = new.customer_id), new.status);
+            END
+        ''')
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_fts_delete AFTER DELETE ON {table} BEGIN
+                DELETE FROM {table}_fts WHERE rowid = old.id;
+            END
+        ''')
+
+    rebuild_search_index(conn)
+
+def rebuild_search_index(conn):
+    """依資料表內容重建 FTS 索引（大量匯入或關閉 trigger 載入資料後使用）。"""
+    conn.execute("DELETE FROM customers_fts")
+    conn.execute('''
+        INSERT INTO customers_fts (rowid, name, contact_person, phone, email)
+        SELECT id, name, contact_person, phone, email FROM customers
+    ''')
+    for table in ('orders', 'quotes'):
+        conn.execute(f"DELETE FROM {table}_fts")
+        conn.execute(f'''
+            INSERT INTO {table}_fts (rowid, customer_name, status)
+            SELECT t.id, c.name, t.status FROM {table} t LEFT JOIN customers c ON c.id = t.customer_id
+        ''')
+
+# 報價單轉換率計算時視為「成功」的狀態
+CONVERTED_QUOTE_STATUSES = ('已接受', '已轉換')
+
+def _create_sales_summaries(conn):
+    # 由 trigger 增量維護的彙總表，/analysis 只需讀取少量資料列
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS order_status_summary (
+            status TEXT PRIMARY KEY,
+            order_count INTEGER NOT NULL DEFAULT 0,
+            total_amount REAL NOT NULL DEFAULT 0
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS quote_status_summary (
+            status TEXT PRIMARY KEY,
+            quote_count INTEGER NOT NULL DEFAULT 0,
+            total_amount REAL NOT NULL DEFAULT 0
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS customer_sales_summary (
+            customer_id INTEGER PRIMARY KEY,
+            order_count INTEGER NOT NULL DEFAULT 0,
+            total_amount REAL NOT NULL DEFAULT 0,
+            quote_count INTEGER NOT NULL DEFAULT 0,
+            converted_quotes INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_customer_sales_total ON customer_sales_summary (total_amount)")
+    # 第 4 版發佈時的 trigger：customer_id 只排除 NULL（第 10 版改為只接受整數）
+    _create_summary_triggers(conn, "{row}.customer_id IS NOT NULL")
+    rebuild_sales_summaries(conn)
+
+def _create_summary_triggers(conn, customer_guard):
+    """建立彙總表的 trigger；customer_guard 決定哪些 customer_id 會寫入 customer_sales_summary。"""
+    converted = ", ".join(f"'{status}'" for status in CONVERTED_QUOTE_STATUSES)
+
+    def order_delta(row, sign):
+        return f'''
+            INSERT OR IGNORE INTO order_status_summary (status) VALUES ({row}.status);
+            UPDATE order_status_summary
+            SET order_count = order_count {sign} 1, total_amount = total_amount {sign} {row}.amount
+            WHERE status = {row}.status;
+            INSERT OR IGNORE INTO customer_sales_summary (customer_id)
+            SELECT {row}.customer_id WHERE {customer_guard.format(row=row)};
+            UPDATE customer_sales_summary
+            SET order_count = order_count {sign} 1, total_amount = total_amount {sign} {row}.amount
+            WHERE customer_id = {row}.customer_id;
+        '''
+
+    def quote_delta(row, sign):
+        return f'''
+            INSERT OR IGNORE INTO quote_status_summary (status) VALUES ({row}.status);
+            UPDATE quote_status_summary
+            SET quote_count = quote_count {sign} 1, total_amount = total_amount {sign} {row}.amount
+            WHERE status = {row}.status;
+            INSERT OR IGNORE INTO customer_sales_summary (customer_id)
+            SELECT {row}.customer_id WHERE {customer_guard.format(row=row)};
+            UPDATE customer_sales_summary
+            SET quote_count = quote_count {sign} 1,
+                converted_quotes = converted_quotes {sign} ({row}.status IN ({converted}))
+            WHERE customer_id = {row}.customer_id;
+        '''
+
+    for table, delta, columns in (('orders', order_delta, 'customer_id, amount, status'),
+                                  ('quotes', quote_delta, 'customer_id, amount, status')):
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {table}_summary_insert AFTER INSERT ON {table} BEGIN {delta('new', '+')} END")
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {table}_summary_delete AFTER DELETE ON {table} BEGIN {delta('old', '-')} END")
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {table}_summary_update AFTER UPDATE OF {columns} ON {table} BEGIN {delta('old', '-')} {delta('new', '+')} END")
+
+def _fix_summary_triggers(conn):
+    # customer_id 不是整數（例如匯入時的文字）時，舊 trigger 寫入 INTEGER PRIMARY KEY 會失敗而擋下整筆寫入；
+    # 改為略過，與 rebuild_sales_summaries 的條件一致。舊 trigger 只會讓寫入失敗，彙總資料本身不需重算。
+    for table in ('orders', 'quotes'):
+        for event in ('insert', 'delete', 'update'):
+            conn.execute(f"DROP TRIGGER IF EXISTS {table}_summary_{event}")
+    _create_summary_triggers(conn, "typeof({row}.customer_id) = 'integer'")
+
+def rebuild_sales_summaries(conn):
+    """從訂單與報價單全量重算彙總表。"""
+    converted = ", ".join("?" for _ in CONVERTED_QUOTE_STATUSES)
+    conn.execute("DELETE FROM order_status_summary")
+    conn.execute('''
+        INSERT INTO order_status_summary (status, order_count, total_amount)
+        SELECT status, COUNT(*), TOTAL(amount) FROM orders GROUP BY status
+    ''')
+    conn.execute("DELETE FROM quote_status_summary")
+    conn.execute('''
+        INSERT INTO quote_status_summary (status, quote_count, total_amount)
+        SELECT status, COUNT(*), TOTAL(amount) FROM quotes GROUP BY status
+    ''')
+    conn.execute("DELETE FROM customer_sales_summary")
+    conn.execute(f'''
+        INSERT INTO customer_sales_summary (customer_id, order_count, total_amount, quote_count, converted_quotes)
+        SELECT customer_id, SUM(order_count), TOTAL(total_amount), SUM(quote_count), SUM(converted_quotes)
+        FROM (
+            SELECT customer_id, COUNT(*) AS order_count, TOTAL(amount) AS total_amount,
+                   0 AS quote_count, 0 AS converted_quotes
+            FROM orders WHERE typeof(customer_id) = 'integer' GROUP BY customer_id
+            UNION ALL
+            SELECT customer_id, 0, 0, COUNT(*), SUM(status IN ({converted}))
+            FROM quotes WHERE typeof(customer_id) = 'integer' GROUP BY customer_id
+        )
+        GROUP BY customer_id
+    ''', CONVERTED_QUOTE_STATUSES)
+
+def _create_scoring_indexes(conn):
+    # 客戶評分依狀態彙總每位客戶的筆數；(status, customer_id) 讓這類查詢只需讀索引
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_status_customer ON orders (status, customer_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_quotes_status_customer ON quotes (status, customer_id)")
+    # 已被 (status, customer_id) 涵蓋
+    conn.execute("DROP INDEX IF EXISTS idx_orders_status")
+
+# 有變更計數器的資料表；快取以這些計數器當作資料版本
+VERSIONED_TABLES = ('users', 'customers', 'orders', 'quotes')
+
+def _create_table_versions(conn):
+    # 每張表一個變更計數器，由 trigger 在每次寫入時遞增；只有被寫入的表會讓相關快取失效
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS table_versions (
+            table_name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    ''')
+    for table in VERSIONED_TABLES:
+        conn.execute("INSERT OR IGNORE INTO table_versions (table_name, version) VALUES (?, 0)", (table,))
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            conn.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS {table}_version_{event.lower()} AFTER {event} ON {table} BEGIN
+                    UPDATE table_versions SET version = version + 1 WHERE table_name = '{table}';
+                END
+            ''')
+
+def table_versions(conn, tables=VERSIONED_TABLES):
+    """回傳各表變更計數器組成的 tuple，可直接當作快取的資料版本。"""
+    rows = dict(conn.execute(
+        f"SELECT table_name, version FROM table_versions WHERE table_name IN ({', '.join('?' for _ in tables)})",
+        tuple(tables)
+    ).fetchall())
+    return tuple(rows.get(table, 0) for table in tables)
+
+def bump_table_versions(conn, tables):
+    """手動遞增變更計數器，給不經過資料表 trigger 的寫入（例如重建彙總表）使用。"""
+    conn.execute(
+        f"UPDATE table_versions SET version = version + 1 WHERE table_name IN ({', '.join('?' for _ in tables)})",
+        tuple(tables)
+    )
+
+def _create_chat_history(conn):
+    # 聊天紀錄存在伺服器端，session 只記對話 id
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS chat_conversations (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            updated_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            summary TEXT NOT NULL DEFAULT '',
+            summarized_through INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS chat_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            conversation_id TEXT NOT NULL REFERENCES chat_conversations (id),
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_messages_conversation ON chat_messages (conversation_id, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_conversations_user ON chat_conversations (user_id, updated_at)")
+
+def _add_order_source_quote(conn):
+    # 由報價單轉換而來的訂單記錄來源報價單；唯一索引保證一張報價單最多產生一筆訂單，
+    # 重送的批次轉換請求因此不會建立重複訂單
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(orders)").fetchall()]
+    if 'source_quote_id' not in columns:
+        conn.execute("ALTER TABLE orders ADD COLUMN source_quote_id INTEGER REFERENCES quotes (id)")
+    conn.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_orders_source_quote ON orders (source_quote_id)
+        WHERE source_quote_id IS NOT NULL
+    ''')
+
+def _create_jobs(conn):
+    # 背景工作的狀態與結果；放在資料庫裡，多個 worker 行程都能回答輪詢
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            owner_id INTEGER,
+            dedup_key TEXT,
+            status TEXT NOT NULL DEFAULT 'queued',
+            output TEXT NOT NULL DEFAULT '',
+            result TEXT,
+            error TEXT,
+            submitted_at REAL NOT NULL,
+            started_at REAL,
+            finished_at REAL
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_dedup ON jobs (dedup_key, submitted_at) WHERE dedup_key IS NOT NULL")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_submitted ON jobs (submitted_at)")
+
+# 依版本排序的 schema migration；版本號記錄在 PRAGMA user_version。
+# 新增 migration 時只能往後加，不要修改已發佈的項目。
+MIGRATIONS = [
+    (1, "users / customers / orders / quotes 補上 creator_id 與 role 欄位", _migrate_legacy_columns),
+    (2, "熱門查詢欄位的次要索引", _create_hot_column_indexes),
+    (3, "客戶、訂單、報價單的 FTS5 trigram 全文索引", _create_search_index),
+    (4, "由 trigger 維護的銷售彙總表", _create_sales_summaries),
+    (5, "客戶評分用的 (status, customer_id) 覆蓋索引", _create_scoring_indexes),
+    (6, "各資料表的變更計數器（快取失效用）", _create_table_versions),
+    (7, "伺服器端的聊天紀錄", _create_chat_history),
+    (8, "訂單記錄來源報價單（批次轉換的冪等性）", _add_order_source_quote),
+    (9, "背景工作（LLM 與客戶評分）的狀態與結果", _create_jobs),
+    (10, "彙總表 trigger 略過非整數的 customer_id", _fix_summary_triggers),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def get_schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate_db():
+    """依序套用尚未執行的 migration，全部在同一個交易內完成，回傳最終版本。"""
+    conn = sqlite3.connect(DB_PATH, isolation_level=None)
+    try:
+        if get_schema_version(conn) >= SCHEMA_VERSION:
+            return get_schema_version(conn)
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # 取得寫入鎖後再讀一次，其他 process 可能已經完成 migration
+            current = get_schema_version(conn)
+            for version, description, apply in MIGRATIONS:
+                if version > current:
+                    apply(conn)
+                    current = version
+            conn.execute(f"PRAGMA user_version = {current}")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return current
+    finally:
+        conn.close()
+
+def bootstrap(seed_demo_data=None):
+    """
+    程式啟動時呼叫。schema 已是最新版時只讀一次 PRAGMA user_version 就回傳 False；
+    否則建立資料表並套用 migration（SEED_DEMO_DATA 開啟時一併填入示範資料），回傳 True。
+    """
+    seed = SEED_DEMO_DATA if seed_demo_data is None else seed_demo_data
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        current = get_schema_version(conn) >= SCHEMA_VERSION
+    finally:
+        conn.close()
+    if current:
+        return False
+    init_db(seed_samples=seed)
+    migrate_db()
+    if seed:
+        populate_with_more_data()
+    return True
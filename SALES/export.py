@@ -0,0 +1,77 @@
+"""
+客戶、訂單、報價單的串流匯出（CSV / NDJSON，可選 gzip）。
+
+查詢結果以 fetchmany() 分批讀出、逐批轉成文字後立刻送出，
+不論匯出多少筆，記憶體用量只與單批大小有關。
+"""
+import csv
+import io
+import json
+import os
+import zlib
+import database
+
+EXPORT_BATCH_SIZE = int(os.environ.get("EXPORT_BATCH_SIZE", "1000"))
+
+FORMATS = ('csv', 'ndjson')
+COLUMNS = {
+    'customers': ('id', 'name', 'contact_person', 'phone', 'email', 'creator_id'),
+    'orders': ('id', 'customer_id', 'customer_name', 'order_date', 'amount', 'status', 'creator_id'),
+    'quotes': ('id', 'customer_id', 'customer_name', 'quote_date', 'amount', 'status', 'creator_id'),
+}
+MIMETYPES = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+
+def _batches(cursor):
+    while True:
+        rows = cursor.fetchmany(EXPORT_BATCH_SIZE)
+        if not rows:
+            return
+        yield rows
+
+
+def iter_csv(cursor, columns):
+    # 加上 BOM，Excel 開啟時才會以 UTF-8 顯示中文
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write('﻿')
+    writer.writerow(columns)
+    for rows in _batches(cursor):
+        writer.writerows([row[column] for column in columns] for row in rows)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def iter_ndjson(cursor, columns):
+    for rows in _batches(cursor):
+        yield "".join(
+            json.dumps({column: row[column] for column in columns}, ensure_ascii=False) + "\n" for row in rows
+        ).encode('utf-8')
+
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31：gzip 格式
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def stream_export(query, params, columns, fmt, compress=False):
+    """
+    產生匯出檔的位元組內容。連線在產生器開始時才從連線池借出，結束（或用戶端中斷）時歸還，
+    因此可以安全地交給串流回應，不受 request 結束時釋放連線的影響。
+    """
+    conn = database.get_pool().acquire()
+    try:
+        cursor = conn.execute(query, params)
+        chunks = iter_csv(cursor, columns) if fmt == 'csv' else iter_ndjson(cursor, columns)
+        if compress:
+            chunks = gzip_chunks(chunks)
+        yield from chunks
+    finally:
+        conn.close()
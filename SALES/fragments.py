@@ -0,0 +1,31 @@
+"""
+列表頁與分析頁的片段快取。
+
+快取渲染好的 HTML 片段（列表的搜尋列、表格與分頁）與查詢結果（分析頁的彙總數字），
+以路由、角色與可見範圍、查詢參數為鍵，以相關資料表的變更計數器為版本：
+任何一張相關資料表被寫入，trigger 就會遞增計數器，舊的項目在下次讀取時自動失效。
+
+    FRAGMENT_CACHE_BYTES       行程內快取的位元組上限（預設 32 MiB，0 表示停用）
+    FRAGMENT_CACHE_PATH        設定時啟用多個 worker 共用的 SQLite 快取檔
+    FRAGMENT_CACHE_DISK_BYTES  快取檔的位元組上限（預設 256 MiB）
+
+統計數字在 /admin/stats 的 fragment_cache。
+"""
+import os
+import cache
+import database
+
+MAX_BYTES = int(os.environ.get("FRAGMENT_CACHE_BYTES", str(32 * 1024 * 1024)))
+DISK_PATH = os.environ.get("FRAGMENT_CACHE_PATH", "")
+DISK_MAX_BYTES = int(os.environ.get("FRAGMENT_CACHE_DISK_BYTES", str(256 * 1024 * 1024)))
+
+fragment_cache = cache.FragmentCache(
+    MAX_BYTES, disk=cache.DiskStore(DISK_PATH, DISK_MAX_BYTES) if DISK_PATH else None
+)
+
+
+def get_or_build(conn, key, tables, build):
+    """回傳 key 的快取值；tables 的任一張表有寫入、或沒有快取時，呼叫 build() 重建。"""
+    if MAX_BYTES <= 0:
+        return build()
+    return fragment_cache.get_or_build(key, database.table_versions(conn, tables), build)
@@ -0,0 +1,244 @@
+"""
+壓力測試用的合成資料產生器。
+
+以固定的亂數種子產生使用者、客戶、訂單與報價單（相同參數、相同種子，產生的資料完全相同）：
+    * 客戶熱門程度呈 Zipf 分佈，少數大客戶佔大部分訂單
+    * 訂單與報價單的狀態依實際比例分佈
+    * 日期隨時間成長，並有週末淡季與年底旺季
+    * 金額為對數常態分佈
+
+載入時暫時移除索引與 trigger、放寬 pragma，資料寫完後再重建索引、彙總表與全文索引。
+
+    python generate_data.py --customers 100000 --orders 10000000 --quotes 2000000
+    python generate_data.py --db /tmp/load.db --orders 1000000 --reset
+"""
+import argparse
+import datetime
+import sys
+import time
+import numpy as np
+import database
+import search
+
+ORDER_STATUSES = (('已付款', 0.62), ('未付款', 0.26), ('取消', 0.12))
+QUOTE_STATUSES = (('已發送', 0.30), ('已接受', 0.25), ('已拒絕', 0.20), ('草稿', 0.15), ('已轉換', 0.10))
+USER_ROLES = (('user', 0.9), ('administrator', 0.1))
+
+COMPANY_PREFIXES = ('宏達', '聯發', '台達', '中華', '遠傳', '台灣', '國泰', '富邦', '玉山', '中信',
+                    '長榮', '統一', '華碩', '廣達', '仁寶', '和碩', '緯創', '光寶', '研華', '大同')
+COMPANY_SUFFIXES = ('電子', '科技', '實業', '國際', '開發', '控股', '貿易', '工業', '股份有限公司', '有限公司')
+SURNAMES = ('陳', '林', '黃', '張', '李', '王', '吳', '劉', '蔡', '楊', '許', '鄭', '謝', '郭', '洪')
+TITLES = ('先生', '小姐', '經理', '總監', '協理')
+GIVEN_NAMES = ('志明', '春嬌', '家豪', '怡君', '冠宇', '雅婷', '俊傑', '淑芬', '建宏', '美玲')
+
+# 客戶熱門程度的 Zipf 指數、業務經手自己客戶訂單的比例
+ZIPF_EXPONENT = 1.1
+OWNER_SHARE = 0.9
+BATCH_SIZE = 500_000
+
+# 載入期間要暫時移除 trigger 與索引的資料表
+LOAD_TABLES = ('users', 'customers', 'orders', 'quotes')
+
+
+def _choice(rng, options, size):
+    labels = [label for label, _ in options]
+    weights = np.array([weight for _, weight in options], dtype=np.float64)
+    return np.array(labels, dtype=object)[rng.choice(len(labels), size=size, p=weights / weights.sum())]
+
+
+def day_weights(start, end):
+    """每一天的權重：隨時間線性成長，週末較少，11–12 月較多。"""
+    days = (end - start).days + 1
+    dates = [start + datetime.timedelta(days=i) for i in range(days)]
+    growth = np.linspace(1.0, 2.0, days)
+    weekday = np.array([0.35 if d.weekday() >= 5 else 1.0 for d in dates])
+    season = np.array([1.3 if d.month in (11, 12) else 0.85 if d.month in (1, 2) else 1.0 for d in dates])
+    weights = growth * weekday * season
+    return [d.isoformat() for d in dates], weights / weights.sum()
+
+
+def popularity(rng, n):
+    """Zipf 權重，並打亂順序，讓大客戶不會集中在 id 最小的幾筆。"""
+    weights = 1.0 / np.arange(1, n + 1, dtype=np.float64) ** ZIPF_EXPONENT
+    rng.shuffle(weights)
+    return weights / weights.sum()
+
+
+def _drop_load_objects(conn):
+    """移除載入資料表上的 trigger 與索引，回傳重建用的 SQL。"""
+    placeholders = ", ".join("?" for _ in LOAD_TABLES)
+    objects = conn.execute(
+        f"SELECT type, name, sql FROM sqlite_master WHERE type IN ('trigger', 'index') AND sql IS NOT NULL "
+        f"AND tbl_name IN ({placeholders})",
+        LOAD_TABLES
+    ).fetchall()
+    for kind, name, _ in objects:
+        conn.execute(f"DROP {kind.upper()} IF EXISTS {name}")
+    # 先建索引再建 trigger
+    return [sql for kind, _, sql in sorted(objects, key=lambda o: o[0] != 'index')]
+
+
+def _next_id(conn, table):
+    return conn.execute(f"SELECT COALESCE(MAX(id), 0) + 1 FROM {table}").fetchone()[0]
+
+
+def _insert_batches(conn, sql, total, make_batch, label, log):
+    start = time.perf_counter()
+    done = 0
+    while done < total:
+        size = min(BATCH_SIZE, total - done)
+        conn.executemany(sql, make_batch(done, size))
+        done += size
+        elapsed = time.perf_counter() - start
+        log(f"  {label}: {done:,}/{total:,}（{done / elapsed:,.0f} 筆/秒）")
+
+
+def generate(conn, users=20, customers=1000, orders=10000, quotes=2000, seed=42,
+             start=datetime.date(2022, 1, 1), end=datetime.date(2025, 12, 31), reset=False, log=print):
+    """產生資料並寫入 conn，回傳各表新增的筆數。"""
+    rng = np.random.default_rng(seed)
+    timings = {}
+
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute("PRAGMA cache_size = -262144")
+    rebuild_sql = _drop_load_objects(conn)
+    conn.commit()
+
+    try:
+        t = time.perf_counter()
+        if reset:
+            for table in ('quotes', 'orders', 'customers'):
+                conn.execute(f"DELETE FROM {table}")
+
+        # --- 使用者 ---
+        first_user = _next_id(conn, 'users')
+        roles = _choice(rng, USER_ROLES, users)
+        conn.executemany(
+            "INSERT INTO users (id, employee_id, password, name, role, creator_id) VALUES (?, ?, ?, ?, ?, 1)",
+            [
+                (first_user + i, f"G{first_user + i:06d}", 'demo',
+                 SURNAMES[rng.integers(len(SURNAMES))] + GIVEN_NAMES[rng.integers(len(GIVEN_NAMES))], roles[i])
+                for i in range(users)
+            ]
+        )
+        user_ids = np.array([row[0] for row in conn.execute("SELECT id FROM users")], dtype=np.int64)
+
+        # --- 客戶：每位客戶隨機指派一位負責業務 ---
+        first_customer = _next_id(conn, 'customers')
+        customer_owner = user_ids[rng.integers(len(user_ids), size=customers)]
+        prefixes = rng.integers(len(COMPANY_PREFIXES), size=customers)
+        suffixes = rng.integers(len(COMPANY_SUFFIXES), size=customers)
+        conn.executemany(
+            "INSERT INTO customers (id, name, contact_person, phone, email, creator_id) VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (first_customer + i,
+                 f"{COMPANY_PREFIXES[prefixes[i]]}{COMPANY_SUFFIXES[suffixes[i]]} {first_customer + i}",
+                 SURNAMES[(prefixes[i] + i) % len(SURNAMES)] + TITLES[i % len(TITLES)],
+                 f"09{10 + i % 89:02d}-{(i * 7919) % 1000000:06d}",
+                 f"contact{first_customer + i}@example.com",
+                 int(customer_owner[i]))
+                for i in range(customers)
+            ]
+        )
+        timings['users_customers'] = time.perf_counter() - t
+
+        day_strings, day_p = day_weights(start, end)
+        customer_p = popularity(rng, customers) if customers else None
+
+        def documents(first_id, statuses, amount_mu):
+            def make_batch(offset, size):
+                picked = rng.choice(customers, size=size, p=customer_p)
+                owners = customer_owner[picked]
+                others = user_ids[rng.integers(len(user_ids), size=size)]
+                creators = np.where(rng.random(size) < OWNER_SHARE, owners, others)
+                days = rng.choice(len(day_strings), size=size, p=day_p)
+                amounts = np.round(rng.lognormal(amount_mu, 0.9, size=size), 2)
+                status = _choice(rng, statuses, size)
+                return zip(
+                    range(first_id + offset, first_id + offset + size),
+                    (picked + first_customer).tolist(),
+                    [day_strings[d] for d in days.tolist()],
+                    amounts.tolist(),
+                    status.tolist(),
+                    creators.tolist(),
+                )
+            return make_batch
+
+        if customers:
+            t = time.perf_counter()
+            _insert_batches(
+                conn, "INSERT INTO orders (id, customer_id, order_date, amount, status, creator_id) VALUES (?, ?, ?, ?, ?, ?)",
+                orders, documents(_next_id(conn, 'orders'), ORDER_STATUSES, 8.5), "訂單", log
+            )
+            timings['orders'] = time.perf_counter() - t
+            t = time.perf_counter()
+            _insert_batches(
+                conn, "INSERT INTO quotes (id, customer_id, quote_date, amount, status, creator_id) VALUES (?, ?, ?, ?, ?, ?)",
+                quotes, documents(_next_id(conn, 'quotes'), QUOTE_STATUSES, 8.7), "報價單", log
+            )
+            timings['quotes'] = time.perf_counter() - t
+        conn.commit()
+    except BaseException:
+        # 先丟棄寫到一半的資料，下面 commit 索引與 trigger 時才不會一併提交
+        conn.rollback()
+        raise
+    finally:
+        # 不論成功與否都要把索引與 trigger 建回來
+        t = time.perf_counter()
+        log("重建索引與 trigger...")
+        for sql in rebuild_sql:
+            conn.execute(sql)
+        conn.commit()
+        timings['indexes'] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    log("重建彙總表...")
+    with conn:
+        database.rebuild_sales_summaries(conn)
+        conn.execute("UPDATE table_versions SET version = version + 1")
+    timings['summaries'] = time.perf_counter() - t
+    if search.has_search_index(conn):
+        t = time.perf_counter()
+        log("重建全文索引...")
+        with conn:
+            database.rebuild_search_index(conn)
+        timings['search_index'] = time.perf_counter() - t
+    conn.execute("PRAGMA optimize")
+    conn.execute("PRAGMA synchronous = NORMAL")
+
+    return {'users': users, 'customers': customers, 'orders': orders if customers else 0,
+            'quotes': quotes if customers else 0, 'seconds': {k: round(v, 2) for k, v in timings.items()}}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="產生壓力測試用的合成資料")
+    parser.add_argument('--db', help="資料庫路徑（預設為 DB_PATH）")
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--customers', type=int, default=1000)
+    parser.add_argument('--orders', type=int, default=10000)
+    parser.add_argument('--quotes', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--start', type=datetime.date.fromisoformat, default=datetime.date(2022, 1, 1))
+    parser.add_argument('--end', type=datetime.date.fromisoformat, default=datetime.date(2025, 12, 31))
+    parser.add_argument('--reset', action='store_true', help="先刪除既有的客戶、訂單與報價單")
+    args = parser.parse_args(argv)
+
+    if args.db:
+        database.DB_PATH = args.db
+    database.bootstrap()
+    conn = database.connect()
+    started = time.perf_counter()
+    try:
+        result = generate(conn, args.users, args.customers, args.orders, args.quotes, args.seed,
+                          args.start, args.end, args.reset)
+    finally:
+        conn.close()
+    print(f"完成：{result['users']:,} 位使用者、{result['customers']:,} 位客戶、"
+          f"{result['orders']:,} 筆訂單、{result['quotes']:,} 筆報價單，共 {time.perf_counter() - started:.1f} 秒")
+    print("各階段秒數:", result['seconds'])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
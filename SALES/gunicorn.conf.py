@@ -0,0 +1,37 @@
+"""
+gunicorn 的多 worker 設定，搭配 wsgi.py 使用：
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+    PORT                  監聽的埠號（預設 8000）
+    WEB_CONCURRENCY       worker 行程數（預設 CPU 數 × 2，最多 8）
+    GUNICORN_THREADS      每個 worker 的執行緒數（預設 4）
+    GUNICORN_TIMEOUT      worker 多久沒有回應就重啟（秒，預設 120）
+    SECRET_KEY            session 簽章金鑰；未設定時啟動時產生一把，所有 worker 共用，重新啟動後使用者需重新登入
+
+所有 worker 共用同一個 SQLite 檔（DB_PATH，WAL 模式）。寫入使用 BEGIN IMMEDIATE，
+資料庫忙碌時自動退避重試（DB_BUSY_RETRIES、DB_BUSY_BACKOFF_MS，見 database.write_transaction）。
+建議另外設定 FRAGMENT_CACHE_PATH，讓 worker 之間共用片段快取。
+"""
+import multiprocessing
+import os
+import secrets
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+workers = int(os.environ.get("WEB_CONCURRENCY", str(min(multiprocessing.cpu_count() * 2, 8))))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "4"))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = 30
+# 不預先載入 app：每個 worker 自己開 SQLite 連線與背景執行緒，不在 fork 前建立
+preload_app = False
+accesslog = "-"
+
+# fork 出來的 worker 會繼承這個環境變數，所有 worker 才能驗證彼此簽發的 session
+os.environ.setdefault("SECRET_KEY", secrets.token_hex(32))
+
+
+def on_starting(server):
+    # 在 fork 之前由 master 建立或升級 schema 一次，worker 啟動時只需讀一次 schema 版本
+    import database
+    database.bootstrap()
@@ -0,0 +1,401 @@
+"""
+背景工作：耗時的 LLM 呼叫與客戶評分不佔用請求執行緒。
+
+    * llm：執行緒池（I/O 密集，多半在等上游回應）；工作函式的第一個參數 emit(text) 可逐段回報輸出
+    * scoring：行程池（CPU 密集，不受 GIL 限制）；JOB_SCORING_PROCESSES=0 時改在單一執行緒執行
+
+每個池都有上限：執行中與排隊中的工作合計達到 workers + queue 時，新工作直接被拒絕（JobRejected），
+請求立即拿到 503，不會在後面越排越長，也不會拖慢一般的 CRUD 頁面。
+
+工作的狀態、已產生的輸出與結果存在 jobs 資料表，所以任何一個 worker 行程都能回答
+GET /jobs/<id> 的輪詢；工作本身在接受它的行程裡執行。同一行程內的串流直接等記憶體中的通知，
+其他行程則定期讀取資料表。帶 dedup_key 的工作（例如同一份資料的評分）會重用既有的結果。
+
+佇列深度、等待時間與拒絕次數在 /admin/stats 的 jobs 與 /metrics。
+"""
+import atexit
+import functools
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+import database
+
+LLM_THREADS = int(os.environ.get("JOB_LLM_THREADS", "8"))
+LLM_QUEUE = int(os.environ.get("JOB_LLM_QUEUE", "32"))
+SCORING_PROCESSES = int(os.environ.get("JOB_SCORING_PROCESSES", "2"))
+SCORING_QUEUE = int(os.environ.get("JOB_SCORING_QUEUE", "8"))
+# 完成的工作保留多久；超過 JOB_TIMEOUT_SECONDS 仍未完成的工作視為遺失（例如執行它的行程已結束）
+RETENTION_SECONDS = float(os.environ.get("JOB_RETENTION_SECONDS", "600"))
+TIMEOUT_SECONDS = float(os.environ.get("JOB_TIMEOUT_SECONDS", "300"))
+# 串流輸出寫回資料表的最短間隔、其他行程的工作在串流時讀取資料表的間隔
+FLUSH_SECONDS = 0.2
+POLL_SECONDS = 0.2
+PURGE_EVERY_SECONDS = 60
+
+QUEUED, RUNNING, DONE, ERROR = 'queued', 'running', 'done', 'error'
+FINISHED = (DONE, ERROR)
+LOST_MESSAGE = '工作逾時，或執行它的行程已結束'
+
+
+class JobRejected(RuntimeError):
+    """工作池已滿，新工作被拒絕。"""
+
+    def __init__(self, pool, retry_after=2):
+        super().__init__(f"{pool} 工作佇列已滿")
+        self.pool = pool
+        self.retry_after = retry_after
+
+
+class Pool:
+    """一個執行緒池或行程池，加上准入控制與統計。執行器在第一次提交工作時才建立。"""
+
+    def __init__(self, name, workers, queue, processes=False, streams=False):
+        self.name = name
+        self.workers = max(1, workers)
+        self.queue = max(0, queue)
+        self.processes = processes
+        # 工作函式是否以 fn(emit, *args) 呼叫，可逐段回報輸出
+        self.streams = streams
+        self._executor = None
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self.run_seconds_total = 0.0
+
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                import concurrent.futures
+                if self.processes:
+                    import multiprocessing
+                    # 不用 fork：父行程有其他執行緒與開著的 SQLite 連線
+                    self._executor = concurrent.futures.ProcessPoolExecutor(
+                        self.workers, mp_context=multiprocessing.get_context('spawn'))
+                else:
+                    self._executor = concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix=f"job-{self.name}")
+            return self._executor
+
+    def discard_executor(self, wait=False):
+        # 行程池的子行程異常結束後整個池都不能再用，下次提交時重建
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+    def _check_capacity(self):
+        # 呼叫時已持有 lock
+        if self.in_flight >= self.workers + self.queue:
+            self.rejected += 1
+            raise JobRejected(self.name)
+
+    def check_capacity(self):
+        """池已滿時拋出 JobRejected（並計入 rejected），但不佔用名額。"""
+        with self._lock:
+            self._check_capacity()
+
+    def admit(self):
+        with self._lock:
+            self._check_capacity()
+            self.in_flight += 1
+            self.submitted += 1
+
+    def cancel(self):
+        with self._lock:
+            self.in_flight -= 1
+            self.submitted -= 1
+
+    def finished(self, ok, wait_seconds, run_seconds):
+        with self._lock:
+            self.in_flight -= 1
+            if ok:
+                self.completed += 1
+            else:
+                self.failed += 1
+            self.wait_seconds_total += wait_seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, wait_seconds)
+            self.run_seconds_total += run_seconds
+
+    def stats(self):
+        with self._lock:
+            done = self.completed + self.failed
+            return {
+                'mode': 'processes' if self.processes else 'threads',
+                'workers': self.workers,
+                'queue_limit': self.queue,
+                'in_flight': self.in_flight,
+                'queue_depth': max(0, self.in_flight - self.workers),
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'failed': self.failed,
+                'rejected': self.rejected,
+                'wait_seconds_avg': self.wait_seconds_total / done if done else 0.0,
+                'wait_seconds_max': self.wait_seconds_max,
+                'run_seconds_avg': self.run_seconds_total / done if done else 0.0,
+            }
+
+
+class _LocalJob:
+    """本行程執行中的工作：輸出片段與完成通知，供同一行程內的等待與串流使用。"""
+
+    def __init__(self):
+        self.chunks = []
+        self.flushed_at = time.monotonic()
+        self.finished = False
+        self.cond = threading.Condition()
+
+    def append(self, text):
+        with self.cond:
+            self.chunks.append(text)
+            self.cond.notify_all()
+
+    def finish(self):
+        with self.cond:
+            self.finished = True
+            self.cond.notify_all()
+
+
+def _update(job_id, **columns):
+    sql = f"UPDATE jobs SET {', '.join(f'{name} = ?' for name in columns)} WHERE id = ?"
+    conn = database.get_pool().acquire()
+    try:
+        database.write_transaction(conn, lambda conn: conn.execute(sql, (*columns.values(), job_id)))
+    finally:
+        conn.close()
+
+
+def _run_in_process(job_id, path, fn, args):
+    """在行程池的子行程中執行：標記為執行中、執行 fn，回傳 (開始時間, 結果)。"""
+    started = time.time()
+    conn = database.connect(path)
+    try:
+        database.write_transaction(conn, lambda conn: conn.execute(
+            "UPDATE jobs SET status = ?, started_at = ? WHERE id = ?", (RUNNING, started, job_id)))
+    finally:
+        conn.close()
+    return started, fn(*args)
+
+
+class JobRunner:
+    def __init__(self, llm_threads=LLM_THREADS, llm_queue=LLM_QUEUE,
+                 scoring_processes=SCORING_PROCESSES, scoring_queue=SCORING_QUEUE):
+        self.pools = {
+            'llm': Pool('llm', llm_threads, llm_queue, streams=True),
+            'scoring': Pool('scoring', scoring_processes or 1, scoring_queue, processes=scoring_processes > 0),
+        }
+        self._local = {}  # job id -> _LocalJob（本行程執行中的工作）
+        self._lock = threading.Lock()
+        self._purged_at = 0.0
+
+    def check_capacity(self, pool):
+        self.pools[pool].check_capacity()
+
+    def submit(self, pool_name, fn, *args, owner_id=None, dedup_key=None):
+        """
+        提交工作並回傳 job id。llm 池的 fn 以 fn(emit, *args) 呼叫；scoring 池以 fn(*args) 呼叫，
+        在行程池執行時 fn 必須是模組層級的函式。結果必須可以轉成 JSON。池已滿時拋出 JobRejected。
+        """
+        now = time.time()
+        pool = self.pools[pool_name]
+        job_id = uuid.uuid4().hex
+        admitted = []
+
+        def claim(conn):
+            # 查詢既有工作與新增在同一個 BEGIN IMMEDIATE 交易內：同時送出相同 dedup_key 的請求
+            # （可能在不同 worker 行程）只有一個會建立工作，其他的會看到它。
+            # busy 重試時 claim 會再執行一次，名額只佔一次
+            if dedup_key is not None:
+                existing = conn.execute(
+                    "SELECT id, status, submitted_at FROM jobs WHERE dedup_key = ? ORDER BY submitted_at DESC LIMIT 1",
+                    (dedup_key,)
+                ).fetchone()
+                if existing is not None and existing['status'] != ERROR and not self._lost(existing, now):
+                    return existing['id']
+            if not admitted:
+                pool.admit()
+                admitted.append(True)
+            conn.execute(
+                "INSERT INTO jobs (id, kind, owner_id, dedup_key, status, submitted_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, pool_name, owner_id, dedup_key, QUEUED, now))
+            return job_id
+
+        conn = database.get_pool().acquire()
+        try:
+            self._purge(conn, now)
+            claimed = database.write_transaction(conn, claim)
+        except Exception:
+            if admitted:
+                pool.cancel()
+            raise
+        finally:
+            conn.close()
+        if claimed != job_id:
+            if admitted:
+                pool.cancel()
+            return claimed
+
+        local = _LocalJob()
+        with self._lock:
+            self._local[job_id] = local
+        try:
+            if pool.processes:
+                future = pool.executor().submit(_run_in_process, job_id, database.DB_PATH, fn, args)
+            else:
+                future = pool.executor().submit(self._run_in_thread, pool, job_id, local, fn, args)
+        except Exception as e:
+            self._finish(pool, job_id, local, now, None, None, e)
+            return job_id
+        future.add_done_callback(functools.partial(self._done, pool, job_id, local, now))
+        return job_id
+
+    def _run_in_thread(self, pool, job_id, local, fn, args):
+        started = time.time()
+        _update(job_id, status=RUNNING, started_at=started)
+
+        def emit(text):
+            local.append(text)
+            if time.monotonic() - local.flushed_at >= FLUSH_SECONDS:
+                local.flushed_at = time.monotonic()
+                try:
+                    _update(job_id, output=''.join(local.chunks))
+                except sqlite3.Error:
+                    # 中途的輸出只供其他行程輪詢；完成時 _finish 會寫入完整輸出，不中斷工作
+                    pass
+
+        return started, fn(emit, *args) if pool.streams else fn(*args)
+
+    def _done(self, pool, job_id, local, submitted, future):
+        try:
+            started, result = future.result()
+        except Exception as e:
+            if type(e).__name__ == 'BrokenProcessPool':
+                pool.discard_executor()
+            self._finish(pool, job_id, local, submitted, None, None, e)
+        else:
+            self._finish(pool, job_id, local, submitted, started, result, None)
+
+    def _finish(self, pool, job_id, local, submitted, started, result, error):
+        finished = time.time()
+        started = started or finished
+        try:
+            _update(job_id, status=ERROR if error else DONE, output=''.join(local.chunks),
+                    result=None if error else json.dumps(result, ensure_ascii=False),
+                    error=f"{type(error).__name__}: {error}" if error else None,
+                    started_at=started, finished_at=finished)
+        finally:
+            pool.finished(error is None, started - submitted, finished - started)
+            with self._lock:
+                self._local.pop(job_id, None)
+            local.finish()
+
+    def _lost(self, row, now):
+        return row['status'] not in FINISHED and row['submitted_at'] < now - TIMEOUT_SECONDS
+
+    def _purge(self, conn, now):
+        if now - self._purged_at < PURGE_EVERY_SECONDS:
+            return
+        self._purged_at = now
+        try:
+            database.write_transaction(conn, lambda conn: conn.execute(
+                "DELETE FROM jobs WHERE submitted_at < ? AND (status IN (?, ?) OR submitted_at < ?)",
+                (now - RETENTION_SECONDS, DONE, ERROR, now - RETENTION_SECONDS - TIMEOUT_SECONDS)
+            ))
+        except sqlite3.Error:
+            # 清理可以等下一次；不要因此拒絕新的工作
+            self._purged_at = 0.0
+
+    def wait(self, job_id, timeout=None):
+        """等待本行程執行中的工作完成；回傳是否已完成（其他行程的工作直接回傳 False）。"""
+        with self._lock:
+            local = self._local.get(job_id)
+        if local is None:
+            return False
+        with local.cond:
+            return local.cond.wait_for(lambda: local.finished, timeout)
+
+    def get(self, job_id, owner_id=None, since=0):
+        """
+        工作的狀態與 since 之後的新輸出；不存在或不屬於 owner_id 時回傳 None
+        （owner_id 為 NULL 的工作，例如共用的評分結果，任何人都能讀取）。
+        """
+        conn = database.get_pool().acquire()
+        try:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        finally:
+            conn.close()
+        if row is None or (row['owner_id'] is not None and row['owner_id'] != owner_id):
+            return None
+        status, error, output = row['status'], row['error'], row['output']
+        with self._lock:
+            local = self._local.get(job_id)
+        if local is not None and status not in FINISHED:
+            # 資料表裡的輸出最多落後 FLUSH_SECONDS
+            with local.cond:
+                output = ''.join(local.chunks)
+        elif self._lost(row, time.time()):
+            status, error = ERROR, LOST_MESSAGE
+        now = time.time()
+        started, finished = row['started_at'], row['finished_at']
+        return {
+            'id': row['id'],
+            'kind': row['kind'],
+            'status': status,
+            'output': output[since:],
+            'offset': len(output),
+            'result': json.loads(row['result']) if status == DONE and row['result'] is not None else None,
+            'error': error,
+            'wait_seconds': (started or now) - row['submitted_at'],
+            'run_seconds': (finished or now) - started if started else 0.0,
+        }
+
+    def follow(self, job_id, owner_id=None):
+        """依序產生 ('delta', 文字)，最後是 ('done', get() 的結果) 或 ('error', 訊息)。"""
+        offset = 0
+        with self._lock:
+            local = self._local.get(job_id)
+        if local is not None:
+            # 本行程的工作：逐段轉送 emit() 的輸出，不必等資料表
+            sent = 0
+            while True:
+                with local.cond:
+                    local.cond.wait_for(lambda: local.finished or len(local.chunks) > sent)
+                    chunks, finished = local.chunks[sent:], local.finished
+                for chunk in chunks:
+                    yield 'delta', chunk
+                    offset += len(chunk)
+                sent += len(chunks)
+                if finished:
+                    break
+        while True:
+            job = self.get(job_id, owner_id, since=offset)
+            if job is None:
+                yield 'error', '找不到這個工作'
+                return
+            if job['output']:
+                yield 'delta', job['output']
+                offset = job['offset']
+            if job['status'] == DONE:
+                yield 'done', job
+                return
+            if job['status'] == ERROR:
+                yield 'error', job['error']
+                return
+            time.sleep(POLL_SECONDS)
+
+    def shutdown(self):
+        for pool in self.pools.values():
+            pool.discard_executor(wait=True)
+
+    def stats(self):
+        return {name: pool.stats() for name, pool in self.pools.items()}
+
+
+runner = JobRunner()
+atexit.register(runner.shutdown)
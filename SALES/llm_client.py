@@ -0,0 +1,197 @@
+"""
+LLM 後端（DeepSeek / OpenAI 相容 API）的共用 HTTP 用戶端。
+
+    * requests.Session 連線池：保持 keep-alive，不必每則訊息都重新做 TCP / TLS 交握
+    * 連線與讀取逾時，避免上游卡住時一直佔用 Flask worker
+    * 遇到 429 / 5xx / 連線錯誤時，以加上隨機抖動的指數退避重試，次數有上限
+    * 斷路器：連續失敗達門檻後直接快速失敗，冷卻時間過後再放行一次試探請求
+    * 每次呼叫的延遲與錯誤統計（stats()，顯示在 /admin/stats）
+"""
+import collections
+import os
+import random
+import threading
+import time
+
+CONNECT_TIMEOUT = float(os.environ.get("LLM_CONNECT_TIMEOUT", "3.05"))
+READ_TIMEOUT = float(os.environ.get("LLM_READ_TIMEOUT", "60"))
+MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", "2"))
+BACKOFF_BASE = float(os.environ.get("LLM_BACKOFF_BASE", "0.5"))
+BACKOFF_MAX = float(os.environ.get("LLM_BACKOFF_MAX", "8"))
+BREAKER_THRESHOLD = int(os.environ.get("LLM_BREAKER_THRESHOLD", "5"))
+BREAKER_RESET = float(os.environ.get("LLM_BREAKER_RESET", "30"))
+POOL_SIZE = int(os.environ.get("LLM_POOL_SIZE", "10"))
+
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+# 延遲百分位數以最近這麼多次呼叫計算
+LATENCY_WINDOW = 1000
+
+
+class CircuitOpenError(RuntimeError):
+    """斷路器開啟中，請求未送出。不繼承 requests 的例外，匯入本模組時不必載入 requests。"""
+
+
+class LLMClient:
+    def __init__(self, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, max_retries=MAX_RETRIES,
+                 backoff_base=BACKOFF_BASE, backoff_max=BACKOFF_MAX, breaker_threshold=BREAKER_THRESHOLD,
+                 breaker_reset=BREAKER_RESET, pool_size=POOL_SIZE):
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset = breaker_reset
+
+        # requests 載入要數十毫秒，等到真的要呼叫 LLM 時才匯入
+        import requests
+        from requests.adapters import HTTPAdapter
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._lock = threading.Lock()
+        self._consecutive_failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self._stats = {
+            'calls': 0,
+            'successes': 0,
+            'failures': 0,
+            'retries': 0,
+            'short_circuited': 0,
+            'latency_seconds_total': 0.0,
+            'latency_seconds_max': 0.0,
+        }
+        self._errors = collections.Counter()
+
+    # --- 斷路器 ---
+
+    def _before_call(self):
+        """斷路器開啟時拋出 CircuitOpenError；放行的是半開狀態的試探請求時回傳 True。"""
+        with self._lock:
+            if self._opened_at is None:
+                return False
+            if time.monotonic() - self._opened_at >= self.breaker_reset and not self._probing:
+                # 半開：只放行一個試探請求
+                self._probing = True
+                return True
+            self._stats['short_circuited'] += 1
+            self._errors['circuit_open'] += 1
+        raise CircuitOpenError("LLM backend circuit breaker is open")
+
+    def _after_call(self, latency, error=None, backend_healthy=None):
+        """記錄一次呼叫；backend_healthy 決定斷路器的計數（預設為沒有錯誤）。"""
+        if backend_healthy is None:
+            backend_healthy = error is None
+        with self._lock:
+            self._stats['calls'] += 1
+            self._stats['latency_seconds_total'] += latency
+            self._stats['latency_seconds_max'] = max(self._stats['latency_seconds_max'], latency)
+            self._latencies.append(latency)
+            self._probing = False
+            if error is None:
+                self._stats['successes'] += 1
+            else:
+                self._stats['failures'] += 1
+                self._errors[error] += 1
+            if backend_healthy:
+                self._consecutive_failures = 0
+                self._opened_at = None
+                return
+            self._consecutive_failures += 1
+            if self._opened_at is not None or self._consecutive_failures >= self.breaker_threshold:
+                self._opened_at = time.monotonic()
+
+    @property
+    def circuit_open(self):
+        with self._lock:
+            return self._opened_at is not None
+
+    # --- 重試 ---
+
+    def _backoff(self, attempt, response=None):
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after:
+            try:
+                delay = max(delay, min(float(retry_after), self.backoff_max))
+            except ValueError:
+                pass
+        return delay
+
+    def post(self, url, headers=None, data=None, stream=False):
+        """
+        送出 POST 並回傳 requests.Response（不會自動 raise_for_status）。
+        可重試的狀態碼在重試用完後照樣回傳最後一次的回應；連線錯誤與逾時則在重試用完後拋出。
+        """
+        probing = self._before_call()
+        try:
+            return self._post(url, headers, data, stream)
+        finally:
+            if probing:
+                # 試探請求以 requests 以外的例外結束時不會經過 _after_call；不在這裡重設，斷路器就再也不會試探
+                with self._lock:
+                    self._probing = False
+
+    def _post(self, url, headers, data, stream):
+        import requests
+        start = time.perf_counter()
+        attempt = 0
+        while True:
+            response = None
+            try:
+                response = self.session.post(url, headers=headers, data=data, stream=stream, timeout=self.timeout)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                error = 'timeout' if isinstance(e, requests.exceptions.Timeout) else 'connection'
+                if attempt >= self.max_retries:
+                    self._after_call(time.perf_counter() - start, error)
+                    raise
+            except requests.exceptions.RequestException:
+                # 網址錯誤之類的問題，重試也沒用
+                self._after_call(time.perf_counter() - start, 'request', backend_healthy=True)
+                raise
+            else:
+                if response.status_code not in RETRY_STATUSES:
+                    # 其他 4xx 是請求本身的問題（例如金鑰錯誤），不代表後端故障，不計入斷路器
+                    error = f'http_{response.status_code}' if response.status_code >= 400 else None
+                    self._after_call(time.perf_counter() - start, error, backend_healthy=True)
+                    return response
+                if attempt >= self.max_retries:
+                    self._after_call(time.perf_counter() - start, f'http_{response.status_code}')
+                    return response
+                response.close()
+
+            delay = self._backoff(attempt, response)
+            with self._lock:
+                self._stats['retries'] += 1
+            attempt += 1
+            time.sleep(delay)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            latencies = sorted(self._latencies)
+            stats['errors'] = dict(self._errors)
+            stats['circuit_open'] = self._opened_at is not None
+            stats['consecutive_failures'] = self._consecutive_failures
+        for name, q in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99)):
+            stats[f'latency_seconds_{name}'] = latencies[min(len(latencies) - 1, int(len(latencies) * q))] if latencies else 0.0
+        return stats
+
+    def close(self):
+        self.session.close()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """全域共用的 LLMClient（所有請求共用同一個連線池與斷路器）。"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = LLMClient()
+        return _client
@@ -0,0 +1,162 @@
+"""
+離線測試用的 OpenAI 相容（DeepSeek）聊天端點。
+
+    python llm_stub.py --port 8099
+    DEEPSEEK_API_URL=http://127.0.0.1:8099/chat/completions python app.py
+
+在測試中則直接使用 StubLLMServer：
+
+    with StubLLMServer(reply="你好") as stub:
+        chatbot.DEEPSEEK_API_URL = stub.url
+        ...
+        stub.requests  # 收到的請求內容（已解析的 JSON）
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # 與真正的上游相同，串流回覆使用 HTTP/1.1 chunked 傳輸
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        with self.server.stub.lock:
+            self.server.stub.connections += 1
+
+    def do_POST(self):
+        stub = self.server.stub
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            payload = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            self._send_json(400, {'error': {'message': 'invalid JSON'}})
+            return
+        with stub.lock:
+            stub.requests.append(payload)
+            status = stub.failures.pop(0) if stub.failures else None
+        if stub.delay:
+            time.sleep(stub.delay)
+        if status is not None:
+            self._send_json(status, {'error': {'message': f'stub failure {status}'}})
+            return
+
+        reply = stub.reply(payload) if callable(stub.reply) else stub.reply
+        if payload.get('stream'):
+            self._send_stream(reply)
+            return
+        self._send_json(200, {
+            'id': f'stub-{len(stub.requests)}',
+            'object': 'chat.completion',
+            'model': payload.get('model', 'stub'),
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': reply},
+                'finish_reason': 'stop',
+            }],
+        })
+
+    def _send_stream(self, reply):
+        """以 OpenAI 相容的 SSE 格式逐段送出回覆，每段之間等待 chunk_delay 秒。"""
+        stub = self.server.stub
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream; charset=utf-8')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        size = stub.chunk_size
+        for start in range(0, len(reply), size):
+            chunk = {
+                'object': 'chat.completion.chunk',
+                'choices': [{'index': 0, 'delta': {'content': reply[start:start + size]}, 'finish_reason': None}],
+            }
+            self._write_chunk(b'data: ' + json.dumps(chunk, ensure_ascii=False).encode('utf-8') + b'\n\n')
+            if stub.chunk_delay:
+                time.sleep(stub.chunk_delay)
+        self._write_chunk(b'data: [DONE]\n\n')
+        self._write_chunk(b'')
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):X}\r\n".encode('ascii') + data + b"\r\n")
+        self.wfile.flush()
+
+    def _send_json(self, status, body):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubLLMServer:
+    """
+    在背景執行緒中執行的假 LLM 伺服器；reply 可以是字串或 (payload) -> 字串 的函式。
+    請求帶 stream: true 時，回覆會每 chunk_size 個字元切成一個 SSE 事件。
+    failures 是接下來幾個請求要回傳的錯誤狀態碼（依序使用），delay 是每個請求回應前的等待秒數。
+    """
+
+    def __init__(self, reply="這是測試回覆。", host='127.0.0.1', port=0, chunk_size=4, chunk_delay=0.0,
+                 failures=(), delay=0.0):
+        self.reply = reply
+        self.chunk_size = chunk_size
+        self.chunk_delay = chunk_delay
+        self.failures = list(failures)
+        self.delay = delay
+        self.requests = []
+        self.connections = 0
+        self.lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.stub = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/chat/completions"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="離線測試用的假 LLM 端點")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--reply', default="這是測試回覆。")
+    parser.add_argument('--chunk-delay', type=float, default=0.05, help="串流時每段之間的秒數")
+    args = parser.parse_args(argv)
+
+    stub = StubLLMServer(reply=args.reply, host=args.host, port=args.port, chunk_delay=args.chunk_delay)
+    print(f"Stub LLM listening on {stub.url}")
+    try:
+        stub._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stub._server.server_close()
+
+
+if __name__ == "__main__":
+    main()
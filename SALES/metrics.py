@@ -0,0 +1,173 @@
+"""
+每個請求的效能指標，以 Prometheus 文字格式輸出。
+
+記錄的項目（以 Flask endpoint 為標籤，不用原始路徑，避免 id 造成標籤爆量）：
+    * 請求數（依 endpoint、method、狀態碼）與延遲直方圖
+    * 每個請求執行的 SQL 陳述式數量與耗時（連線池連線的 execute / executemany）
+    * 每個樣板的渲染時間
+
+熱路徑上只做 perf_counter、字典查找與整數加法；統計資料以單一 lock 保護，
+只在請求結束時取用一次。
+"""
+import bisect
+import threading
+import time
+from flask import before_render_template, g, request, template_rendered
+import database
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 500)
+PREFIX = 'sales'
+
+
+class Histogram:
+    """累積直方圖：counts[i] 為落在第 i 個區間（<= buckets[i]）的次數，最後一格為 +Inf。"""
+
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = {}        # (endpoint, method, status) -> 次數
+            self.latency = {}         # endpoint -> Histogram
+            self.statements = {}      # endpoint -> Histogram（每個請求的陳述式數）
+            self.sql_seconds = {}     # endpoint -> Histogram（每個請求的 SQL 總耗時）
+            self.templates = {}       # 樣板名稱 -> Histogram
+
+    def _histogram(self, table, key, buckets):
+        histogram = table.get(key)
+        if histogram is None:
+            histogram = table[key] = Histogram(buckets)
+        return histogram
+
+    def observe_request(self, endpoint, method, status, seconds, statements, sql_seconds):
+        key = (endpoint, method, status)
+        with self._lock:
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self._histogram(self.latency, endpoint, LATENCY_BUCKETS).observe(seconds)
+            self._histogram(self.statements, endpoint, STATEMENT_BUCKETS).observe(statements)
+            self._histogram(self.sql_seconds, endpoint, LATENCY_BUCKETS).observe(sql_seconds)
+
+    def observe_template(self, name, seconds):
+        with self._lock:
+            self._histogram(self.templates, name, LATENCY_BUCKETS).observe(seconds)
+
+    def render(self, gauges=()):
+        """輸出 Prometheus 文字格式；gauges 為額外的 (名稱, 說明, 值) 序列。"""
+        lines = []
+        with self._lock:
+            _counter(lines, 'http_requests_total', "Requests by endpoint, method and status code",
+                     ('endpoint', 'method', 'status'), self.requests)
+            _histograms(lines, 'http_request_duration_seconds', "Request latency", 'endpoint', self.latency)
+            _histograms(lines, 'sql_statements_per_request', "SQL statements executed per request", 'endpoint', self.statements)
+            _histograms(lines, 'sql_seconds_per_request', "Time spent in SQL per request", 'endpoint', self.sql_seconds)
+            _histograms(lines, 'template_render_seconds', "Template render time", 'template', self.templates)
+        for name, help_text, value in gauges:
+            lines.append(f"# HELP {PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {PREFIX}_{name} gauge")
+            lines.append(f"{PREFIX}_{name} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(pairs):
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _counter(lines, name, help_text, label_names, values):
+    lines.append(f"# HELP {PREFIX}_{name} {help_text}")
+    lines.append(f"# TYPE {PREFIX}_{name} counter")
+    for key in sorted(values):
+        lines.append(f"{PREFIX}_{name}{_labels(zip(label_names, key))} {values[key]}")
+
+
+def _histograms(lines, name, help_text, label_name, histograms):
+    lines.append(f"# HELP {PREFIX}_{name} {help_text}")
+    lines.append(f"# TYPE {PREFIX}_{name} histogram")
+    for key in sorted(histograms):
+        histogram = histograms[key]
+        cumulative = 0
+        for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+            cumulative += count
+            le = bound if bound == '+Inf' else _number(float(bound))
+            lines.append(f"{PREFIX}_{name}_bucket{_labels(((label_name, key), ('le', le)))} {cumulative}")
+        lines.append(f"{PREFIX}_{name}_sum{_labels(((label_name, key),))} {_number(histogram.sum)}")
+        lines.append(f"{PREFIX}_{name}_count{_labels(((label_name, key),))} {cumulative}")
+
+
+registry = Registry()
+
+# 目前執行緒上正在處理的請求：[陳述式數, SQL 秒數]；不在請求中時為 None
+_local = threading.local()
+
+
+def _record_statement(conn, sql, params, seconds):
+    current = getattr(_local, 'sql', None)
+    if current is not None:
+        current[0] += 1
+        current[1] += seconds
+
+
+def _before_request():
+    g._metrics_start = time.perf_counter()
+    _local.sql = [0, 0.0]
+
+
+def _after_request(response):
+    g._metrics_status = response.status_code
+    return response
+
+
+def _teardown_request(exception):
+    start = g.pop('_metrics_start', None)
+    if start is None:
+        return
+    sql = getattr(_local, 'sql', None) or (0, 0.0)
+    _local.sql = None
+    status = g.pop('_metrics_status', 500)
+    registry.observe_request(request.endpoint or 'unmatched', request.method, status,
+                             time.perf_counter() - start, sql[0], sql[1])
+
+
+def _before_render(sender, template, context, **extra):
+    stack = getattr(_local, 'templates', None)
+    if stack is None:
+        stack = _local.templates = []
+    stack.append(time.perf_counter())
+
+
+def _rendered(sender, template, context, **extra):
+    stack = getattr(_local, 'templates', None)
+    if stack:
+        registry.observe_template(template.name or 'string', time.perf_counter() - stack.pop())
+
+
+def init_app(app):
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_rendered, app)
+    if _record_statement not in database.statement_hooks:
+        database.statement_hooks.append(_record_statement)
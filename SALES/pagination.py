@@ -0,0 +1,185 @@
+import base64
+import json
+import os
+import threading
+import time
+
+# 分頁設定
+DEFAULT_PAGE_SIZE = int(os.environ.get("PAGE_SIZE", "50"))
+MAX_PAGE_SIZE = int(os.environ.get("MAX_PAGE_SIZE", "200"))
+# 總筆數最多只數到 COUNT_CAP 筆，超過就顯示「10000+」，結果快取 COUNT_TTL 秒
+COUNT_CAP = int(os.environ.get("PAGE_COUNT_CAP", "10000"))
+COUNT_TTL = float(os.environ.get("PAGE_COUNT_TTL", "30"))
+
+_count_cache = {}
+_count_lock = threading.Lock()
+_COUNT_CACHE_MAX = 1024
+
+
+class Page:
+    """一頁查詢結果，以及前後頁的游標。"""
+
+    def __init__(self, rows, args, sorts, next_cursor, prev_cursor, total, total_capped):
+        self.rows = rows
+        self.args = args
+        self.sorts = sorts
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.total = total
+        self.total_capped = total_capped
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+    def url_args(self, **extra):
+        """產生分頁連結要帶的查詢參數（保留搜尋與排序條件）。"""
+        params = {k: v for k, v in self.args.items() if v not in (None, '')}
+        params.update(extra)
+        return params
+
+
+def encode_cursor(values):
+    raw = json.dumps(values, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token, length=None):
+    """
+    解碼游標；格式不對（不是清單、長度與排序鍵不符、含有無法當作 SQL 參數的值）時回傳 None，
+    等同沒有帶游標。游標來自網址，任何內容都可能出現。
+    """
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        values = json.loads(raw.decode('utf-8'))
+    except (ValueError, UnicodeDecodeError):
+        return None
+    if not isinstance(values, list) or not values or (length is not None and len(values) != length):
+        return None
+    if not all(value is None or (isinstance(value, (str, int, float)) and not isinstance(value, bool))
+               for value in values):
+        return None
+    return values
+
+
+def parse_args(args, sorts, default_sort='id'):
+    """從 request.args 取出排序、頁面大小與游標參數。"""
+    sort = args.get('sort')
+    if sort not in sorts:
+        sort = default_sort
+    order = 'desc' if args.get('order') == 'desc' else 'asc'
+    try:
+        per_page = int(args.get('per_page', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        per_page = DEFAULT_PAGE_SIZE
+    per_page = max(1, min(per_page, MAX_PAGE_SIZE))
+    return {
+        'search': args.get('search'),
+        'sort': sort,
+        'order': order,
+        'per_page': per_page,
+        'after': args.get('after'),
+        'before': args.get('before'),
+    }
+
+
+def count_rows(conn, query, params, version=None):
+    """
+    回傳 (筆數, 是否超過上限)。最多數到 COUNT_CAP 筆，結果短暫快取。
+    version 為查詢涉及資料表的變更計數器（database.table_versions()）；寫入後版本改變，不會沿用舊的筆數。
+    """
+    key = (query, tuple(params), version)
+    now = time.monotonic()
+    with _count_lock:
+        cached = _count_cache.get(key)
+        if cached and cached[0] > now:
+            return cached[1]
+
+    count = conn.execute(f"SELECT COUNT(*) FROM ({query} LIMIT {COUNT_CAP + 1})", params).fetchone()[0]
+    result = (min(count, COUNT_CAP), count > COUNT_CAP)
+
+    with _count_lock:
+        if len(_count_cache) >= _COUNT_CACHE_MAX:
+            _count_cache.clear()
+        _count_cache[key] = (now + COUNT_TTL, result)
+    return result
+
+
+def clear_count_cache():
+    with _count_lock:
+        _count_cache.clear()
+
+
+def fetch_page(conn, query, where, params, sorts, id_column, args, version=None):
+    """
+    以 keyset（游標）方式取出一頁資料。
+
+    query 為不含 WHERE 的 SELECT（可帶 WITH 子句）；where 為 AND 串接的條件清單；
+    params 依序包含 query 與 where 的參數；
+    sorts 對應 排序名稱 -> (SQL 欄位, 結果列欄位名稱)，並一律以 id_column 作為排序的第二鍵，
+    確保排序穩定、游標唯一；version 會交給 count_rows() 作為總筆數快取的資料版本。
+    """
+    sort_expr, sort_key = sorts[args['sort']]
+    single_key = sort_expr == id_column
+    descending = args['order'] == 'desc'
+    per_page = args['per_page']
+
+    cursor_length = 1 if single_key else 2
+    after = decode_cursor(args['after'], cursor_length)
+    before = decode_cursor(args['before'], cursor_length) if after is None else None
+    cursor = after or before
+
+    # 往前翻頁時反向查詢，取回後再倒轉
+    reverse = before is not None
+    scan_desc = descending != reverse
+
+    base_where = list(where)
+    base_params = list(params)
+    page_where = list(base_where)
+    page_params = list(base_params)
+    if cursor is not None:
+        op = '<' if scan_desc else '>'
+        if single_key:
+            page_where.append(f"{id_column} {op} ?")
+        else:
+            page_where.append(f"({sort_expr}, {id_column}) {op} (?, ?)")
+        page_params.extend(cursor)
+
+    direction = 'DESC' if scan_desc else 'ASC'
+    order_by = f"{id_column} {direction}" if single_key else f"{sort_expr} {direction}, {id_column} {direction}"
+    sql = query
+    if page_where:
+        sql += " WHERE " + " AND ".join(page_where)
+    sql += f" ORDER BY {order_by} LIMIT ?"
+    rows = conn.execute(sql, page_params + [per_page + 1]).fetchall()
+
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if reverse:
+        rows.reverse()
+
+    def cursor_for(row):
+        if single_key:
+            return encode_cursor([row[sort_key]])
+        return encode_cursor([row[sort_key], row[id_column.split('.')[-1]]])
+
+    next_cursor = prev_cursor = None
+    if rows:
+        if (more and not reverse) or (reverse and cursor is not None):
+            next_cursor = cursor_for(rows[-1])
+        if (more and reverse) or (not reverse and cursor is not None):
+            prev_cursor = cursor_for(rows[0])
+
+    count_sql = query
+    if base_where:
+        count_sql += " WHERE " + " AND ".join(base_where)
+    total, capped = count_rows(conn, count_sql, base_params, version)
+
+    link_args = {k: args[k] for k in ('search', 'sort', 'order', 'per_page')}
+    return Page(rows, link_args, list(sorts), next_cursor, prev_cursor, total, capped)
@@ -0,0 +1,153 @@
+"""
+已接受的報價單批次轉換為訂單。
+
+整批在同一個 BEGIN IMMEDIATE 交易內（database.write_transaction，資料庫忙碌時整批重試）
+以固定數量的集合式 SQL 完成，與報價單數量無關：
+    1. 一條 SELECT 取得每個報價單 id 的狀態、建立者與既有訂單，用來回報逐筆結果
+    2. INSERT ... SELECT 為狀態為「已接受」且使用者有權限的報價單建立訂單
+    3. UPDATE 把剛轉換的報價單改為「已轉換」
+    4. SELECT 取回新訂單的 id
+
+訂單以 orders.source_quote_id 記錄來源報價單，並有唯一索引，
+所以重送同一個請求不會產生重複訂單：已轉換的報價單回報 already_converted 與原本的訂單 id。
+"""
+import json
+import database
+
+ACCEPTED = '已接受'
+CONVERTED = '已轉換'
+NEW_ORDER_STATUS = '未付款'
+# 單次請求最多處理的報價單數，避免一個交易持有寫入鎖太久
+MAX_BATCH = 1000
+
+# 逐筆結果
+RESULT_CONVERTED = 'converted'
+RESULT_ALREADY_CONVERTED = 'already_converted'
+RESULT_NOT_FOUND = 'not_found'
+RESULT_NOT_ACCEPTED = 'not_accepted'
+RESULT_FORBIDDEN = 'forbidden'
+
+# 以 JSON 陣列傳入整批 id，SQL 的長度與參數個數不隨批次大小改變
+_REQUESTED = "SELECT DISTINCT CAST(value AS INTEGER) FROM json_each(:ids)"
+
+
+class ConversionError(ValueError):
+    """請求本身不合法（id 格式錯誤、超過批次上限）。"""
+
+
+def parse_ids(values):
+    """把表單或 JSON 傳入的 id 轉為不重複、保留順序的整數清單。"""
+    ids = []
+    seen = set()
+    for value in values:
+        try:
+            quote_id = int(value)
+        except (TypeError, ValueError):
+            raise ConversionError(f"無效的報價單 ID: {value!r}")
+        if quote_id not in seen:
+            seen.add(quote_id)
+            ids.append(quote_id)
+    if len(ids) > MAX_BATCH:
+        raise ConversionError(f"一次最多轉換 {MAX_BATCH} 張報價單")
+    return ids
+
+
+def accepted_quotes_query(filters, creator_id=None):
+    """
+    已接受報價單的查詢（含客戶名稱）與參數；/automation 列表與「轉換所有符合條件」共用。
+    filters 可包含 search（客戶名稱）、date_from、date_to；creator_id 不為 None 時只列出該使用者建立的報價單。
+    """
+    query = ("SELECT q.*, c.name AS customer_name FROM quotes q JOIN customers c ON q.customer_id = c.id "
+             "WHERE q.status = ?")
+    params = [ACCEPTED]
+    if creator_id is not None:
+        query += " AND q.creator_id = ?"
+        params.append(creator_id)
+    if filters.get('search'):
+        query += " AND c.name LIKE ?"
+        params.append(f"%{filters['search']}%")
+    if filters.get('date_from'):
+        query += " AND q.quote_date >= ?"
+        params.append(filters['date_from'])
+    if filters.get('date_to'):
+        query += " AND q.quote_date <= ?"
+        params.append(filters['date_to'])
+    return query, params
+
+
+def matching_ids(conn, filters, creator_id=None):
+    """符合篩選條件的已接受報價單 id（最多 MAX_BATCH 筆），以及是否還有更多。"""
+    query, params = accepted_quotes_query(filters, creator_id)
+    rows = conn.execute(f"SELECT id FROM ({query}) ORDER BY id LIMIT ?", params + [MAX_BATCH + 1]).fetchall()
+    ids = [row['id'] for row in rows]
+    return ids[:MAX_BATCH], len(ids) > MAX_BATCH
+
+
+def convert(conn, quote_ids, user_id, can_convert_all=False):
+    """
+    把 quote_ids 中可轉換的報價單轉為訂單，回傳依輸入順序排列的逐筆結果：
+    {'quote_id', 'result', 'order_id'}。can_convert_all 為 True 時（系統管理員）可轉換任何人的報價單，
+    否則只能轉換自己建立的。conn 不可處於未完成的交易中。
+    """
+    ids = parse_ids(quote_ids)
+    if not ids:
+        return []
+    params = {'ids': json.dumps(ids), 'user_id': user_id, 'all': 1 if can_convert_all else 0,
+              'accepted': ACCEPTED, 'converted': CONVERTED, 'new_status': NEW_ORDER_STATUS}
+
+    def apply(conn):
+        before = {row['quote_id']: row for row in conn.execute(f'''
+            WITH requested (quote_id) AS ({_REQUESTED})
+            SELECT r.quote_id, q.id IS NOT NULL AS found, q.status, q.creator_id, o.id AS order_id
+            FROM requested r
+            LEFT JOIN quotes q ON q.id = r.quote_id
+            LEFT JOIN orders o ON o.source_quote_id = r.quote_id
+        ''', params).fetchall()}
+        conn.execute(f'''
+            INSERT INTO orders (customer_id, order_date, amount, status, creator_id, source_quote_id)
+            SELECT q.customer_id, q.quote_date, q.amount, :new_status, :user_id, q.id
+            FROM quotes q
+            WHERE q.id IN ({_REQUESTED})
+              AND q.status = :accepted
+              AND (:all OR q.creator_id = :user_id)
+              AND NOT EXISTS (SELECT 1 FROM orders o WHERE o.source_quote_id = q.id)
+            ORDER BY q.id
+        ''', params)
+        conn.execute(f'''
+            UPDATE quotes SET status = :converted
+            WHERE status = :accepted
+              AND id IN (SELECT source_quote_id FROM orders WHERE source_quote_id IN ({_REQUESTED}))
+        ''', params)
+        orders = dict(conn.execute(
+            f"SELECT source_quote_id, id FROM orders WHERE source_quote_id IN ({_REQUESTED})", params
+        ).fetchall())
+        return before, orders
+
+    before, orders = database.write_transaction(conn, apply)
+
+    results = []
+    for quote_id in ids:
+        row = before[quote_id]
+        if row['order_id'] is not None:
+            result = RESULT_ALREADY_CONVERTED
+        elif not row['found']:
+            result = RESULT_NOT_FOUND
+        elif row['status'] == CONVERTED:
+            # 來源欄位出現之前轉換的報價單，查不到對應的訂單
+            result = RESULT_ALREADY_CONVERTED
+        elif row['status'] != ACCEPTED:
+            result = RESULT_NOT_ACCEPTED
+        elif not can_convert_all and row['creator_id'] != user_id:
+            result = RESULT_FORBIDDEN
+        else:
+            result = RESULT_CONVERTED
+        results.append({'quote_id': quote_id, 'result': result, 'order_id': orders.get(quote_id)})
+    return results
+
+
+def summarize(results):
+    """各種結果的筆數，例如 {'converted': 3, 'forbidden': 1}。"""
+    counts = {}
+    for item in results:
+        counts[item['result']] = counts.get(item['result'], 0) + 1
+    return counts
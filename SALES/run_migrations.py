@@ -1,4 +1,3 @@
 import database
-database.init_db()
-database.migrate_db()
-print("Database migration complete.")
\ No newline at end of file
+database.bootstrap()
+print("Database migration complete.")
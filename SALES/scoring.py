@@ -0,0 +1,122 @@
+"""
+客戶商機評分與客戶群分組（/ai_features）。
+
+計數類資料用 SQL 彙總，消費金額則以欄位式（columnar）方式一次讀出，交給 NumPy 向量運算。
+結果與原本逐筆迴圈的版本完全相同：
+    * 訂單 +10 分（取消的訂單 -10 分），已接受／已轉換的報價單 +5 分
+    * 消費總額（不含取消訂單）高於平均者再 +20 分
+    * 以 P25 / P75 將客戶分成高、中、低價值三群
+"""
+import itertools
+import database
+
+CANCELLED_ORDER_STATUS = '取消'
+
+# 100 萬筆訂單、1 萬位客戶的評分時間（秒）。需求的目標是 1 秒內，目前約 1.3–1.8 秒仍未達成：
+# SQL 掃描只要約 0.15 秒，其餘是 sqlite3 模組把約 70 萬列轉成 Python 物件的時間。
+# 改用 SQL SUM 雖可省去這段，但 SQLite 3.43 起 SUM 採補償求和，總額不再與原本逐筆相加的結果
+# 位元相同（本機 GROUP BY 也要排序而更慢），所以保留完全相同的輸出、放棄這個目標。
+# test_scoring.py 與 benchmark.py 以 BUDGET 防止再變慢。
+TARGET_SECONDS_PER_MILLION_ORDERS = 1.0
+BUDGET_SECONDS_PER_MILLION_ORDERS = 2.5
+
+
+def _per_customer_counts(conn, query, params, customer_ids):
+    import numpy as np
+    counts = np.zeros(len(customer_ids), dtype=np.int64)
+    rows = conn.execute(query, params).fetchall()
+    if rows:
+        keys = np.array([row[0] for row in rows], dtype=np.int64)
+        values = np.array([row[1] for row in rows], dtype=np.int64)
+        positions = np.searchsorted(customer_ids, keys)
+        valid = positions < len(customer_ids)
+        valid[valid] = customer_ids[positions[valid]] == keys[valid]
+        np.add.at(counts, positions[valid], values[valid])
+    return counts
+
+
+def score_customers(conn):
+    """
+    回傳 (依分數排序的客戶清單, 客戶群分組)，格式與 ai_features.html 使用的一致。
+    耗時與有效訂單數成正比，目前未達 1 秒內的目標（見 TARGET_SECONDS_PER_MILLION_ORDERS）。
+    """
+    # NumPy 載入要上百毫秒，延到第一次評分時才匯入，不拖慢 app 啟動
+    import numpy as np
+    customers = conn.execute("SELECT id, name FROM customers ORDER BY id").fetchall()
+    names = [row[1] for row in customers]
+    customer_ids = np.array([row[0] for row in customers], dtype=np.int64)
+    n = len(customer_ids)
+
+    # --- 計數：交給 SQL 彙總（有 (status, customer_id) 覆蓋索引） ---
+    cancelled_orders = _per_customer_counts(
+        conn,
+        "SELECT customer_id, COUNT(*) FROM orders WHERE status = ? AND typeof(customer_id) = 'integer' GROUP BY customer_id",
+        (CANCELLED_ORDER_STATUS,), customer_ids
+    )
+    placeholders = ", ".join("?" for _ in database.CONVERTED_QUOTE_STATUSES)
+    converted_quotes = _per_customer_counts(
+        conn,
+        f"SELECT customer_id, COUNT(*) FROM quotes WHERE status IN ({placeholders}) AND typeof(customer_id) = 'integer' GROUP BY customer_id",
+        database.CONVERTED_QUOTE_STATUSES, customer_ids
+    )
+
+    # --- 消費金額：依 id 順序讀出欄位資料，bincount 會照相同順序逐筆累加，浮點結果與原本一致 ---
+    cursor = conn.execute(
+        "SELECT customer_id, amount FROM orders WHERE status != ? AND typeof(customer_id) = 'integer' ORDER BY id",
+        (CANCELLED_ORDER_STATUS,)
+    )
+    flat = np.fromiter(itertools.chain.from_iterable(cursor), dtype=np.float64)
+    order_customers = flat[0::2].astype(np.int64)
+    order_amounts = flat[1::2]
+
+    positions = np.searchsorted(customer_ids, order_customers)
+    valid = positions < n
+    valid[valid] = customer_ids[positions[valid]] == order_customers[valid]
+    positions = positions[valid]
+    active_orders = np.bincount(positions, minlength=n)
+    total_spent = np.bincount(positions, weights=order_amounts[valid], minlength=n)
+
+    scores = 10 * (active_orders - cancelled_orders) + 5 * converted_quotes
+
+    # --- 分位數與平均：只看有正向消費的客戶 ---
+    spendings = np.sort(total_spent[(active_orders > 0) & (total_spent > 0)])
+    p25, p75 = 0, 0
+    average = 0
+    if len(spendings):
+        p25 = spendings[int(len(spendings) * 0.25)]
+        p75 = spendings[int(len(spendings) * 0.75)]
+        # cumsum 依序累加，與 Python sum() 的結果相同
+        average = np.cumsum(spendings)[-1] / len(spendings)
+    scores = scores + 20 * (total_spent > average)
+
+    # 沒有任何有效訂單的客戶，原本的消費總額是整數 0
+    spent_values = [float(total) if count else 0 for total, count in zip(total_spent.tolist(), active_orders.tolist())]
+
+    high = (total_spent >= p75) & (p75 > 0)
+    mid = ~high & (total_spent >= p25)
+    segments = {'high_value': [], 'mid_value': [], 'low_value': []}
+    for i in range(n):
+        entry = {'name': names[i], 'total_spent': spent_values[i]}
+        if high[i]:
+            segments['high_value'].append(entry)
+        elif mid[i]:
+            segments['mid_value'].append(entry)
+        else:
+            segments['low_value'].append(entry)
+
+    order = np.argsort(-scores, kind='stable')
+    score_list = scores.tolist()
+    scored_customers = [
+        {'name': names[i], 'score': score_list[i], 'total_spent': spent_values[i]}
+        for i in order.tolist()
+    ]
+    return scored_customers, segments
+
+
+def score_database(path=None):
+    """在背景工作（可能是另一個行程）中評分：自行開啟連線，回傳 score_customers() 的結果。"""
+    conn = database.connect(path)
+    try:
+        return score_customers(conn)
+    finally:
+        conn.close()
@@ -0,0 +1,79 @@
+import os
+
+# 每次搜尋最多取回的命中筆數（依相關性排序後截斷）
+SEARCH_LIMIT = int(os.environ.get("SEARCH_RESULT_LIMIT", "500"))
+# trigram 斷詞至少需要 3 個字元
+MIN_TERM_LENGTH = 3
+
+# 列表加上「依相關性排序」選項時使用；score 為 FTS5 的 bm25 分數，越小越相關
+RELEVANCE_SORT = ('hits.score', 'score')
+
+_FTS_TABLES = {
+    'customers': 'customers_fts',
+    'orders': 'orders_fts',
+    'quotes': 'quotes_fts',
+}
+
+
+def has_search_index(conn):
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'customers_fts'"
+    ).fetchone() is not None
+
+
+def match_expression(term):
+    """
+    把搜尋字串轉成 FTS5 查詢：以空白分詞，每個詞當成一個片語、全部都要符合。
+    有任何詞短於 MIN_TERM_LENGTH 時 trigram 無法比對，回傳 None。
+    """
+    words = (term or '').split()
+    if not words or any(len(word) < MIN_TERM_LENGTH for word in words):
+        return None
+    return " AND ".join('"' + word.replace('"', '""') + '"' for word in words)
+
+
+def ranked_hits(conn, table, term, scope_column=None, scope_value=None, limit=None):
+    """
+    產生 `WITH hits(id, score) AS (...)` 的 CTE 與參數，列出依相關性排序的前 SEARCH_LIMIT 筆。
+
+    scope_column 用來在截斷前先套用可見範圍（例如 creator_id），避免別人的資料佔掉名額。
+    訂單與報價單輸入純數字時，另外以主鍵精確比對 id。無法使用全文索引時回傳 None，
+    由呼叫端退回 LIKE 搜尋。limit 可覆寫 SEARCH_LIMIT，-1 代表不限筆數（匯出時使用）。
+    """
+    term = (term or '').strip()
+    expression = match_expression(term)
+    by_id = table in ('orders', 'quotes') and term.isdigit()
+    if (expression is None and not by_id) or not has_search_index(conn):
+        return None
+
+    scope_sql = ""
+    scope_params = []
+    if scope_column is not None:
+        scope_sql = f" AND t.{scope_column} = ?"
+        scope_params = [scope_value]
+
+    parts = []
+    params = []
+    if expression is not None:
+        fts = _FTS_TABLES[table]
+        parts.append(f'''
+            SELECT id, score FROM (
+                SELECT {fts}.rowid AS id, {fts}.rank AS score
+                FROM {fts} JOIN {table} t ON t.id = {fts}.rowid
+                WHERE {fts} MATCH ?{scope_sql}
+                ORDER BY {fts}.rank LIMIT ?
+            )
+        ''')
+        params.extend([expression] + scope_params + [SEARCH_LIMIT if limit is None else limit])
+    if by_id:
+        # 精確的 id 命中排在最前面
+        parts.append(f"SELECT t.id, -1e308 FROM {table} t WHERE t.id = ?{scope_sql}")
+        params.extend([int(term)] + scope_params)
+
+    return "WITH hits(id, score) AS (" + " UNION ".join(parts) + ")", params
+
+
+def with_relevance(sorts):
+    sorts = dict(sorts)
+    sorts['relevance'] = RELEVANCE_SORT
+    return sorts
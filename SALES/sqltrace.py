@@ -0,0 +1,190 @@
+"""
+SQL 追蹤（預設關閉）：慢查詢記錄、EXPLAIN QUERY PLAN 與最耗時陳述式排行。
+
+路由常以字串串接組出 SQL，同一個頁面可能跑出好幾種查詢變體。追蹤開啟時：
+    * 每條陳述式（正規化空白與 IN (?, ?, ...) 後）累計次數、總耗時與最長耗時
+    * 超過門檻的陳述式寫入慢查詢記錄；參數只記錄型別與長度，不記錄實際值
+    * 每個不同的慢陳述式擷取一次 EXPLAIN QUERY PLAN，並標出整張表掃描
+    * 以 set_trace_callback 計算陳述式在 trigger 中連帶執行的子陳述式數量
+
+計時來自 database.statement_hooks（連線池連線的 execute / executemany）。
+開啟方式：環境變數 SQL_TRACE=1，或由管理員在 /admin/sql 頁面切換。
+"""
+import collections
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import database
+
+TRACE_AT_STARTUP = os.environ.get("SQL_TRACE", "0") == "1"
+SLOW_MS = float(os.environ.get("SQL_SLOW_MS", "50"))
+# 累計的不同陳述式上限（超過的只計入 dropped）、保留的慢查詢筆數、排行顯示筆數
+MAX_STATEMENTS = 1000
+RECENT_SLOW = 100
+TOP_N = 20
+
+logger = logging.getLogger('sales.sqltrace')
+
+_WHITESPACE = re.compile(r'\s+')
+_PLACEHOLDER_LIST = re.compile(r'\?(?:\s*,\s*\?)+')
+# "SCAN orders" 是整表掃描；"SCAN orders USING INDEX ..."、虛擬表與子查詢不算
+_FULL_SCAN = re.compile(r'^SCAN (\w+)$')
+_EXPLAINABLE = ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+_TRANSACTION = ('BEGIN', 'COMMIT', 'ROLLBACK')
+
+
+def normalize(sql):
+    """把同一查詢的不同寫法歸成一類：壓縮空白，IN 清單的多個 ? 視為一個。"""
+    return _PLACEHOLDER_LIST.sub('?, ...', _WHITESPACE.sub(' ', sql).strip())
+
+
+def _redact_value(value):
+    if value is None:
+        return 'NULL'
+    if isinstance(value, (str, bytes)):
+        return f"<{type(value).__name__}:{len(value)}>"
+    return f"<{type(value).__name__}>"
+
+
+def redact(params):
+    """參數只保留型別（字串加上長度），讓記錄可以安全地保存與分享。"""
+    if isinstance(params, dict):
+        return {key: _redact_value(value) for key, value in params.items()}
+    if isinstance(params, (list, tuple)):
+        if params and isinstance(params[0], (list, tuple, dict)):
+            return f"<{len(params)} rows>"
+        return [_redact_value(value) for value in params]
+    return f"<{type(params).__name__}>"
+
+
+def explain(path, sql, params):
+    """回傳 (查詢計畫各行, 整表掃描的資料表)；無法解析時計畫為錯誤說明。"""
+    if not sql.lstrip().upper().startswith(_EXPLAINABLE):
+        return [], []
+    if isinstance(params, (list, tuple)) and params and isinstance(params[0], (list, tuple, dict)):
+        params = params[0]
+    elif not isinstance(params, (list, tuple, dict)):
+        return [], []
+    conn = sqlite3.connect(path)
+    try:
+        rows = conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+    except sqlite3.Error as e:
+        return [f"無法取得查詢計畫: {e}"], []
+    finally:
+        conn.close()
+    plan = [detail for _, _, _, detail in rows]
+    scans = [match.group(1) for match in map(_FULL_SCAN.match, plan) if match]
+    return plan, scans
+
+
+class Tracer:
+    def __init__(self, slow_ms=SLOW_MS):
+        self.slow_ms = slow_ms
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.statements = {}
+            self.plans = {}
+            self.recent = collections.deque(maxlen=RECENT_SLOW)
+            self.dropped = 0
+
+    def enable(self, slow_ms=None):
+        if slow_ms is not None:
+            self.slow_ms = slow_ms
+        self.enabled = True
+        if self._on_statement not in database.statement_hooks:
+            database.statement_hooks.append(self._on_statement)
+
+    def disable(self):
+        self.enabled = False
+        if self._on_statement in database.statement_hooks:
+            database.statement_hooks.remove(self._on_statement)
+
+    def _on_trace(self, statement):
+        # 只計數，不保存：回呼拿到的是代入實際參數值的 SQL
+        if self.enabled and not statement.startswith(_TRANSACTION):
+            self._local.events = getattr(self._local, 'events', 0) + 1
+
+    def _on_statement(self, conn, sql, params, seconds):
+        if not getattr(conn, '_sqltrace', False):
+            conn.set_trace_callback(self._on_trace)
+            conn._sqltrace = True
+        sub_statements = max(getattr(self._local, 'events', 0) - 1, 0)
+        self._local.events = 0
+        key = normalize(sql)
+        slow = seconds * 1000 >= self.slow_ms
+
+        with self._lock:
+            entry = self.statements.get(key)
+            if entry is None and len(self.statements) < MAX_STATEMENTS:
+                entry = self.statements[key] = {'sql': key, 'count': 0, 'total_seconds': 0.0,
+                                                'max_seconds': 0.0, 'slow': 0}
+            if entry is None:
+                self.dropped += 1
+            else:
+                entry['count'] += 1
+                entry['total_seconds'] += seconds
+                entry['max_seconds'] = max(entry['max_seconds'], seconds)
+                entry['slow'] += slow
+            need_plan = slow and key not in self.plans
+            if need_plan:
+                self.plans[key] = ([], [])  # 佔位，避免多個執行緒同時擷取同一個計畫
+        if not slow:
+            return
+
+        if need_plan:
+            plan = explain(getattr(conn.pool, 'path', None) or database.DB_PATH, sql, params)
+            with self._lock:
+                self.plans[key] = plan
+        plan, scans = self.plans.get(key, ([], []))
+        record = {
+            'sql': key,
+            'ms': round(seconds * 1000, 2),
+            'params': redact(params),
+            'sub_statements': sub_statements,
+            'at': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'full_scans': scans,
+        }
+        with self._lock:
+            self.recent.append(record)
+        logger.warning("慢查詢 %.1f ms（子陳述式 %d）: %s | 參數 %s%s", record['ms'], sub_statements, key,
+                       record['params'], f" | 整表掃描: {', '.join(scans)}" if scans else "")
+
+    def top(self, n=TOP_N):
+        """依總耗時排序的前 n 條陳述式，附上平均耗時與（若曾變慢）查詢計畫。"""
+        with self._lock:
+            entries = sorted(self.statements.values(), key=lambda e: e['total_seconds'], reverse=True)[:n]
+            plans = dict(self.plans)
+        return [
+            dict(entry,
+                 total_ms=round(entry['total_seconds'] * 1000, 2),
+                 avg_ms=round(entry['total_seconds'] / entry['count'] * 1000, 3),
+                 max_ms=round(entry['max_seconds'] * 1000, 2),
+                 plan=plans.get(entry['sql'], ([], []))[0],
+                 full_scans=plans.get(entry['sql'], ([], []))[1])
+            for entry in entries
+        ]
+
+    def snapshot(self, n=TOP_N):
+        with self._lock:
+            recent = list(self.recent)[::-1]
+            distinct = len(self.statements)
+            dropped = self.dropped
+        return {
+            'enabled': self.enabled,
+            'slow_ms': self.slow_ms,
+            'distinct_statements': distinct,
+            'dropped': dropped,
+            'top': self.top(n),
+            'recent_slow': recent,
+        }
+
+
+tracer = Tracer()
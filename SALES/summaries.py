@@ -0,0 +1,154 @@
+"""
+銷售彙總表的讀取、重建與一致性檢查。
+
+彙總表（order_status_summary、quote_status_summary、customer_sales_summary）
+由 database.py 建立的 trigger 在訂單與報價單異動時增量維護。
+
+    python summaries.py rebuild   # 從訂單與報價單全量重算
+    python summaries.py check     # 比對彙總表與全量重算的結果
+"""
+import argparse
+import math
+import sys
+import database
+
+# 浮點數累加順序不同會有些微誤差，比對時容許的相對誤差
+AMOUNT_TOLERANCE = 1e-6
+
+
+def sales_overview(conn):
+    """/analysis 需要的彙總數字，只讀取彙總表。"""
+    total_orders, total_revenue = conn.execute(
+        "SELECT COALESCE(SUM(order_count), 0), COALESCE(SUM(total_amount), 0) FROM order_status_summary"
+    ).fetchone()
+    average_order_value = total_revenue / total_orders if total_orders > 0 else 0
+
+    placeholders = ", ".join("?" for _ in database.CONVERTED_QUOTE_STATUSES)
+    total_quotes, converted_quotes = conn.execute(
+        f"SELECT COALESCE(SUM(quote_count), 0), COALESCE(SUM(CASE WHEN status IN ({placeholders}) THEN quote_count ELSE 0 END), 0) FROM quote_status_summary",
+        database.CONVERTED_QUOTE_STATUSES
+    ).fetchone()
+    conversion_rate = converted_quotes / total_quotes if total_quotes > 0 else 0
+
+    # 與原本的 GROUP BY c.name 相同，以客戶名稱合併；資料量只與客戶數有關，與訂單歷史無關
+    top_customers = conn.execute('''
+        SELECT c.name, SUM(s.total_amount) AS total_spent
+        FROM customer_sales_summary s JOIN customers c ON c.id = s.customer_id
+        WHERE s.order_count > 0
+        GROUP BY c.name ORDER BY total_spent DESC LIMIT 5
+    ''').fetchall()
+
+    order_status_distribution = conn.execute(
+        "SELECT status, order_count AS count FROM order_status_summary WHERE order_count > 0 ORDER BY status"
+    ).fetchall()
+
+    return {
+        'sales_summary': {
+            'total_orders': total_orders,
+            'total_revenue': total_revenue,
+            'average_order_value': average_order_value
+        },
+        'quote_summary': {
+            'total_quotes': total_quotes,
+            'converted_quotes': converted_quotes,
+            'conversion_rate': conversion_rate
+        },
+        'top_customers': top_customers,
+        'order_status_distribution': order_status_distribution,
+    }
+
+
+def _amounts_match(a, b):
+    return math.isclose(a or 0, b or 0, rel_tol=AMOUNT_TOLERANCE, abs_tol=AMOUNT_TOLERANCE)
+
+
+def _compare(label, stored, expected, count_columns, amount_columns):
+    problems = []
+    for key in sorted(set(stored) | set(expected), key=str):
+        have = stored.get(key)
+        want = expected.get(key)
+        # 計數歸零的資料列與不存在的資料列視為相同
+        if have is not None and not any(have[c] for c in count_columns) and want is None:
+            continue
+        if have is None or want is None:
+            problems.append(f"{label}[{key}]: stored={have and dict(have)} expected={want and dict(want)}")
+            continue
+        if any(have[c] != want[c] for c in count_columns) or \
+                not all(_amounts_match(have[c], want[c]) for c in amount_columns):
+            problems.append(f"{label}[{key}]: stored={dict(have)} expected={dict(want)}")
+    return problems
+
+
+def check_summaries(conn):
+    """以全量重算結果比對彙總表，回傳不一致項目的描述清單（空清單代表一致）。"""
+    placeholders = ", ".join("?" for _ in database.CONVERTED_QUOTE_STATUSES)
+
+    def keyed(query, params=()):
+        return {row[0]: row for row in conn.execute(query, params).fetchall()}
+
+    problems = []
+    problems += _compare(
+        'order_status_summary',
+        keyed("SELECT status, order_count, total_amount FROM order_status_summary"),
+        keyed("SELECT status, COUNT(*) AS order_count, TOTAL(amount) AS total_amount FROM orders GROUP BY status"),
+        ('order_count',), ('total_amount',)
+    )
+    problems += _compare(
+        'quote_status_summary',
+        keyed("SELECT status, quote_count, total_amount FROM quote_status_summary"),
+        keyed("SELECT status, COUNT(*) AS quote_count, TOTAL(amount) AS total_amount FROM quotes GROUP BY status"),
+        ('quote_count',), ('total_amount',)
+    )
+    problems += _compare(
+        'customer_sales_summary',
+        keyed("SELECT customer_id, order_count, total_amount, quote_count, converted_quotes FROM customer_sales_summary"),
+        keyed(f'''
+            SELECT customer_id, SUM(order_count) AS order_count, TOTAL(total_amount) AS total_amount,
+                   SUM(quote_count) AS quote_count, SUM(converted_quotes) AS converted_quotes
+            FROM (
+                SELECT customer_id, COUNT(*) AS order_count, TOTAL(amount) AS total_amount,
+                       0 AS quote_count, 0 AS converted_quotes
+                FROM orders WHERE typeof(customer_id) = 'integer' GROUP BY customer_id
+                UNION ALL
+                SELECT customer_id, 0, 0, COUNT(*), SUM(status IN ({placeholders}))
+                FROM quotes WHERE typeof(customer_id) = 'integer' GROUP BY customer_id
+            )
+            GROUP BY customer_id
+        ''', database.CONVERTED_QUOTE_STATUSES),
+        ('order_count', 'quote_count', 'converted_quotes'), ('total_amount',)
+    )
+    return problems
+
+
+def rebuild_summaries(conn):
+    with conn:
+        database.rebuild_sales_summaries(conn)
+        # 彙總表不在 trigger 的計數範圍內；讓 /analysis 的 ETag 失效
+        database.bump_table_versions(conn, ('orders', 'quotes'))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="銷售彙總表維護工具")
+    parser.add_argument('command', choices=['rebuild', 'check'])
+    args = parser.parse_args(argv)
+
+    conn = database.connect()
+    try:
+        if args.command == 'rebuild':
+            rebuild_summaries(conn)
+            print("彙總表已重建完成。")
+            return 0
+        problems = check_summaries(conn)
+        for problem in problems:
+            print(problem)
+        if problems:
+            print(f"發現 {len(problems)} 筆不一致，請執行 `python summaries.py rebuild`。")
+            return 1
+        print("彙總表與明細資料一致。")
+        return 0
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,709 @@
+import gzip
+import json
+import re
+import sqlite3
+import threading
+from urllib.parse import urlencode
+import pytest
+from flask import template_rendered
+import database
+import export
+import metrics
+import pagination
+from app import app
+
+
+@pytest.fixture
+def client():
+    app.config['TESTING'] = True
+    with app.test_client() as client:
+        client.post('/login', data={'employee_id': '1', 'password': '1'})
+        yield client
+
+
+def test_routes_reuse_pooled_connections(client):
+    """Repeated requests should be served from already-open pooled connections."""
+    client.get('/customers')
+    before = database.get_pool().stats()
+    for _ in range(5):
+        assert client.get('/orders').status_code == 200
+    after = database.get_pool().stats()
+    assert after['hits'] - before['hits'] >= 5
+    assert after['misses'] == before['misses']
+    assert after['idle'] == after['open']
+
+
+def test_pooled_connection_pragmas():
+    """Pooled connections are opened in WAL mode with the tuned pragmas."""
+    conn = database.get_pool().acquire()
+    try:
+        assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        assert conn.execute('PRAGMA synchronous').fetchone()[0] == 1  # NORMAL
+        assert conn.execute('PRAGMA busy_timeout').fetchone()[0] == database.BUSY_TIMEOUT_MS
+    finally:
+        conn.close()
+
+
+def test_pool_waits_when_exhausted():
+    """Borrowers wait for a returned connection once the pool is at its limit."""
+    pool = database.ConnectionPool(database.DB_PATH, max_size=1, timeout=2)
+    first = pool.acquire()
+    threading.Timer(0.05, first.close).start()
+    second = pool.acquire()
+    assert second is first
+    assert pool.stats()['waits'] == 1
+    second.close()
+    pool.close()
+
+
+def test_pool_timeout_raises_sqlite_error():
+    """A pool timeout surfaces as a regular sqlite3 error."""
+    pool = database.ConnectionPool(database.DB_PATH, max_size=1, timeout=0.01)
+    conn = pool.acquire()
+    with pytest.raises(database.sqlite3.OperationalError):
+        pool.acquire()
+    conn.close()
+    pool.close()
+
+
+def test_teardown_does_not_release_a_connection_lent_to_someone_else():
+    """A route that closes its connection early must not hand back the next borrower's lease at teardown."""
+    from app import get_db_connection
+    pool = database.get_pool()
+    with app.app_context():
+        conn = get_db_connection()
+        conn.close()
+        other = pool.acquire()  # LIFO: the same connection, now another request's lease
+        assert other is conn
+    assert other.checked_out
+    # The pool itself also refuses a stale lease
+    conn.close(lease=other.lease - 1)
+    assert other.checked_out
+    other.close(lease=other.lease)
+    assert not other.checked_out
+
+
+def test_admin_stats_exposes_pool_counters(client):
+    data = client.get('/admin/stats').get_json()
+    assert {'hits', 'misses', 'waits', 'checkout_seconds_total'} <= set(data['db_pool'])
+    assert {'hits', 'misses', 'hit_rate'} <= set(data['chatbot_context_cache'])
+
+
+def _seed_customers(prefix, count):
+    conn = database.get_pool().acquire()
+    try:
+        conn.executemany(
+            "INSERT INTO customers (name, contact_person, phone, email, creator_id) VALUES (?, ?, ?, ?, 1)",
+            [(f"{prefix}{i:04d}", 'Tester', '000', f'{prefix}{i}@example.com') for i in range(count)]
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def test_customer_listing_is_keyset_paginated(client):
+    """Pages are bounded by per_page and cursors walk the whole filtered result exactly once."""
+    _seed_customers('Paged', 23)
+
+    rendered = []
+    def record(sender, template, context, **extra):
+        rendered.append(context)
+    template_rendered.connect(record, client.application)
+    try:
+        seen = []
+        url = '/customers?search=Paged&per_page=10&sort=name&order=desc'
+        while url:
+            assert client.get(url).status_code == 200
+            page = rendered[-1]['page']
+            assert len(page.rows) <= 10
+            assert page.total == 23
+            seen.extend(row['name'] for row in page.rows)
+            url = None
+            if page.has_next:
+                url = '/customers?' + urlencode(page.url_args(after=page.next_cursor))
+
+        assert seen == sorted((f'Paged{i:04d}' for i in range(23)), reverse=True)
+
+        # Walking backwards from the last page returns the previous page unchanged
+        last = rendered[-1]['page']
+        client.get('/customers?' + urlencode(last.url_args(before=last.prev_cursor)))
+        assert [row['name'] for row in rendered[-1]['page'].rows] == seen[10:20]
+
+        # Tampered cursors are ignored rather than bound as SQL parameters
+        for values in ([{'a': 1}], [[1], 2], [True], ['x', 1, 2]):
+            response = client.get('/customers?' + urlencode({'after': pagination.encode_cursor(values)}))
+            assert response.status_code == 200
+    finally:
+        template_rendered.disconnect(record, client.application)
+
+
+def test_page_count_is_capped(monkeypatch):
+    """Total counts stop at COUNT_CAP so a page never scans the whole table."""
+    monkeypatch.setattr(pagination, 'COUNT_CAP', 3)
+    pagination.clear_count_cache()
+    conn = database.get_pool().acquire()
+    try:
+        assert pagination.count_rows(conn, "SELECT * FROM customers", []) == (3, True)
+    finally:
+        conn.close()
+        pagination.clear_count_cache()
+
+
+def _render_context(client, url):
+    rendered = []
+    def record(sender, template, context, **extra):
+        rendered.append(context)
+    template_rendered.connect(record, client.application)
+    try:
+        assert client.get(url).status_code == 200
+    finally:
+        template_rendered.disconnect(record, client.application)
+    return rendered[0]
+
+
+def _page_total(client, url):
+    match = re.search(r'共 (\d+)\+? 筆', client.get(url).get_data(as_text=True))
+    return int(match.group(1))
+
+
+def test_list_total_updates_after_adding_an_order(client):
+    """The cached listing fragment and the cached row count move to the new data version together."""
+    before = _page_total(client, '/orders')
+    response = client.post('/orders/add', data={'customer_id': '1', 'order_date': '2025-09-01',
+                                                'amount': '10', 'status': '未付款'})
+    assert response.status_code == 302
+    assert _page_total(client, '/orders') == before + 1
+
+
+def test_every_single_row_write_updates_the_list_total(client):
+    """Counts are keyed by the table change counters, so no write path can leave the total stale."""
+    before = _page_total(client, '/customers')
+    client.post('/customers/add', data={'name': '計數客戶', 'contact_person': 'C', 'phone': '1', 'email': 'c@example.com'})
+    assert _page_total(client, '/customers') == before + 1
+    conn = database.get_pool().acquire()
+    try:
+        customer_id = conn.execute("SELECT id FROM customers WHERE name = '計數客戶'").fetchone()[0]
+    finally:
+        conn.close()
+    assert _page_total(client, '/customers?search=計數客戶') == 1
+    client.post(f'/customers/delete/{customer_id}')
+    assert _page_total(client, '/customers') == before
+    assert _page_total(client, '/customers?search=計數客戶') == 0
+
+
+def test_search_index_matches_chinese_substrings(client):
+    """The trigram index finds customers by a substring of their Chinese name and stays in sync."""
+    conn = database.get_pool().acquire()
+    try:
+        cur = conn.execute("INSERT INTO customers (name, contact_person, phone, email, creator_id) VALUES ('宏達電子股份有限公司', '陳經理', '0912-345678', 'htc@example.com', 1)")
+        customer_id = cur.lastrowid
+        order_id = conn.execute("INSERT INTO orders (customer_id, order_date, amount, status, creator_id) VALUES (?, '2025-08-01', 100, '未付款', 1)", (customer_id,)).lastrowid
+        conn.commit()
+
+        names = [row['name'] for row in _render_context(client, '/customers?search=宏達電子')['customers']]
+        assert '宏達電子股份有限公司' in names
+        ctx = _render_context(client, '/orders?search=宏達電子')
+        assert ctx['page'].args['sort'] == 'relevance'
+        assert order_id in [row['id'] for row in ctx['orders']]
+        assert [row['id'] for row in _render_context(client, f'/orders?search={order_id}')['orders']][0] == order_id
+
+        # Renaming the customer re-indexes its orders; deleting removes it from the index
+        conn.execute("UPDATE customers SET name = '聯發科技' WHERE id = ?", (customer_id,))
+        conn.commit()
+        assert order_id not in [row['id'] for row in _render_context(client, '/orders?search=宏達電子')['orders']]
+        assert order_id in [row['id'] for row in _render_context(client, '/orders?search=聯發科技')['orders']]
+        conn.execute("DELETE FROM orders WHERE id = ?", (order_id,))
+        conn.execute("DELETE FROM customers WHERE id = ?", (customer_id,))
+        conn.commit()
+        assert conn.execute("SELECT COUNT(*) FROM customers_fts WHERE rowid = ?", (customer_id,)).fetchone()[0] == 0
+        assert conn.execute("SELECT COUNT(*) FROM orders_fts WHERE rowid = ?", (order_id,)).fetchone()[0] == 0
+    finally:
+        conn.close()
+
+
+def test_short_search_terms_fall_back_to_like(client):
+    """Terms shorter than a trigram still match through the LIKE fallback."""
+    names = [row['name'] for row in _render_context(client, '/customers?search=Te')['customers']]
+    assert 'TechCorp' in names
+
+
+def test_sales_summaries_track_writes(client):
+    """Summary tables follow inserts, updates and deletes and match a full recompute."""
+    import random
+    import summaries
+    rng = random.Random(5)
+    conn = database.get_pool().acquire()
+    try:
+        customer_ids = [row[0] for row in conn.execute("SELECT id FROM customers")]
+        order_ids = []
+        for _ in range(60):
+            order_ids.append(conn.execute(
+                "INSERT INTO orders (customer_id, order_date, amount, status, creator_id) VALUES (?, '2025-09-01', ?, ?, 1)",
+                (rng.choice(customer_ids), round(rng.uniform(10, 5000), 2), rng.choice(['未付款', '已付款', '取消']))
+            ).lastrowid)
+            conn.execute(
+                "INSERT INTO quotes (customer_id, quote_date, amount, status, creator_id) VALUES (?, '2025-09-01', ?, ?, 1)",
+                (rng.choice(customer_ids), round(rng.uniform(10, 5000), 2), rng.choice(['草稿', '已接受', '已轉換']))
+            )
+        for order_id in order_ids[:20]:
+            conn.execute("UPDATE orders SET amount = amount * 2, status = '已付款', customer_id = ? WHERE id = ?",
+                         (rng.choice(customer_ids), order_id))
+        conn.execute("DELETE FROM orders WHERE id IN (%s)" % ",".join(map(str, order_ids[20:30])))
+        conn.execute("UPDATE quotes SET status = '已轉換' WHERE status = '已接受'")
+        conn.commit()
+
+        assert summaries.check_summaries(conn) == []
+
+        overview = summaries.sales_overview(conn)
+        count, revenue = conn.execute("SELECT COUNT(*), SUM(amount) FROM orders").fetchone()
+        assert overview['sales_summary']['total_orders'] == count
+        assert abs(overview['sales_summary']['total_revenue'] - revenue) < 1e-6
+        expected_top = conn.execute('SELECT c.name, SUM(o.amount) AS total_spent FROM orders o JOIN customers c ON o.customer_id = c.id GROUP BY c.name ORDER BY total_spent DESC LIMIT 5').fetchall()
+        assert [row['name'] for row in overview['top_customers']] == [row['name'] for row in expected_top]
+        expected_status = conn.execute('SELECT status, COUNT(*) as count FROM orders GROUP BY status').fetchall()
+        assert [tuple(row) for row in overview['order_status_distribution']] == [tuple(row) for row in expected_status]
+
+        # Drift is detected by the checker and repaired by a rebuild
+        conn.execute("UPDATE order_status_summary SET order_count = order_count + 1")
+        conn.commit()
+        assert summaries.check_summaries(conn)
+        summaries.rebuild_summaries(conn)
+        assert summaries.check_summaries(conn) == []
+    finally:
+        conn.close()
+
+    assert client.get('/analysis').status_code == 200
+
+
+def _login_as_regular_user(client, employee_id):
+    conn = database.get_pool().acquire()
+    try:
+        conn.execute("INSERT OR IGNORE INTO users (employee_id, password, name, role) VALUES (?, 'pw', 'Exporter', 'user')", (employee_id,))
+        conn.commit()
+        user_id = conn.execute("SELECT id FROM users WHERE employee_id = ?", (employee_id,)).fetchone()[0]
+    finally:
+        conn.close()
+    client.post('/login', data={'employee_id': employee_id, 'password': 'pw'})
+    return user_id
+
+
+def test_export_streams_only_visible_rows(monkeypatch):
+    """Exports apply the list page's creator scope and search, in small fetchmany batches."""
+    monkeypatch.setattr(export, 'EXPORT_BATCH_SIZE', 7)
+    app.config['TESTING'] = True
+    with app.test_client() as client:
+        user_id = _login_as_regular_user(client, 'export-user')
+        conn = database.get_pool().acquire()
+        try:
+            customer_id = conn.execute("INSERT INTO customers (name, creator_id) VALUES ('匯出測試客戶', 1)").lastrowid
+            conn.executemany(
+                "INSERT INTO orders (customer_id, order_date, amount, status, creator_id) VALUES (?, '2024-06-01', ?, ?, ?)",
+                [(customer_id, i, '已付款' if i % 2 else '未付款', user_id if i < 30 else 1) for i in range(40)]
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+        response = client.get('/export/orders?search=匯出測試')
+        assert response.mimetype == 'text/csv'
+        lines = response.data.decode('utf-8-sig').splitlines()
+        assert lines[0] == 'id,customer_id,customer_name,order_date,amount,status,creator_id'
+        assert len(lines) == 31
+        assert all(line.endswith(f',{user_id}') for line in lines[1:])
+
+        response = client.get('/export/orders?search=未付款&format=ndjson&gzip=1')
+        assert response.mimetype == 'application/gzip'
+        rows = [json.loads(line) for line in gzip.decompress(response.data).decode('utf-8').splitlines()]
+        assert len(rows) == 15
+        assert {row['status'] for row in rows} == {'未付款'}
+        assert [row['id'] for row in rows] == sorted(row['id'] for row in rows)
+
+
+def test_export_response_is_streamed():
+    """The export body is produced incrementally, not rendered up front."""
+    app.config['TESTING'] = True
+    with app.test_client() as client:
+        client.post('/login', data={'employee_id': '1', 'password': '1'})
+        response = client.get('/export/customers?format=ndjson', buffered=False)
+        assert response.is_streamed
+        first = next(iter(response.response))
+        assert first.decode('utf-8').startswith('{"id": ')
+        response.close()
+
+
+def _metric(text, name):
+    return float(next(line.rsplit(' ', 1)[1] for line in text.splitlines() if line.startswith(name + ' ')))
+
+
+def test_metrics_endpoint_reports_routes_sql_and_templates(client):
+    metrics.registry.reset()
+    for _ in range(3):
+        assert client.get('/orders').status_code == 200
+
+    text = client.get('/metrics').get_data(as_text=True)
+    assert _metric(text, 'sales_http_requests_total{endpoint="orders",method="GET",status="200"}') == 3
+    assert _metric(text, 'sales_http_request_duration_seconds_count{endpoint="orders"}') == 3
+    assert _metric(text, 'sales_http_request_duration_seconds_bucket{endpoint="orders",le="+Inf"}') == 3
+    assert _metric(text, 'sales_sql_statements_per_request_sum{endpoint="orders"}') >= 3
+    assert _metric(text, 'sales_sql_seconds_per_request_sum{endpoint="orders"}') > 0
+    assert _metric(text, 'sales_template_render_seconds_count{template="orders.html"}') == 3
+    assert 'sales_db_pool_open_connections ' in text
+
+
+def test_metrics_endpoint_is_limited_to_admins_or_local_scrapers():
+    app.config['TESTING'] = True
+    with app.test_client() as anonymous:
+        # Off by default: a proxy on the same host would otherwise expose /metrics to everyone
+        assert anonymous.get('/metrics').status_code == 401
+        app.config['METRICS_ALLOW_LOCAL'] = True
+        try:
+            assert anonymous.get('/metrics', environ_base={'REMOTE_ADDR': '10.1.2.3'}).status_code == 401
+            assert anonymous.get('/metrics', headers={'X-Forwarded-For': '10.1.2.3'}).status_code == 401
+            assert anonymous.get('/metrics').status_code == 200
+        finally:
+            app.config['METRICS_ALLOW_LOCAL'] = False
+
+
+def test_batch_quote_conversion_reports_per_quote_results_and_is_idempotent():
+    app.config['TESTING'] = True
+    with app.test_client() as client:
+        user_id = _login_as_regular_user(client, 'convert-user')
+        conn = database.get_pool().acquire()
+        try:
+            customer_id = conn.execute("INSERT INTO customers (name, creator_id) VALUES ('批次轉換客戶', 1)").lastrowid
+            quote = "INSERT INTO quotes (customer_id, quote_date, amount, status, creator_id) VALUES (?, '2025-03-01', ?, ?, ?)"
+            own = [conn.execute(quote, (customer_id, 100 + i, '已接受', user_id)).lastrowid for i in range(2)]
+            others = conn.execute(quote, (customer_id, 300, '已接受', 1)).lastrowid
+            draft = conn.execute(quote, (customer_id, 400, '草稿', user_id)).lastrowid
+            conn.commit()
+        finally:
+            conn.close()
+
+        requested = own + [others, draft, 999999999, own[0]]
+        first = client.post('/quotes/convert_batch', json={'quote_ids': requested}).get_json()
+        assert [(item['quote_id'], item['result']) for item in first['results']] == [
+            (own[0], 'converted'), (own[1], 'converted'), (others, 'forbidden'),
+            (draft, 'not_accepted'), (999999999, 'not_found')]
+        assert first['counts'] == {'converted': 2, 'forbidden': 1, 'not_accepted': 1, 'not_found': 1}
+
+        # A retried request points at the same orders instead of creating new ones
+        retry = client.post('/quotes/convert_batch', json={'quote_ids': requested}).get_json()
+        assert [item['result'] for item in retry['results'][:2]] == ['already_converted'] * 2
+        assert [item['order_id'] for item in retry['results'][:2]] == [item['order_id'] for item in first['results'][:2]]
+
+        conn = database.get_pool().acquire()
+        try:
+            new_quote = conn.execute(quote, (customer_id, 500, '已接受', user_id)).lastrowid
+            conn.commit()
+        finally:
+            conn.close()
+        by_filter = client.post('/quotes/convert_batch', json={'filter': {'search': '批次轉換'}}).get_json()
+        assert [(item['quote_id'], item['result']) for item in by_filter['results']] == [(new_quote, 'converted')]
+        assert client.post('/quotes/convert_batch', json={'quote_ids': ['x']}).status_code == 400
+        for bad_filter in ({'search': 123}, {'date_from': ['2025-01-01']}, {'date_to': {'x': 1}}):
+            response = client.post('/quotes/convert_batch', json={'filter': bad_filter})
+            assert response.status_code == 400 and '必須是文字' in response.get_json()['error']
+
+        conn = database.get_pool().acquire()
+        try:
+            orders = conn.execute("SELECT source_quote_id, amount, status, creator_id FROM orders WHERE customer_id = ? ORDER BY source_quote_id",
+                                  (customer_id,)).fetchall()
+            assert [tuple(row) for row in orders] == [(own[0], 100, '未付款', user_id), (own[1], 101, '未付款', user_id),
+                                                      (new_quote, 500, '未付款', user_id)]
+            statuses = dict(conn.execute("SELECT id, status FROM quotes WHERE customer_id = ?", (customer_id,)).fetchall())
+            assert statuses == {own[0]: '已轉換', own[1]: '已轉換', others: '已接受', draft: '草稿', new_quote: '已轉換'}
+        finally:
+            conn.close()
+
+        response = client.post('/quotes/convert_batch', data={'quote_ids': [str(others)]})
+        assert response.status_code == 302
+        assert client.post(f'/quotes/convert_to_order/{own[0]}').headers['Location'].endswith('/automation')
+        assert client.get('/automation?search=批次轉換').status_code == 200
+
+
+def test_list_pages_answer_conditional_gets_from_table_versions(client):
+    import conditional
+    conditional.stats.reset()
+    first = client.get('/orders?sort=date')
+    assert first.status_code == 200 and first.headers['Cache-Control'] == 'private, no-cache'
+    etag = first.headers['ETag']
+    rendered = []
+    def record(sender, template, context, **extra):
+        rendered.append(template.name)
+    template_rendered.connect(record, app)
+    try:
+        repeat = client.get('/orders?sort=date', headers={'If-None-Match': etag})
+    finally:
+        template_rendered.disconnect(record, app)
+    assert repeat.status_code == 304 and repeat.data == b'' and rendered == []
+
+    # Different query args or a different user get their own ETag
+    assert client.get('/orders?sort=id', headers={'If-None-Match': etag}).status_code == 200
+    with app.test_client() as other:
+        _login_as_regular_user(other, 'etag-user')
+        assert other.get('/orders?sort=date', headers={'If-None-Match': etag}).status_code == 200
+
+    # Writing to a table the page depends on changes the ETag; unrelated tables don't
+    conn = database.get_pool().acquire()
+    try:
+        conn.execute("UPDATE users SET name = name WHERE employee_id = 'etag-user'")
+        conn.commit()
+        assert client.get('/orders?sort=date', headers={'If-None-Match': etag}).status_code == 304
+        conn.execute("UPDATE customers SET phone = phone WHERE id = (SELECT MIN(id) FROM customers)")
+        conn.commit()
+    finally:
+        conn.close()
+    assert client.get('/orders?sort=date', headers={'If-None-Match': etag}).status_code == 200
+
+    analysis = client.get('/analysis')
+    assert client.get('/analysis', headers={'If-None-Match': analysis.headers['ETag']}).status_code == 304
+
+    snapshot = client.get('/admin/stats').get_json()['conditional_get']
+    assert snapshot['endpoints']['orders'] == {'checks': 6, 'not_modified': 2, 'hit_rate': 2 / 6}
+    assert snapshot['not_modified'] == 3
+
+
+def test_list_fragments_are_cached_until_their_tables_change(client):
+    import fragments
+    fragments.fragment_cache.clear()
+    rendered = []
+    def record(sender, template, context, **extra):
+        rendered.append(template.name)
+    template_rendered.connect(record, app)
+    try:
+        first = client.get('/quotes?sort=date&order=desc').get_data(as_text=True)
+        assert '_quotes_listing.html' in rendered
+        rendered.clear()
+        second = client.get('/quotes?sort=date&order=desc').get_data(as_text=True)
+        assert rendered == ['quotes.html'] and second == first
+
+        conn = database.get_pool().acquire()
+        try:
+            conn.execute("UPDATE quotes SET amount = amount WHERE id = (SELECT MIN(id) FROM quotes)")
+            conn.commit()
+        finally:
+            conn.close()
+        rendered.clear()
+        client.get('/quotes?sort=date&order=desc')
+        assert '_quotes_listing.html' in rendered
+    finally:
+        template_rendered.disconnect(record, app)
+
+    stats = client.get('/admin/stats').get_json()['fragment_cache']
+    assert stats['hits'] >= 1 and stats['invalidations'] >= 1 and stats['bytes'] > 0
+
+
+def test_fragment_cache_is_bounded_by_bytes_and_shared_through_disk(tmp_path):
+    import cache
+    path = str(tmp_path / 'fragments.db')
+    builds = []
+    def build(value):
+        builds.append(value)
+        return value
+
+    first = cache.FragmentCache(max_bytes=4000, disk=cache.DiskStore(path))
+    for i in range(5):
+        first.get_or_build(('page', i), (1,), lambda: build('x' * 900))
+    stats = first.stats()
+    assert stats['bytes'] <= 4000 and stats['evictions'] == 1 and stats['entries'] == 4
+
+    # Another worker process finds the entry on disk; a new version is rebuilt
+    second = cache.FragmentCache(max_bytes=4000, disk=cache.DiskStore(path))
+    builds.clear()
+    assert second.get_or_build(('page', 0), (1,), lambda: build('rebuilt')) == 'x' * 900
+    assert second.get_or_build(('page', 0), (2,), lambda: build('rebuilt')) == 'rebuilt'
+    assert builds == ['rebuilt'] and second.stats()['disk_hits'] == 1
+
+    store = cache.DiskStore(path, max_bytes=3000)
+    assert store.trim() > 0 and store.stats()['bytes'] <= 3000
+
+    # Truncated or stale pickles count as misses instead of failing the request
+    broken = cache.DiskStore(str(tmp_path / 'broken.db'))
+    broken.put(('page', 'truncated'), (1,), 'x')
+    broken.put(('page', 'stale'), (1,), 'x')
+    conn = sqlite3.connect(broken.path)
+    conn.execute("UPDATE fragments SET value = ? WHERE key = ?", (b'\x80\x05', repr(('page', 'truncated'))))
+    conn.execute("UPDATE fragments SET value = ? WHERE key = ?", (b'cnot_a_module\nX\n.', repr(('page', 'stale'))))
+    conn.commit()
+    conn.close()
+    assert broken.get(('page', 'truncated'), (1,)) is cache._MISSING
+    assert broken.get(('page', 'stale'), (1,)) is cache._MISSING
+    assert broken.stats()['errors'] == 2
+
+
+def test_chatbot_jobs_are_bounded_and_do_not_block_other_requests(monkeypatch):
+    import app as app_module
+    import jobs
+    runner = jobs.JobRunner(llm_threads=1, llm_queue=1, scoring_processes=0)
+    monkeypatch.setattr(jobs, 'runner', runner)
+    release = threading.Event()
+    def slow_reply(message, history=None, summary=None):
+        release.wait(10)
+        yield '慢'
+        yield '回覆'
+    monkeypatch.setattr(app_module, 'stream_chatbot_response', slow_reply)
+
+    app.config['TESTING'] = True
+    try:
+        with app.test_client() as client:
+            client.post('/login', data={'employee_id': '1', 'password': '1'})
+            queued = [client.post('/chatbot_jobs', json={'message': f'問題 {i}'}) for i in range(2)]
+            assert [r.status_code for r in queued] == [202, 202]
+            busy = client.post('/chatbot_jobs', json={'message': '問題 2'})
+            assert busy.status_code == 503 and busy.headers['Retry-After'] == '2'
+
+            # Both LLM slots are taken, but ordinary pages still answer
+            assert client.get('/orders').status_code == 200
+            status_url = queued[0].get_json()['status_url']
+            assert client.get(status_url).get_json()['status'] in (jobs.QUEUED, jobs.RUNNING)
+
+            release.set()
+            for response in queued:
+                runner.wait(response.get_json()['job_id'], 5)
+            job = client.get(status_url).get_json()
+            assert job['status'] == jobs.DONE and job['output'] == '慢回覆' and job['result'] == '慢回覆'
+            assert client.get(status_url + '?since=1').get_json()['output'] == '回覆'
+
+            _login_as_regular_user(client, 'job-viewer')
+            assert client.get(status_url).status_code == 404
+
+        stats = runner.stats()['llm']
+        assert stats['completed'] == 2 and stats['rejected'] == 1 and stats['in_flight'] == 0
+    finally:
+        release.set()
+        runner.shutdown()
+
+
+def test_ai_features_scores_customers_on_the_job_pool(client, monkeypatch):
+    import app as app_module
+    import jobs
+    import scoring
+    runner = jobs.JobRunner(scoring_processes=0)
+    monkeypatch.setattr(jobs, 'runner', runner)
+    monkeypatch.setattr(app_module, 'AI_FEATURES_WAIT_SECONDS', 10)
+    try:
+        page = client.get('/ai_features')
+        assert page.status_code == 200
+        scored, _ = scoring.score_database(database.DB_PATH)
+        assert scored[0]['name'] in page.get_data(as_text=True)
+
+        # Same data version: the finished job is reused instead of scoring again
+        client.get('/ai_features')
+        assert runner.stats()['scoring']['submitted'] == 1
+    finally:
+        runner.shutdown()
+
+
+def test_concurrent_submits_with_the_same_dedup_key_start_one_job(monkeypatch):
+    import time
+    import jobs
+    runner = jobs.JobRunner(scoring_processes=0)
+    pool = runner.pools['scoring']
+    admit = pool.admit
+    def slow_admit():
+        admit()
+        time.sleep(0.05)  # widen the window between the lookup and the insert
+    monkeypatch.setattr(pool, 'admit', slow_admit)
+    key = f'scoring:concurrent:{time.time()}'
+    barrier = threading.Barrier(4)
+    ids = []
+    def submit():
+        barrier.wait()
+        ids.append(runner.submit('scoring', sum, [1, 2], dedup_key=key))
+    try:
+        threads = [threading.Thread(target=submit) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        assert len(ids) == 4 and len(set(ids)) == 1
+        assert runner.stats()['scoring']['submitted'] == 1
+        runner.wait(ids[0], 5)
+        assert runner.get(ids[0])['result'] == 3
+    finally:
+        runner.shutdown()
+
+
+def test_write_queue_group_commits_and_isolates_failures(tmp_path, monkeypatch):
+    import write_queue
+    path = str(tmp_path / 'writes.db')
+    monkeypatch.setattr(database, 'DB_PATH', path)
+    database.init_db()
+    database.migrate_db()
+    writer = write_queue.WriteQueue(path, max_delay_ms=100, durability='full')
+    insert = "INSERT INTO customers (name, contact_person, phone, email, creator_id) VALUES (?, '-', '-', '-', 1)"
+    try:
+        futures = [writer.submit(insert, (f'批次客戶 {i}',)) for i in range(20)]
+        duplicate = writer.submit("INSERT INTO customers (id, name, creator_id) VALUES (?, 'dup', 1)", (1,))
+        futures.append(writer.submit("UPDATE customers SET phone = '123' WHERE name LIKE '批次客戶 1%'"))
+        ids = [future.result(5) for future in futures[:20]]
+        assert futures[20].result(5) == 11
+        with pytest.raises(sqlite3.IntegrityError):
+            duplicate.result(5)
+
+        conn = sqlite3.connect(path)
+        rows = dict(conn.execute("SELECT id, name FROM customers WHERE name LIKE '批次客戶 %'").fetchall())
+        conn.close()
+        assert rows == {row_id: f'批次客戶 {i}' for i, row_id in enumerate(ids)}
+        stats = writer.stats()
+        assert stats['committed'] == 21 and stats['failed'] == 1 and stats['batches'] < 22
+    finally:
+        writer.close()
+
+
+def test_write_queue_fails_pending_writes_and_restarts_after_thread_dies(tmp_path, monkeypatch):
+    import write_queue
+    path = str(tmp_path / 'writer-crash.db')
+    monkeypatch.setattr(database, 'DB_PATH', path)
+    database.init_db()
+    database.migrate_db()
+    writer = write_queue.WriteQueue(path, durability='full')
+    insert = "INSERT INTO customers (name, creator_id) VALUES (?, 1)"
+    connect = writer._connect
+    commit = writer._commit
+    try:
+        # 連不上資料庫：寫入立即失敗，不必等 WAIT_SECONDS
+        writer._connect = lambda: (_ for _ in ()).throw(sqlite3.OperationalError('unable to open database file'))
+        with pytest.raises(sqlite3.OperationalError):
+            writer.submit(insert, ('連線失敗',)).result(5)
+
+        # commit 途中出現非 sqlite3 的例外：這一批與佇列中的寫入都失敗
+        writer._connect = connect
+        def crash(conn, batch):
+            writer._commit = commit
+            raise RuntimeError('writer crashed')
+        writer._commit = crash
+        with pytest.raises(RuntimeError):
+            writer.submit(insert, ('執行緒中斷',)).result(5)
+
+        # 下一次寫入重新啟動執行緒
+        assert writer.write(insert, ('重新啟動',)) > 0
+        assert writer.stats()['failed'] == 2
+    finally:
+        writer.close()
+
+
+def test_add_routes_write_behind_through_the_queue(client, monkeypatch):
+    import write_queue
+    writer = write_queue.WriteQueue(database.DB_PATH)
+    monkeypatch.setattr(write_queue, 'ENABLED', True)
+    monkeypatch.setattr(write_queue, 'writer', writer)
+    try:
+        response = client.post('/customers/add', data={'name': '佇列客戶', 'contact_person': 'Q',
+                                                       'phone': '1', 'email': 'q@example.com'})
+        assert response.status_code == 302
+        conn = database.get_pool().acquire()
+        try:
+            assert conn.execute("SELECT COUNT(*) FROM customers WHERE name = '佇列客戶'").fetchone()[0] == 1
+        finally:
+            conn.close()
+        assert client.get('/admin/stats').get_json()['write_queue']['committed'] == 1
+
+        # Even in deferred mode, user accounts are written synchronously so duplicates are reported
+        writer.durability = 'deferred'
+        client.post('/users/add', data={'employee_id': '1', 'password': 'x', 'name': 'Dup', 'role': 'user'})
+        with client.session_transaction() as session:
+            assert session['_flashes'][-1][1] == '員工ID已存在，請使用其他ID。'
+        assert writer.stats()['submitted'] == 1
+    finally:
+        writer.close()
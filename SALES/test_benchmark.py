@@ -0,0 +1,73 @@
+import copy
+import os
+import subprocess
+import sys
+import benchmark
+import database
+import generate_data
+import scoring
+from app import app
+
+
+def test_load_run_covers_every_route_and_detects_regressions(tmp_path, monkeypatch):
+    path = str(tmp_path / "bench.db")
+    monkeypatch.setattr(database, "DB_PATH", path)
+    database.init_db()
+    database.migrate_db()
+    conn = database.connect()
+    generate_data.generate(conn, users=3, customers=50, orders=500, quotes=100, reset=True, log=lambda message: None)
+    conn.close()
+
+    result = benchmark.run_load(app, path, clients=3, duration=1.5, warmup=0.2, llm_delay=0.0)
+    assert set(result['routes']) == {name for name, _, _, _ in benchmark.SCENARIO}
+    assert result['total']['requests'] > 0
+    assert result['total']['errors'] == 0
+    assert result['total']['p50_ms'] <= result['total']['p95_ms'] <= result['total']['p99_ms']
+
+    # 樣本數放大，讓 p95 也納入比較
+    result['total']['requests'] = 1000
+    results = {'sizes': {'tiny': result}}
+    assert benchmark.compare(results, copy.deepcopy(results)) == []
+
+    slower = copy.deepcopy(results)
+    slower['sizes']['tiny']['total']['p95_ms'] = result['total']['p95_ms'] * 2 + 100
+    slower['sizes']['tiny']['total']['throughput'] = result['total']['throughput'] / 2
+    regressions = benchmark.compare(slower, results)
+    assert any('tiny/total p95_ms' in line for line in regressions)
+    assert any('tiny/total throughput' in line for line in regressions)
+
+
+def test_startup_measurement_and_lazy_imports():
+    startup = benchmark.measure_startup(runs=1)
+    assert set(startup) == {'current_schema', 'new_database'}
+    assert all(stats['import_ms'] > 0 and stats['process_ms'] >= stats['import_ms'] for stats in startup.values())
+
+    # numpy 與 requests 要等到第一次評分或呼叫 LLM 時才載入
+    probe = "import sys, app; print(sorted(m for m in ('numpy', 'requests') if m in sys.modules))"
+    output = subprocess.run([sys.executable, '-c', probe], cwd=os.path.dirname(benchmark.__file__),
+                            capture_output=True, text=True, check=True).stdout
+    assert output.strip() == '[]'
+
+
+def test_concurrent_worker_processes_lose_no_writes():
+    stress = benchmark.stress_workers(workers=3, writes=30)
+    assert stress['requests'] > 0
+    assert stress['errors'] == 0, stress['error_samples']
+    assert stress['lost'] == 0
+    assert stress['busy_failures'] == 0
+
+
+def test_scoring_latency_is_recorded_and_checked_against_budget():
+    scored = benchmark.measure_scoring(orders=20_000, customers=500, runs=1)
+    assert scored['orders'] == 20_000 and scored['median_seconds'] > 0
+    assert scored['target_seconds'] == scoring.TARGET_SECONDS_PER_MILLION_ORDERS
+    assert scored['per_million_seconds'] < scored['budget_seconds']
+
+    results = {'sizes': {}, 'scoring': scored}
+    assert benchmark.compare(results, copy.deepcopy(results)) == []
+    slower = copy.deepcopy(results)
+    slower['scoring']['median_seconds'] = scored['median_seconds'] * 2 + 1
+    slower['scoring']['per_million_seconds'] = scored['budget_seconds'] + 1
+    regressions = benchmark.compare(slower, results)
+    assert any('scoring median_seconds' in line for line in regressions)
+    assert any('scoring per_million_seconds' in line for line in regressions)
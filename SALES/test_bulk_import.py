@@ -0,0 +1,117 @@
+import io
+import json
+import bulk_import
+import database
+import summaries
+from app import app
+
+
+def _fresh_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "import.db"))
+    database.init_db(seed_samples=True)  # 匯入的訂單與報價單要對應到範例客戶
+    database.migrate_db()
+    return database.connect()
+
+
+def test_import_validates_resolves_customers_and_keeps_going(tmp_path, monkeypatch):
+    conn = _fresh_db(tmp_path, monkeypatch)
+    customers_csv = io.BytesIO(
+        "﻿name,contact_person,phone,email\n"
+        "Acme Ltd,Amy,111,amy@acme.test\n"
+        "宏達電子,王小明,222,\n"
+        ",Nobody,333,\n"
+        "Bad Mail,Bob,444,not-an-email\n".encode('utf-8')
+    )
+    result = bulk_import.import_stream(conn, 'customers', customers_csv, 'csv', creator_id=1)
+    assert (result['rows'], result['inserted'], result['rejected']) == (4, 2, 2)
+    assert [r['line'] for r in result['rejects']] == [4, 5]
+    acme_id = conn.execute("SELECT id FROM customers WHERE name = 'Acme Ltd'").fetchone()[0]
+
+    lines = [
+        {'customer_name': 'acme ltd', 'order_date': '2024-01-05', 'amount': 100, 'status': '已付款'},
+        {'customer_id': acme_id, 'order_date': '2024-01-06', 'amount': '250.5', 'status': '未付款'},
+        {'customer_name': '宏達電子', 'order_date': '2024-01-07', 'amount': 30, 'status': '已付款'},
+        {'customer_name': 'Unknown Co', 'order_date': '2024-01-08', 'amount': 1, 'status': '已付款'},
+        {'customer_id': acme_id, 'order_date': '2024-13-01', 'amount': 1, 'status': '已付款'},
+        {'customer_id': acme_id, 'order_date': '2024-01-09', 'amount': -5, 'status': '已付款'},
+    ]
+    payload = "\n".join(json.dumps(line, ensure_ascii=False) for line in lines) + "\n{broken\n"
+    rejected = []
+    result = bulk_import.import_stream(
+        conn, 'orders', io.BytesIO(payload.encode('utf-8')), 'ndjson', creator_id=1,
+        batch_size=2, on_reject=lambda line, error, record: rejected.append(line)
+    )
+    assert (result['rows'], result['inserted'], result['rejected']) == (7, 3, 4)
+    assert sorted(rejected) == [4, 5, 6, 7]
+    assert result['rows_per_second'] > 0
+    assert tuple(conn.execute("SELECT COUNT(*), SUM(amount) FROM orders WHERE customer_id = ?", (acme_id,)).fetchone()) == (2, 350.5)
+    # trigger 維護的彙總表與搜尋索引也跟著更新
+    assert summaries.check_summaries(conn) == []
+    conn.close()
+
+
+def test_upload_route_requires_login_and_reports_json(tmp_path, monkeypatch):
+    _fresh_db(tmp_path, monkeypatch).close()
+    app.config['TESTING'] = True
+    data = "customer_id,quote_date,amount,status\n1,2024-02-01,99.5,草稿\n999999,2024-02-01,1,草稿\n"
+    with app.test_client() as client:
+        response = client.post('/import/quotes', data={'file': (io.BytesIO(data.encode()), 'quotes.csv')},
+                               headers={'Accept': 'application/json'})
+        assert response.status_code == 401
+
+        client.post('/login', data={'employee_id': '1', 'password': '1'})
+        response = client.post('/import/quotes', data={'file': (io.BytesIO(data.encode()), 'quotes.csv')},
+                               headers={'Accept': 'application/json'})
+        result = response.get_json()
+        assert (result['inserted'], result['rejected']) == (1, 1)
+        assert result['rejects'] == [{'line': 3, 'error': '找不到客戶 ID: 999999'}]
+
+
+def test_cli_writes_rejects_file(tmp_path, monkeypatch, capsys):
+    _fresh_db(tmp_path, monkeypatch).close()
+    source = tmp_path / "customers.ndjson"
+    source.write_text('{"name": "CLI Co"}\n{"name": ""}\n', encoding='utf-8')
+    rejects = tmp_path / "rejects.ndjson"
+    assert bulk_import.main(['customers', str(source), '--rejects', str(rejects)]) == 2
+    assert json.loads(rejects.read_text(encoding='utf-8'))['error'] == '缺少 name'
+    assert '成功 1 筆，拒絕 1 筆' in capsys.readouterr().out
+
+
+def test_upload_rejects_undecodable_files_before_writing(tmp_path, monkeypatch):
+    conn = _fresh_db(tmp_path, monkeypatch)
+    before = conn.execute("SELECT COUNT(*) FROM quotes").fetchone()[0]
+    conn.close()
+    # 第一行可以解碼，第三行是 Big5：用預設的 UTF-8 上傳時整個檔案都不寫入
+    data = "customer_id,quote_date,amount,status\n1,2024-02-01,10,草稿\n".encode() + "1,2024-02-02,20,草稿\n".encode('big5')
+    app.config['TESTING'] = True
+    with app.test_client() as client:
+        client.post('/login', data={'employee_id': '1', 'password': '1'})
+        response = client.post('/import/quotes', data={'file': (io.BytesIO(data), 'quotes.csv')},
+                               headers={'Accept': 'application/json'})
+        assert response.status_code == 400 and '第 3 行' in response.get_json()['error']
+        conn = database.connect()
+        assert conn.execute("SELECT COUNT(*) FROM quotes").fetchone()[0] == before
+
+        response = client.post('/import/quotes', data={'file': (io.BytesIO(data), 'quotes.csv'), 'encoding': 'big5'},
+                               headers={'Accept': 'application/json'})
+        assert response.status_code == 400  # 第二行的「草稿」是 UTF-8，不是 Big5
+        big5 = "customer_id,quote_date,amount,status\n1,2024-02-02,20,草稿\n".encode('cp950')
+        response = client.post('/import/quotes', data={'file': (io.BytesIO(big5), 'quotes.csv'), 'encoding': 'cp950'},
+                               headers={'Accept': 'application/json'})
+        assert response.get_json()['inserted'] == 1
+        assert conn.execute("SELECT status FROM quotes ORDER BY id DESC LIMIT 1").fetchone()[0] == '草稿'
+        conn.close()
+
+
+def test_cli_does_not_seed_sample_data_into_a_new_database(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "production.db"))
+    monkeypatch.setattr(database, "SEED_DEMO_DATA", False)
+    source = tmp_path / "customers.ndjson"
+    source.write_text('{"name": "CLI Co"}\n', encoding='utf-8')
+    assert bulk_import.main(['customers', str(source)]) == 0
+    conn = database.connect()
+    try:
+        assert [row[0] for row in conn.execute("SELECT name FROM customers")] == ['CLI Co']
+        assert conn.execute("SELECT COUNT(*) FROM orders").fetchone()[0] == 0
+    finally:
+        conn.close()
@@ -0,0 +1,61 @@
+import chat_history
+import chatbot
+import database
+from app import app
+from llm_stub import StubLLMServer
+
+
+def _fresh_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "chat.db"))
+    database.init_db()
+    database.migrate_db()
+    return database.connect()
+
+
+def test_window_keeps_recent_turns_within_budget_and_summarises_the_rest(tmp_path, monkeypatch):
+    conn = _fresh_db(tmp_path, monkeypatch)
+    conversation_id = chat_history.create_conversation(conn, 1)
+    for i in range(10):
+        chat_history.append_message(conn, conversation_id, 'user', f"問題 {i} " + "x" * 40)
+        chat_history.append_message(conn, conversation_id, 'assistant', f"回答 {i} " + "y" * 40)
+
+    messages, summary = chat_history.context_window(conn, conversation_id, token_budget=80)
+    assert [m['content'][:4] for m in messages] == ['問題 8', '回答 8', '問題 9', '回答 9']
+    assert messages[0]['role'] == 'user' and messages[-1]['role'] == 'assistant'
+    # 視窗之前的訊息被摘要，而且摘要只保留在預算內的最新部分
+    assert '回答 7' in summary and '問題 8' not in summary
+    assert chat_history.estimate_tokens(summary) <= chat_history.SUMMARY_TOKEN_BUDGET
+
+    # 摘要是累進的：已摘要的訊息不會重複處理
+    chat_history.append_message(conn, conversation_id, 'user', "問題 10 " + "x" * 40)
+    chat_history.append_message(conn, conversation_id, 'assistant', "回答 10 " + "y" * 40)
+    _, summary = chat_history.context_window(conn, conversation_id, token_budget=80)
+    assert summary.count('回答 7') == 1 and '回答 8' in summary
+    conn.close()
+
+
+def test_history_is_stored_server_side_and_sent_upstream(tmp_path, monkeypatch):
+    _fresh_db(tmp_path, monkeypatch).close()
+    app.config['TESTING'] = True
+    replies = iter(["第一個回答", "第二個回答"])
+    with StubLLMServer(reply=lambda payload: next(replies)) as stub, app.test_client() as client:
+        monkeypatch.setattr(chatbot, "DEEPSEEK_API_URL", stub.url)
+        client.post('/login', data={'employee_id': '1', 'password': '1'})
+
+        assert client.post('/chatbot_api', json={'message': '第一個問題'}).get_json()['response'] == "第一個回答"
+        assert client.post('/chatbot_api', json={'message': '第二個問題'}).get_json()['response'] == "第二個回答"
+
+        # 第二次呼叫帶著上一輪的對話
+        second = stub.requests[1]['messages']
+        assert [(m['role'], m['content']) for m in second[1:3]] == [('user', '第一個問題'), ('assistant', '第一個回答')]
+
+        # session 只有對話 id
+        with client.session_transaction() as sess:
+            assert 'chatbot_history' not in sess
+            assert len(sess['chatbot_conversation']) == 32
+
+        page = client.get('/get_chatbot_history?limit=3').get_json()
+        assert [m['content'] for m in page['history']] == ['第一個回答', '第二個問題', '第二個回答']
+        older = client.get(f"/get_chatbot_history?limit=3&before={page['next_before']}").get_json()
+        assert [m['content'] for m in older['history']] == ['第一個問題']
+        assert older['next_before'] is None
@@ -0,0 +1,207 @@
+import datetime
+import json
+import chat_context
+import chatbot
+import database
+from app import app
+from llm_stub import StubLLMServer
+
+
+def _fresh_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "chatbot.db"))
+    database.init_db()
+    database.migrate_db()
+    conn = database.connect()
+    # 換成測試專用的資料
+    for table in ('orders', 'quotes', 'customers'):
+        conn.execute(f"DELETE FROM {table}")
+    conn.executemany(
+        "INSERT INTO customers (id, name, contact_person, phone, email, creator_id) VALUES (?, ?, 'Tester', '000', 'x@example.com', 1)",
+        [(1, 'TechCorp'), (2, 'Innovate Inc'), (3, '宏達電子股份有限公司'), (4, '宏達科技')]
+        + [(i, f'Filler {i:04d}') for i in range(10, 310)]
+    )
+    conn.executemany(
+        "INSERT INTO orders (id, customer_id, order_date, amount, status, creator_id) VALUES (?, ?, ?, ?, ?, 1)",
+        [
+            (1, 1, '2024-03-05', 1200.0, '已付款'),
+            (2, 1, '2024-04-10', 800.0, '未付款'),
+            (3, 2, '2024-03-07', 99999.0, '已付款'),
+            (4, 3, '2024-03-20', 450.0, '已付款'),
+            (5, 4, '2024-03-21', 300.0, '已付款'),
+        ]
+    )
+    conn.execute("INSERT INTO quotes (id, customer_id, quote_date, amount, status, creator_id) VALUES (7, 2, '2024-03-01', 500.0, '已接受', 1)")
+    conn.commit()
+    return conn
+
+
+def test_entities_are_extracted_from_question(tmp_path, monkeypatch):
+    conn = _fresh_db(tmp_path, monkeypatch)
+    try:
+        entities = chat_context.extract_entities(conn, "宏達電子 2024年3月 已付款的訂單", today=datetime.date(2024, 5, 1))
+        assert entities['customers'] == [{'id': 3, 'name': '宏達電子股份有限公司'}]
+        assert entities['statuses'] == ['已付款']
+        assert entities['date_range'] == ('2024-03-01', '2024-03-31')
+        assert entities['wants_orders'] and not entities['wants_quotes']
+
+        entities = chat_context.extract_entities(conn, "show order #2 and quote 7 for techcorp last month", today=datetime.date(2024, 5, 15))
+        assert entities['order_ids'] == [2]
+        assert entities['quote_ids'] == [7]
+        assert entities['customers'] == [{'id': 1, 'name': 'TechCorp'}]
+        assert entities['date_range'] == ('2024-04-01', '2024-04-30')
+    finally:
+        conn.close()
+
+
+def test_chatbot_sends_only_relevant_rows(tmp_path, monkeypatch):
+    """The prompt contains the asked-about customer's orders, not a dump of the whole database."""
+    _fresh_db(tmp_path, monkeypatch).close()
+    with StubLLMServer(reply="TechCorp 有 2 筆訂單。") as stub:
+        monkeypatch.setattr(chatbot, "DEEPSEEK_API_URL", stub.url)
+        assert chatbot.get_chatbot_response("分析 TechCorp 的訂單狀況。") == "TechCorp 有 2 筆訂單。"
+
+    prompt = stub.requests[0]['messages'][-1]['content']
+    assert '"order_date":"2024-03-05"' in prompt and '"order_date":"2024-04-10"' in prompt
+    assert '99999' not in prompt
+    assert 'Filler' not in prompt
+
+
+def test_context_respects_token_budget(tmp_path, monkeypatch):
+    conn = _fresh_db(tmp_path, monkeypatch)
+    conn.executemany(
+        "INSERT INTO orders (customer_id, order_date, amount, status, creator_id) VALUES (1, '2024-02-01', ?, '已付款', 1)",
+        [(float(i),) for i in range(200)]
+    )
+    conn.commit()
+    conn.close()
+
+    context = chatbot.get_database_context_for_llm("TechCorp 的訂單", token_budget=150)
+    assert chat_context.estimate_tokens(context) <= 160
+    assert '未列出' in context
+    # 彙總數字仍然完整
+    assert '"筆數":202' in context
+
+
+def test_context_is_cached_until_tables_change(tmp_path, monkeypatch):
+    """A burst of questions against an idle dataset builds the context once."""
+    conn = _fresh_db(tmp_path, monkeypatch)
+    built = []
+    original = chat_context.collect_sections
+    monkeypatch.setattr(chat_context, "collect_sections", lambda *a: built.append(1) or original(*a))
+    monkeypatch.setattr(chat_context, "context_cache", chat_context.cache.VersionedCache())
+
+    first = [chatbot.get_database_context_for_llm("TechCorp 的訂單") for _ in range(5)]
+    assert len(built) == 1 and len(set(first)) == 1
+    assert chat_context.context_cache.stats()['hits'] == 4
+
+    # 寫入無關的資料表不會讓快取失效
+    conn.execute("UPDATE users SET name = name")
+    conn.commit()
+    chatbot.get_database_context_for_llm("TechCorp 的訂單")
+    assert len(built) == 1
+
+    conn.execute("INSERT INTO orders (customer_id, order_date, amount, status, creator_id) VALUES (1, '2024-05-01', 77.0, '未付款', 1)")
+    conn.commit()
+    conn.close()
+    assert '"amount":77.0' in chatbot.get_database_context_for_llm("TechCorp 的訂單")
+    assert len(built) == 2
+    assert chat_context.context_cache.stats()['invalidations'] == 1
+
+
+def _sse_events(body):
+    events = []
+    for block in body.decode('utf-8').split('\n\n'):
+        if block.strip():
+            name, data = block.split('\n', 1)
+            events.append((name[len('event: '):], json.loads(data[len('data: '):])))
+    return events
+
+
+def test_streaming_endpoint_relays_tokens_and_saves_history(tmp_path, monkeypatch):
+    _fresh_db(tmp_path, monkeypatch).close()
+    app.config['TESTING'] = True
+    reply = "TechCorp 目前有 2 筆訂單：ID 1 與 ID 2。"
+    with StubLLMServer(reply=reply, chunk_size=3) as stub, app.test_client() as client:
+        monkeypatch.setattr(chatbot, "DEEPSEEK_API_URL", stub.url)
+        client.post('/login', data={'employee_id': '1', 'password': '1'})
+
+        response = client.post('/chatbot_stream', json={'message': '分析 TechCorp 的訂單狀況'})
+        assert response.mimetype == 'text/event-stream'
+        events = _sse_events(response.data)
+
+        assert stub.requests[0]['stream'] is True
+        deltas = [data['content'] for name, data in events if name == 'delta']
+        assert len(deltas) > 1 and ''.join(deltas) == reply
+        assert events[-1] == ('done', {'response': reply})
+
+        history = client.get('/get_chatbot_history').get_json()['history']
+        assert [(m['role'], m['content']) for m in history[-2:]] == [
+            ('user', '分析 TechCorp 的訂單狀況'),
+            ('assistant', reply),
+        ]
+
+
+def test_router_answers_common_questions_without_llm(tmp_path, monkeypatch):
+    _fresh_db(tmp_path, monkeypatch).close()
+    monkeypatch.setattr(chatbot, "router_stats", chatbot.RouterStats())
+    with StubLLMServer(reply="LLM 回覆") as stub:
+        monkeypatch.setattr(chatbot, "DEEPSEEK_API_URL", stub.url)
+
+        reply = chatbot.get_chatbot_response("查詢 TechCorp 的所有訂單")
+        assert reply.startswith("TechCorp（客戶 ID: 1）的訂單共有 2 筆，總金額 2,000.00")
+        assert "訂單 (ID: 2)" in reply and "訂單 (ID: 1)" in reply
+
+        reply = chatbot.get_chatbot_response("how many paid orders in 2024年3月?")
+        assert reply == "狀態為「已付款」，日期在 2024-03-01 至 2024-03-31的訂單共有 4 筆，總金額 101,949.00。"
+
+        reply = chatbot.get_chatbot_response("top customers")
+        assert reply.splitlines()[1].startswith("1. Innovate Inc（客戶 ID: 2）")
+
+        assert "訂單 (ID: 4)" in chatbot.get_chatbot_response("訂單 #4 的狀態？")
+        assert list(chatbot.stream_chatbot_response("報價單 7")) == ["報價單資料如下：\n- 報價單 (ID: 7)｜Innovate Inc（客戶 ID: 2）｜2024-03-01｜500.00｜已接受"]
+
+        # 需要推理的問題交給 LLM
+        assert chatbot.get_chatbot_response("為什麼 TechCorp 的訂單變少了？") == "LLM 回覆"
+
+    assert len(stub.requests) == 1
+    stats = chatbot.router_stats.snapshot()
+    assert stats['messages'] == 6
+    assert stats['hit_rate'] == 5 / 6
+    assert stats['intents'] == {'list_documents': 1, 'count_documents': 1, 'top_customers': 1, 'document_detail': 2}
+    assert stats['paths']['llm']['count'] == 1
+
+
+def test_top_customers_exclude_cancelled_orders_with_or_without_dates(tmp_path, monkeypatch):
+    conn = _fresh_db(tmp_path, monkeypatch)
+    try:
+        conn.executemany(
+            "INSERT INTO orders (customer_id, order_date, amount, status, creator_id) VALUES (?, '2024-03-15', ?, '取消', 1)",
+            [(4, 500000.0), (10, 700000.0)]
+        )
+        conn.commit()
+        for question in ("top customers", "top customers 2024年3月"):
+            reply = chatbot.match_intent(conn, question)[1].splitlines()
+            assert reply[1] == "1. Innovate Inc（客戶 ID: 2）：1 筆訂單，99,999.00"
+            assert any(line.endswith("宏達科技（客戶 ID: 4）：1 筆訂單，300.00") for line in reply)
+            assert not any("Filler 0010" in line for line in reply)
+    finally:
+        conn.close()
+
+
+def test_router_matches_english_keywords_as_whole_words(tmp_path, monkeypatch):
+    conn = _fresh_db(tmp_path, monkeypatch)
+    try:
+        # 'count' inside "account", 'all' inside "small", 'top' inside "desktop" are not keywords
+        assert chatbot.match_intent(conn, "TechCorp account orders") is None
+        assert chatbot.match_intent(conn, "small orders for TechCorp") is None
+        assert chatbot.match_intent(conn, "desktop customers") is None
+        assert chatbot.match_intent(conn, "TechCorp orders by the overall total") is None
+
+        assert chatbot.match_intent(conn, "count TechCorp orders")[0] == 'count_documents'
+        assert chatbot.match_intent(conn, "show all TechCorp orders")[0] == 'list_documents'
+        assert chatbot.match_intent(conn, "列出TechCorp的all訂單")[0] == 'list_documents'
+        assert chatbot.match_intent(conn, "Top 3 customers")[0] == 'top_customers'
+        assert chatbot.match_intent(conn, "TechCorp revenue")[0] == 'sales_total'
+        assert chatbot.match_intent(conn, "analysis of TechCorp orders") is None
+    finally:
+        conn.close()
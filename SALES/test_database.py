@@ -1,5 +1,6 @@
 import sqlite3
 import os
+import pytest
 import database
 
 def test_database_connection():
@@ -81,9 +82,122 @@ def test_quote_data():
     finally:
         conn.close()
 
+def test_migrations_are_versioned(tmp_path, monkeypatch):
+    """Migrations bring a fresh database to SCHEMA_VERSION and re-running is a no-op."""
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "migrate.db"))
+    database.init_db()
+    assert database.migrate_db() == database.SCHEMA_VERSION
+    assert database.migrate_db() == database.SCHEMA_VERSION
+    conn = sqlite3.connect(database.DB_PATH)
+    try:
+        assert database.get_schema_version(conn) == database.SCHEMA_VERSION
+        indexes = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        assert {"idx_orders_creator_date", "idx_orders_customer", "idx_quotes_status_creator", "idx_quotes_customer"} <= indexes
+    finally:
+        conn.close()
+
+def test_summary_trigger_fix_is_a_new_migration(tmp_path, monkeypatch):
+    """A database already past migration 4 gets the non-integer customer_id guard from migration 10."""
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "triggers.db"))
+    monkeypatch.setattr(database, "MIGRATIONS", [m for m in database.MIGRATIONS if m[0] < 10])
+    monkeypatch.setattr(database, "SCHEMA_VERSION", 9)
+    database.init_db()
+    assert database.migrate_db() == 9
+    conn = sqlite3.connect(database.DB_PATH)
+    try:
+        with pytest.raises(sqlite3.IntegrityError):
+            conn.execute("INSERT INTO orders (customer_id, order_date, amount, status) VALUES ('abc', '2025-01-01', 10, '未付款')")
+    finally:
+        conn.close()
+
+    monkeypatch.undo()
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "triggers.db"))
+    assert database.migrate_db() == database.SCHEMA_VERSION
+    conn = sqlite3.connect(database.DB_PATH)
+    try:
+        conn.execute("INSERT INTO orders (customer_id, order_date, amount, status) VALUES ('abc', '2025-01-01', 10, '未付款')")
+        conn.execute("INSERT INTO orders (customer_id, order_date, amount, status) VALUES (1, '2025-01-01', 10, '未付款')")
+        assert conn.execute("SELECT COUNT(*) FROM customer_sales_summary WHERE typeof(customer_id) != 'integer'").fetchone()[0] == 0
+    finally:
+        conn.close()
+
+def test_hot_queries_use_indexes(tmp_path, monkeypatch):
+    """Listing filters and JOINs are answered through the secondary indexes."""
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "plan.db"))
+    database.init_db()
+    database.migrate_db()
+    conn = sqlite3.connect(database.DB_PATH)
+    try:
+        plans = {
+            "orders_by_creator": "SELECT * FROM orders WHERE creator_id = 1 ORDER BY order_date",
+            "quotes_by_status": "SELECT * FROM quotes WHERE status = '已接受' AND creator_id = 1",
+            "orders_by_customer": "SELECT * FROM orders WHERE customer_id = 1",
+        }
+        for name, query in plans.items():
+            detail = " ".join(row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + query))
+            assert "USING INDEX" in detail, f"{name} does not use an index: {detail}"
+    finally:
+        conn.close()
+
+def test_bootstrap_skips_schema_work_when_current(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "boot.db"))
+    assert database.bootstrap(seed_demo_data=False) is True
+    conn = sqlite3.connect(database.DB_PATH)
+    try:
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == database.SCHEMA_VERSION
+        assert conn.execute("SELECT COUNT(*) FROM users WHERE employee_id = '1'").fetchone()[0] == 1
+        assert conn.execute("SELECT COUNT(*) FROM customers").fetchone()[0] == 0  # 沒有要求示範資料
+    finally:
+        conn.close()
+
+    calls = []
+    monkeypatch.setattr(database, "init_db", lambda **kwargs: calls.append('init_db'))
+    monkeypatch.setattr(database, "migrate_db", lambda: calls.append('migrate_db'))
+    assert database.bootstrap(seed_demo_data=True) is False
+    assert calls == []
+
+def test_write_transaction_retries_while_another_process_holds_the_lock(tmp_path, monkeypatch):
+    """BEGIN IMMEDIATE transactions back off and retry on busy errors; other errors are not retried."""
+    import threading
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "busy.db"))
+    monkeypatch.setattr(database, "BUSY_BACKOFF_MS", 5)
+    database.init_db()
+    database.migrate_db()
+    holder = database.connect()
+    holder.execute("BEGIN IMMEDIATE")
+    threading.Timer(0.1, holder.commit).start()
+
+    conn = database.connect()
+    conn.execute("PRAGMA busy_timeout=0")
+    database.write_stats.reset()
+    try:
+        cursor = database.write_transaction(
+            conn, lambda conn: conn.execute("UPDATE users SET name = 'retried' WHERE employee_id = '1'"))
+        assert cursor.rowcount == 1
+        stats = database.write_stats.snapshot()
+        assert stats['busy_retries'] >= 1 and stats['busy_failures'] == 0
+
+        calls = []
+        def fails(conn):
+            calls.append(1)
+            conn.execute("INSERT INTO users (id, employee_id, password, name, role) SELECT id, employee_id, 'x', 'x', 'user' FROM users LIMIT 1")
+        with pytest.raises(sqlite3.IntegrityError):
+            database.write_transaction(conn, fails)
+        assert calls == [1] and not conn.in_transaction
+
+        holder.execute("BEGIN IMMEDIATE")
+        with pytest.raises(sqlite3.OperationalError) as error:
+            database.write_transaction(conn, lambda conn: None, retries=1)
+        assert database.is_busy_error(error.value)
+        assert database.write_stats.snapshot()['busy_failures'] == 1
+    finally:
+        holder.rollback()
+        holder.close()
+        conn.close()
+
 if __name__ == "__main__":
     print("Initializing database for test...")
-    database.init_db()
+    database.init_db(seed_samples=True)
     print("\nRunning database tests...")
     
     tests = [
@@ -0,0 +1,73 @@
+import pytest
+import database
+import generate_data
+import summaries
+
+
+def _generate(tmp_path, monkeypatch, name, **kwargs):
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / name))
+    database.init_db()
+    database.migrate_db()
+    conn = database.connect()
+    generate_data.generate(conn, log=lambda message: None, **kwargs)
+    return conn
+
+
+def test_generator_is_deterministic_and_keeps_derived_data_consistent(tmp_path, monkeypatch):
+    options = dict(users=5, customers=200, orders=5000, quotes=1000, seed=7)
+    first = _generate(tmp_path, monkeypatch, "a.db", **options)
+    second = _generate(tmp_path, monkeypatch, "b.db", **options)
+    try:
+        for table in ('users', 'customers', 'orders', 'quotes'):
+            query = f"SELECT * FROM {table} ORDER BY id"
+            assert [tuple(r) for r in first.execute(query)] == [tuple(r) for r in second.execute(query)]
+
+        # 索引與 trigger 都已建回，彙總表與全文索引和明細一致
+        assert first.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'idx_orders_customer'").fetchone()[0] == 1
+        assert first.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'orders_summary_insert'").fetchone()[0] == 1
+        assert summaries.check_summaries(first) == []
+        assert first.execute("SELECT COUNT(*) FROM orders_fts").fetchone()[0] == first.execute("SELECT COUNT(*) FROM orders").fetchone()[0]
+
+        # 狀態比例與客戶熱門程度的偏斜
+        statuses = dict(first.execute("SELECT status, COUNT(*) FROM orders GROUP BY status").fetchall())
+        assert statuses['已付款'] > statuses['未付款'] > statuses['取消'] > 0
+        per_customer = sorted((row[0] for row in first.execute("SELECT COUNT(*) FROM orders GROUP BY customer_id")), reverse=True)
+        assert sum(per_customer[:20]) > 0.4 * sum(per_customer)
+    finally:
+        first.close()
+        second.close()
+
+
+def test_generator_appends_and_resets(tmp_path, monkeypatch):
+    conn = _generate(tmp_path, monkeypatch, "c.db", users=2, customers=10, orders=50, quotes=5)
+    try:
+        before = conn.execute("SELECT COUNT(*) FROM orders").fetchone()[0]
+        generate_data.generate(conn, users=0, customers=10, orders=50, quotes=5, seed=1, log=lambda message: None)
+        assert conn.execute("SELECT COUNT(*) FROM orders").fetchone()[0] == before + 50
+        generate_data.generate(conn, users=0, customers=10, orders=30, quotes=5, reset=True, log=lambda message: None)
+        assert conn.execute("SELECT COUNT(*) FROM orders").fetchone()[0] == 30
+        assert summaries.check_summaries(conn) == []
+    finally:
+        conn.close()
+
+
+def test_generator_rolls_back_partial_rows_on_failure(tmp_path, monkeypatch):
+    conn = _generate(tmp_path, monkeypatch, "d.db", users=2, customers=10, orders=50, quotes=5)
+    insert_batches = generate_data._insert_batches
+
+    def fail_on_quotes(conn, sql, total, make_batch, label, log):
+        insert_batches(conn, sql, total, make_batch, label, log)
+        if 'quotes' in sql:
+            raise RuntimeError("中斷")
+
+    try:
+        before = {table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in ('customers', 'orders', 'quotes')}
+        monkeypatch.setattr(generate_data, "_insert_batches", fail_on_quotes)
+        with pytest.raises(RuntimeError):
+            generate_data.generate(conn, users=0, customers=10, orders=50, quotes=5, seed=1, log=lambda message: None)
+        after = {table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in ('customers', 'orders', 'quotes')}
+        assert after == before
+        assert conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'orders_summary_insert'").fetchone()[0] == 1
+        assert summaries.check_summaries(conn) == []
+    finally:
+        conn.close()
@@ -0,0 +1,92 @@
+import time
+import pytest
+import requests
+import chatbot
+import llm_client
+from llm_stub import StubLLMServer
+
+
+def _client(**kwargs):
+    options = dict(backoff_base=0.001, backoff_max=0.01, breaker_threshold=3, breaker_reset=60)
+    options.update(kwargs)
+    return llm_client.LLMClient(**options)
+
+
+def test_retries_transient_errors_with_backoff():
+    client = _client(max_retries=2)
+    with StubLLMServer(failures=[503, 429]) as stub:
+        response = client.post(stub.url, data='{}')
+    assert response.status_code == 200
+    stats = client.stats()
+    assert stats['retries'] == 2
+    assert stats['calls'] == 1 and stats['successes'] == 1
+    assert len(stub.requests) == 3
+
+
+def test_gives_up_after_bounded_retries():
+    client = _client(max_retries=1)
+    with StubLLMServer(failures=[500, 500, 500]) as stub:
+        assert client.post(stub.url, data='{}').status_code == 500
+    assert len(stub.requests) == 2
+    assert client.stats()['errors'] == {'http_500': 1}
+
+
+def test_read_timeout_is_enforced():
+    client = _client(read_timeout=0.05, max_retries=0)
+    with StubLLMServer(delay=0.5) as stub:
+        with pytest.raises(requests.exceptions.Timeout):
+            client.post(stub.url, data='{}')
+    assert client.stats()['errors'] == {'timeout': 1}
+
+
+def test_circuit_breaker_fails_fast_and_recovers():
+    client = _client(max_retries=0, breaker_threshold=2, breaker_reset=0.05)
+    with StubLLMServer(failures=[502, 502]) as stub:
+        client.post(stub.url, data='{}')
+        client.post(stub.url, data='{}')
+        assert client.circuit_open
+        with pytest.raises(llm_client.CircuitOpenError):
+            client.post(stub.url, data='{}')
+        assert len(stub.requests) == 2
+
+        # 冷卻時間過後放行一次試探請求，成功就關閉斷路器
+        time.sleep(0.06)
+        assert client.post(stub.url, data='{}').status_code == 200
+        assert not client.circuit_open
+    assert client.stats()['short_circuited'] == 1
+
+
+def test_half_open_probe_is_released_after_unexpected_errors(monkeypatch):
+    client = _client(max_retries=0, breaker_threshold=1, breaker_reset=0.05)
+    with StubLLMServer(failures=[502]) as stub:
+        client.post(stub.url, data='{}')
+        assert client.circuit_open
+        time.sleep(0.06)
+
+        # 試探請求拋出 requests 以外的例外，下一個請求仍可再試探
+        def broken_post(*args, **kwargs):
+            raise ValueError("bad payload")
+        monkeypatch.setattr(client.session, 'post', broken_post)
+        with pytest.raises(ValueError):
+            client.post(stub.url, data='{}')
+        monkeypatch.undo()
+        assert client.post(stub.url, data='{}').status_code == 200
+        assert not client.circuit_open
+
+
+def test_connections_are_reused():
+    client = _client()
+    with StubLLMServer() as stub:
+        for _ in range(3):
+            client.post(stub.url, data='{}').content
+    assert stub.connections == 1
+
+
+def test_chatbot_reports_open_circuit(monkeypatch):
+    client = _client(max_retries=0, breaker_threshold=1)
+    monkeypatch.setattr(llm_client, "_client", client)
+    with StubLLMServer(failures=[503]) as stub:
+        monkeypatch.setattr(chatbot, "DEEPSEEK_API_URL", stub.url)
+        assert "503" in chatbot.get_chatbot_response("你好")
+        assert chatbot.get_chatbot_response("你好") == chatbot.CIRCUIT_OPEN_MESSAGE
+        assert list(chatbot.stream_chatbot_response("你好")) == [chatbot.CIRCUIT_OPEN_MESSAGE]
@@ -0,0 +1,141 @@
+import random
+import time
+import database
+import generate_data
+import scoring
+
+
+def legacy_ai_features(customers, orders, quotes):
+    """The original row-by-row implementation from app.ai_features(), kept as the reference."""
+    customer_scores = {}
+    for customer in customers:
+        customer_scores[customer['id']] = {'name': customer['name'], 'score': 0}
+
+    for order in orders:
+        if order['customer_id'] in customer_scores:
+            if order['status'] == '取消':
+                customer_scores[order['customer_id']]['score'] -= 10
+            else:
+                customer_scores[order['customer_id']]['score'] += 10
+
+    for quote in quotes:
+        if quote['customer_id'] in customer_scores:
+            if quote['status'] == '已接受' or quote['status'] == '已轉換':
+                customer_scores[quote['customer_id']]['score'] += 5
+
+    customer_spending = {c['id']: {'name': c['name'], 'total_spent': 0} for c in customers}
+    for order in orders:
+        if order['customer_id'] in customer_spending and order['status'] != '取消':
+            customer_spending[order['customer_id']]['total_spent'] += order['amount']
+
+    spendings = sorted([v['total_spent'] for v in customer_spending.values() if v['total_spent'] > 0])
+
+    p25, p75 = 0, 0
+    if spendings:
+        p25 = spendings[int(len(spendings) * 0.25)]
+        p75 = spendings[int(len(spendings) * 0.75)]
+
+    for cid, data in customer_scores.items():
+        data['total_spent'] = customer_spending[cid]['total_spent']
+        if data['total_spent'] > (sum(s for s in spendings) / len(spendings) if spendings else 0):
+            data['score'] += 20
+
+    segments = {'high_value': [], 'mid_value': [], 'low_value': []}
+    for cid, data in customer_spending.items():
+        if data['total_spent'] >= p75 and p75 > 0:
+            segments['high_value'].append(data)
+        elif data['total_spent'] >= p25:
+            segments['mid_value'].append(data)
+        else:
+            segments['low_value'].append(data)
+
+    return sorted(customer_scores.values(), key=lambda x: x['score'], reverse=True), segments
+
+
+def _fresh_db(tmp_path, monkeypatch, name):
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / name))
+    database.init_db()
+    database.migrate_db()
+    conn = database.connect()
+    return conn
+
+
+def _assert_matches_legacy(conn):
+    expected = legacy_ai_features(
+        conn.execute('SELECT * FROM customers').fetchall(),
+        conn.execute('SELECT * FROM orders').fetchall(),
+        conn.execute('SELECT * FROM quotes').fetchall(),
+    )
+    actual = scoring.score_customers(conn)
+    assert actual == expected
+    # Same value types as well (int 0 for customers without orders)
+    for got, want in zip(actual[0], expected[0]):
+        assert type(got['total_spent']) is type(want['total_spent'])
+        assert type(got['score']) is type(want['score'])
+
+
+def test_scoring_matches_legacy_implementation(tmp_path, monkeypatch):
+    """The vectorised engine reproduces the row-by-row scores, totals and segments exactly."""
+    conn = _fresh_db(tmp_path, monkeypatch, "scoring.db")
+    rng = random.Random(42)
+    try:
+        conn.executemany(
+            "INSERT INTO customers (name, contact_person, phone, email, creator_id) VALUES (?, '', '', '', 1)",
+            [(f"客戶{i % 37}",) for i in range(300)]
+        )
+        customer_ids = [row[0] for row in conn.execute("SELECT id FROM customers")]
+        order_statuses = ['未付款', '已付款', '取消', 'Pending', 'Completed']
+        conn.executemany(
+            "INSERT INTO orders (customer_id, order_date, amount, status, creator_id) VALUES (?, '2025-01-01', ?, ?, 1)",
+            [(rng.choice(customer_ids + [None, 99999, 'abc']),
+              rng.choice([round(rng.uniform(0.01, 99999), 2), rng.uniform(-50, 50), 0.1, 1e-3]),
+              rng.choice(order_statuses)) for _ in range(5000)]
+        )
+        conn.executemany(
+            "INSERT INTO quotes (customer_id, quote_date, amount, status, creator_id) VALUES (?, '2025-01-01', ?, ?, 1)",
+            [(rng.choice(customer_ids + [None, 99999]), rng.uniform(1, 1000),
+              rng.choice(['草稿', '已發送', '已接受', '已拒絕', '已轉換'])) for _ in range(2000)]
+        )
+        conn.commit()
+        _assert_matches_legacy(conn)
+    finally:
+        conn.close()
+
+
+def test_scoring_handles_empty_and_sparse_data(tmp_path, monkeypatch):
+    """Edge cases: no orders at all, and only cancelled orders."""
+    conn = _fresh_db(tmp_path, monkeypatch, "sparse.db")
+    try:
+        conn.execute("DELETE FROM orders")
+        conn.execute("DELETE FROM quotes")
+        conn.commit()
+        _assert_matches_legacy(conn)
+        conn.execute("INSERT INTO orders (customer_id, order_date, amount, status, creator_id) VALUES (1, '2025-01-01', 10, '取消', 1)")
+        conn.commit()
+        _assert_matches_legacy(conn)
+        conn.execute("DELETE FROM customers")
+        conn.commit()
+        assert scoring.score_customers(conn) == ([], {'high_value': [], 'mid_value': [], 'low_value': []})
+    finally:
+        conn.close()
+
+
+def test_scoring_latency_stays_within_the_recorded_budget(tmp_path, monkeypatch):
+    """
+    The request asked for 1M orders in well under a second; exact output costs ~1.4 s per million
+    here (see scoring.TARGET_SECONDS_PER_MILLION_ORDERS). Guard against getting slower than the budget.
+    """
+    conn = _fresh_db(tmp_path, monkeypatch, "latency.db")
+    orders = 100_000
+    try:
+        generate_data.generate(conn, users=5, customers=2_000, orders=orders, quotes=0, reset=True,
+                               log=lambda message: None)
+        best = float('inf')
+        for _ in range(3):
+            started = time.perf_counter()
+            scoring.score_customers(conn)
+            best = min(best, time.perf_counter() - started)
+        per_million = best * 1_000_000 / orders
+        assert per_million < scoring.BUDGET_SECONDS_PER_MILLION_ORDERS, f"{per_million:.2f} s per million orders"
+    finally:
+        conn.close()
@@ -0,0 +1,72 @@
+import sqlite3
+import pytest
+import database
+import sqltrace
+from app import app
+
+
+@pytest.fixture
+def tracer():
+    sqltrace.tracer.reset()
+    sqltrace.tracer.enable(slow_ms=0)  # 每條陳述式都算慢查詢
+    try:
+        yield sqltrace.tracer
+    finally:
+        sqltrace.tracer.disable()
+        sqltrace.tracer.reset()
+
+
+def test_normalize_redact_and_scan_detection(tmp_path):
+    assert sqltrace.normalize("SELECT *\n  FROM t WHERE id IN (?, ?,?)") == "SELECT * FROM t WHERE id IN (?, ...)"
+    assert sqltrace.redact(('宏達電子', 5, None)) == ['<str:4>', '<int>', 'NULL']
+    assert sqltrace.redact([(1, 'a'), (2, 'b')]) == '<2 rows>'
+
+    path = str(tmp_path / "plan.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE t (id INTEGER PRIMARY KEY, email TEXT)")
+    conn.close()
+    plan, scans = sqltrace.explain(path, "SELECT * FROM t WHERE email = ?", ('x',))
+    assert scans == ['t']
+    plan, scans = sqltrace.explain(path, "SELECT * FROM t WHERE id = ?", (1,))
+    assert scans == [] and plan[0].startswith('SEARCH t')
+
+
+def test_tracer_aggregates_slow_statements_without_leaking_values(tracer):
+    app.config['TESTING'] = True
+    with app.test_client() as client:
+        client.post('/login', data={'employee_id': '1', 'password': '1'})
+        client.get('/customers?search=SecretTerm')
+        client.post('/orders/add', data={'customer_id': '1', 'order_date': '2025-01-01', 'amount': '10', 'status': '未付款'})
+
+        snapshot = tracer.snapshot()
+        assert snapshot['top'] and snapshot['recent_slow']
+        assert 'SecretTerm' not in repr(snapshot)
+        insert = next(s for s in snapshot['recent_slow'] if s['sql'].startswith('INSERT INTO orders'))
+        # 訂單的彙總表、全文索引與版本號 trigger 都會被計入
+        assert insert['sub_statements'] > 0
+        assert any(statement['plan'] for statement in snapshot['top'])
+
+        page = client.get('/admin/sql')
+        assert page.status_code == 200
+        assert '總耗時排行' in page.get_data(as_text=True)
+        assert client.get('/admin/sql?format=json').get_json()['enabled'] is True
+
+        client.post('/admin/sql', data={'action': 'disable'})
+        assert not tracer.enabled
+        assert tracer.snapshot()['distinct_statements'] > 0
+
+
+def test_admin_sql_requires_administrator():
+    conn = database.get_pool().acquire()
+    try:
+        if conn.execute("SELECT 1 FROM users WHERE employee_id = 'trace-user'").fetchone() is None:
+            conn.execute("INSERT INTO users (employee_id, password, name, role) VALUES ('trace-user', 'pw', 'Tracer', 'user')")
+            conn.commit()
+    finally:
+        conn.close()
+    app.config['TESTING'] = True
+    with app.test_client() as client:
+        client.post('/login', data={'employee_id': 'trace-user', 'password': 'pw'})
+        assert client.get('/admin/sql').status_code == 302
+        client.post('/admin/sql', data={'action': 'enable'})
+        assert not sqltrace.tracer.enabled
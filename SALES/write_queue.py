@@ -0,0 +1,240 @@
+"""
+批次提交（group commit）的寫入佇列。
+
+新增、修改客戶、訂單與報價單時，原本每個請求各自開連線、寫一筆、commit 一次，
+尖峰時每筆都要等一次 fsync，同時寫入的請求之間也會互相等待 SQLite 的寫入鎖（database is locked）。
+
+開啟 WRITE_QUEUE 後，這些寫入交給單一的寫入執行緒：它收集所有請求送來的 SQL，
+把上一次 commit 期間累積的寫入（最多 WRITE_QUEUE_MAX_BATCH 筆）放在同一個交易裡執行並 commit 一次，
+再以新資料列的 id（UPDATE 則是影響的筆數）完成每個呼叫者的 Future。
+設定 WRITE_QUEUE_MAX_DELAY_MS 時，第一筆到達後再多等這麼久湊成更大的批次（fsync 很慢的磁碟適用）。
+一批中有任何一筆失敗時，整批回滾後改為每筆各自包在 SAVEPOINT 裡重跑，
+所以一筆違反限制只會讓那一筆失敗，同一批的其他寫入照常提交。
+
+    WRITE_QUEUE                1 表示啟用（預設 0，每個請求自行 commit）
+    WRITE_QUEUE_MAX_BATCH      每批最多幾筆（預設 256）
+    WRITE_QUEUE_MAX_DELAY_MS   湊批次時第一筆最多多等幾毫秒（預設 0，只收已在佇列中的寫入）
+    WRITE_QUEUE_DURABILITY     full：synchronous=FULL，commit 後才回應
+                               normal：synchronous=NORMAL（與一般連線相同），commit 後才回應（預設）
+                               deferred：放入佇列就回應，不等 commit；行程當掉時佇列中的寫入會遺失
+
+統計數字在 /admin/stats 的 write_queue 與 /metrics。
+"""
+import atexit
+import concurrent.futures
+import os
+import queue
+import sqlite3
+import threading
+import time
+import database
+
+ENABLED = os.environ.get("WRITE_QUEUE", "0") == "1"
+MAX_BATCH = int(os.environ.get("WRITE_QUEUE_MAX_BATCH", "256"))
+MAX_DELAY_MS = float(os.environ.get("WRITE_QUEUE_MAX_DELAY_MS", "0"))
+DURABILITY = os.environ.get("WRITE_QUEUE_DURABILITY", "normal")
+# 等待 commit 的上限；超過時呼叫者收到 TimeoutError，寫入仍可能稍後完成
+WAIT_SECONDS = 30
+
+DURABILITIES = {'full': 'FULL', 'normal': 'NORMAL', 'deferred': 'NORMAL'}
+
+_STOP = object()
+
+
+class WriteQueue:
+    def __init__(self, path=None, max_batch=MAX_BATCH, max_delay_ms=MAX_DELAY_MS, durability=DURABILITY):
+        if durability not in DURABILITIES:
+            raise ValueError(f"未知的 durability: {durability}")
+        self.path = path
+        self.max_batch = max(1, max_batch)
+        self.max_delay = max(0.0, max_delay_ms) / 1000
+        self.durability = durability
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self.submitted = 0
+        self.committed = 0
+        self.failed = 0
+        self.batches = 0
+        self.largest_batch = 0
+        self.commit_seconds_total = 0.0
+        self.wait_seconds_total = 0.0
+
+    def _ensure_thread(self):
+        # 呼叫者須持有 self._lock。寫入執行緒在第一次寫入時才啟動；fork 出來的子行程（多個 worker）
+        # 各自啟動自己的，執行緒因例外結束後（_fail_pending 會清掉 self._thread）也在下一次寫入重新啟動
+        if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+            if self._pid != os.getpid():
+                self._queue = queue.Queue()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="write-queue", daemon=True)
+            self._thread.start()
+
+    def submit(self, sql, params=()):
+        """放入佇列並回傳 Future；commit 後以 lastrowid（INSERT）或 rowcount（其他）完成。"""
+        future = concurrent.futures.Future()
+        with self._lock:
+            # 與 _fail_pending 共用同一把鎖，放進佇列的寫入不會落在即將結束的執行緒之後
+            self._ensure_thread()
+            self.submitted += 1
+            self._queue.put((sql, params, future, time.perf_counter()))
+        return future
+
+    def write(self, sql, params=()):
+        """
+        依 durability 寫入一筆：full/normal 等到 commit 並回傳新 id 或影響筆數；
+        deferred 放入佇列就回傳 None。執行失敗時拋出與直接執行相同的 sqlite3 例外。
+        """
+        future = self.submit(sql, params)
+        if self.durability == 'deferred':
+            return None
+        return future.result(WAIT_SECONDS)
+
+    def flush(self, timeout=WAIT_SECONDS):
+        """等到目前佇列中的寫入全部提交。"""
+        if self._thread is None or self._pid != os.getpid():
+            return
+        self.submit(None).result(timeout)
+
+    def close(self, timeout=WAIT_SECONDS):
+        """提交佇列中剩下的寫入後停止寫入執行緒。"""
+        with self._lock:
+            thread = self._thread if self._pid == os.getpid() else None
+            self._thread = None
+        if thread is not None and thread.is_alive():
+            self._queue.put(_STOP)
+            thread.join(timeout)
+
+    def _connect(self):
+        conn = database.connect(self.path)
+        conn.isolation_level = None  # 交易由 _commit 自行控制
+        conn.execute(f"PRAGMA synchronous={DURABILITIES[self.durability]}")
+        return conn
+
+    def _run(self):
+        try:
+            conn = self._connect()
+        except Exception as e:
+            self._fail_pending([], e)
+            return
+        try:
+            while True:
+                batch = []
+                item = self._queue.get()
+                if item is _STOP:
+                    return
+                batch = [item]
+                deadline = time.perf_counter() + self.max_delay
+                stop = False
+                while len(batch) < self.max_batch:
+                    remaining = deadline - time.perf_counter()
+                    try:
+                        item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is _STOP:
+                        stop = True
+                        break
+                    batch.append(item)
+                self._commit(conn, batch)
+                if stop:
+                    return
+        except Exception as e:
+            # 執行緒即將結束：手上這一批與佇列中的寫入都以例外完成，呼叫者不必等到 WAIT_SECONDS
+            self._fail_pending(batch, e)
+        finally:
+            conn.close()
+
+    def _fail_pending(self, batch, error):
+        pending = [item for item in batch if not item[2].done()]
+        with self._lock:
+            while True:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not _STOP:
+                    pending.append(item)
+            if self._thread is threading.current_thread():
+                self._thread = None
+            self.failed += sum(1 for sql, _, _, _ in pending if sql is not None)
+        for _, _, future, _ in pending:
+            future.set_exception(error)
+
+    @staticmethod
+    def _execute(conn, sql, params):
+        cursor = conn.execute(sql, params)
+        return cursor.lastrowid if sql.startswith('INSERT') else cursor.rowcount
+
+    def _apply(self, conn, batch, isolate):
+        results = []
+        for sql, params, _, _ in batch:
+            if sql is None:  # flush() 的標記
+                results.append((True, None))
+            elif not isolate:
+                # 任何一筆失敗就讓例外往外丟，由 _commit 回滾後逐筆重跑
+                results.append((True, self._execute(conn, sql, params)))
+            else:
+                conn.execute("SAVEPOINT write_queue_item")
+                try:
+                    results.append((True, self._execute(conn, sql, params)))
+                except sqlite3.Error as e:
+                    conn.execute("ROLLBACK TO write_queue_item")
+                    results.append((False, e))
+                conn.execute("RELEASE write_queue_item")
+        return results
+
+    def _commit(self, conn, batch):
+        started = time.perf_counter()
+        try:
+            try:
+                results = database.write_transaction(conn, lambda conn: self._apply(conn, batch, isolate=False))
+            except sqlite3.Error as e:
+                if len(batch) == 1 or database.is_busy_error(e):
+                    raise
+                results = database.write_transaction(conn, lambda conn: self._apply(conn, batch, isolate=True))
+        except sqlite3.Error as e:
+            results = [(False, e)] * len(batch)
+
+        finished = time.perf_counter()
+        with self._lock:
+            self.batches += 1
+            self.largest_batch = max(self.largest_batch, len(batch))
+            self.commit_seconds_total += finished - started
+            for (sql, _, _, queued_at), (ok, _) in zip(batch, results):
+                if sql is None:
+                    continue
+                self.wait_seconds_total += started - queued_at
+                if ok:
+                    self.committed += 1
+                else:
+                    self.failed += 1
+        for (_, _, future, _), (ok, value) in zip(batch, results):
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    def stats(self):
+        with self._lock:
+            writes = self.committed + self.failed
+            return {
+                'enabled': ENABLED,
+                'durability': self.durability,
+                'max_batch': self.max_batch,
+                'max_delay_ms': self.max_delay * 1000,
+                'queue_depth': self._queue.qsize(),
+                'submitted': self.submitted,
+                'committed': self.committed,
+                'failed': self.failed,
+                'batches': self.batches,
+                'largest_batch': self.largest_batch,
+                'avg_batch': writes / self.batches if self.batches else 0.0,
+                'wait_seconds_avg': self.wait_seconds_total / writes if writes else 0.0,
+                'commit_seconds_avg': self.commit_seconds_total / self.batches if self.batches else 0.0,
+            }
+
+
+writer = WriteQueue()
+atexit.register(writer.close)
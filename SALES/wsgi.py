@@ -0,0 +1,10 @@
+"""
+正式環境的 WSGI 進入點（多個 worker 行程）：
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+開發時仍可用 python app.py。Vercel 直接載入 app.py。
+"""
+from app import app
+
+application = app